@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""CachingKojiWrapper benchmark suite against a synthetic in-process koji hub
+
+Each scenario runs on a cold cache (empty cache directory) and again on a
+warm one (a new wrapper loading what the cold run saved).  Wall time, hub
+calls (every multiCall round trip counts once) and peak traced memory are
+reported, and optionally compared with a stored baseline:
+
+    python benchmarks/bench_koji.py --builds 2000 --latency 0.002
+    python benchmarks/bench_koji.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_koji.py --baseline benchmarks/baseline.json
+
+Run it with container_processing importable (pip install -e .).
+"""
+
+from __future__ import print_function
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from container_processing.caching_koji import CachingKojiWrapper
+from container_processing.test_support import batch_label
+from container_processing.test_support import make_synthetic_hub
+from container_processing import update_internal_container_registry
+
+OSP = 16.0
+RHEL = 8
+
+
+def scenario_matching_batch(koji_session, args):
+    koji_session.get_matching_batch_from_tag(OSP, RHEL, batch_label(args.batches - 1))
+
+
+def scenario_latest_cdn(koji_session, args):
+    koji_session.get_latest_cdn_containers(OSP, RHEL, extra_info=True)
+
+
+def scenario_get_tree(koji_session, args):
+    containers = koji_session.get_list_containers(OSP, RHEL, latest=True)
+    koji_session.get_tree(sorted(containers), fout=io.StringIO())
+
+
+def scenario_save_load(koji_session, args):
+    koji_session.get_list_containers(OSP, RHEL)
+    koji_session.prefetch_records(koji_session._nvr_to_build_id.values(), grab_build_task_info=True)
+    with tempfile.TemporaryDirectory() as cache_path:
+        koji_session.save_cache(path=cache_path)
+        loaded = CachingKojiWrapper(session=koji_session.session)
+        loaded.load_cache(path=cache_path, lazy=False)
+
+
+def scenario_update_registry(koji_session, args):
+    argv = [str(OSP), 'bench', '--rhel', str(RHEL), '--from-cdn',
+            '--batch', batch_label(args.batches - 1), '--cache-path', args.cache_path]
+    update_internal_container_registry.main(argv, koji_session=koji_session)
+
+
+SCENARIOS = [
+    ('get_matching_batch_from_koji_tag', scenario_matching_batch),
+    ('get_latest_cdn_containers', scenario_latest_cdn),
+    ('get_tree', scenario_get_tree),
+    ('load_cache/save_cache', scenario_save_load),
+    ('update_internal_container_registry.main', scenario_update_registry),
+]
+
+
+def measure(name, scenario, hub, args, warm):
+    """Run scenario with a wrapper on hub, cache_path is shared by cold and warm"""
+    koji_session = CachingKojiWrapper(session=hub, multicall_chunk_size=args.chunk_size,
+                                      max_workers=args.max_workers)
+    if warm:
+        koji_session.load_cache(path=args.cache_path)
+
+    hub.calls.clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        scenario(koji_session, args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    if not warm:
+        koji_session.save_cache(path=args.cache_path)
+
+    return {'scenario': name, 'cache': 'warm' if warm else 'cold',
+            'wall': elapsed, 'hub_calls': sum(hub.calls.values()),
+            'calls': dict(hub.calls), 'peak_mib': peak / 1024.0 / 1024.0}
+
+
+def run(args):
+    results = []
+    hub = make_synthetic_hub(builds=args.builds, batches=args.batches, osp=OSP, rhel=RHEL,
+                             latency=args.latency)
+    for name, scenario in SCENARIOS:
+        if args.scenario and args.scenario not in name:
+            continue
+        args.cache_path = tempfile.mkdtemp(prefix='bench-koji-')
+        try:
+            for warm in (False, True):
+                results.append(measure(name, scenario, hub, args, warm))
+        finally:
+            shutil.rmtree(args.cache_path)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print results next to baseline, returns the regressed entries"""
+    previous = dict(((i['scenario'], i['cache']), i) for i in baseline['results'])
+    regressions = []
+    for result in results:
+        before = previous.get((result['scenario'], result['cache']))
+        if before is None:
+            continue
+        wall_ratio = result['wall'] / before['wall'] if before['wall'] else 1.0
+        flag = ''
+        if result['hub_calls'] > before['hub_calls'] or wall_ratio > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(result)
+        print("{0:<42} {1:<4} wall x{2:.2f}  hub calls {3} -> {4}{5}".format(
+            result['scenario'], result['cache'], wall_ratio, before['hub_calls'],
+            result['hub_calls'], flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--builds', type=int, default=1000,
+                        help='container builds in the synthetic candidate tag (100 - 20000)')
+    parser.add_argument('--batches', type=int, default=4,
+                        help='rebuilds of every image, one batch label each')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every hub call')
+    parser.add_argument('--chunk-size', type=int, default=200,
+                        help='multicall chunk size, 0 disables multicall prefetch')
+    parser.add_argument('--max-workers', type=int, default=None,
+                        help='thread pool size for record resolution')
+    parser.add_argument('--scenario', type=str, default=None,
+                        help='only run scenarios whose name contains this')
+    parser.add_argument('--save-baseline', type=str, default=None,
+                        help='write the results as a baseline to this file')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='compare the results with this baseline')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='wall time ratio over baseline counted as a regression')
+    args = parser.parse_args()
+
+    results = run(args)
+
+    print("{0:<42} {1:<4} {2:>9} {3:>9} {4:>9}".format('scenario', '', 'wall s', 'hub calls', 'peak MiB'))
+    for result in results:
+        print("{0:<42} {1:<4} {2:>9.3f} {3:>9} {4:>9.1f}".format(
+            result['scenario'], result['cache'], result['wall'], result['hub_calls'],
+            result['peak_mib']))
+
+    settings = dict((key, getattr(args, key)) for key in
+                    ('builds', 'batches', 'latency', 'chunk_size', 'max_workers'))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fout:
+            json.dump({'settings': settings, 'results': results}, fout, indent=2, sort_keys=True)
+            fout.write('\n')
+
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        if baseline['settings'] != settings:
+            print("# baseline was taken with {0}".format(baseline['settings']))
+        print()
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
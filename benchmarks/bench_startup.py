@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Startup time benchmark
+
+Compares eager and lazy CachingKojiWrapper.load_cache on a synthetic cache
+directory, and the import/startup cost of the command line entry points.
+
+    python benchmarks/bench_startup.py --builds 5000
+
+Run it with container_processing importable (pip install -e .).
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def populate_cache(cache_path, builds):
+    from container_processing.caching_koji import CachingKojiWrapper
+    from container_processing.test_support import FakeKojiHub
+    from container_processing.test_support import make_container_build
+    from container_processing.test_support import make_task_result
+
+    hub = FakeKojiHub()
+    for build_id in range(1, builds + 1):
+        build = make_container_build(build_id, 'openstack-svc{0}-container'.format(build_id),
+                                     parent_build_id=1 if build_id > 1 else None)
+        hub.add_build(build, make_task_result(build, batch='20190601.1'))
+
+    koji_session = CachingKojiWrapper(session=hub)
+    koji_session.prefetch_records(range(1, builds + 1), grab_build_task_info=True)
+    koji_session.save_cache(path=cache_path)
+
+
+def time_load(cache_path, lazy):
+    from container_processing.caching_koji import CachingKojiWrapper
+    from container_processing.test_support import FakeKojiHub
+
+    koji_session = CachingKojiWrapper(session=FakeKojiHub())
+    start = time.perf_counter()
+    koji_session.load_cache(path=cache_path, lazy=lazy)
+    loaded = time.perf_counter()
+    koji_session.get_nvr(1)
+    first = time.perf_counter()
+    return loaded - start, first - start
+
+
+def time_command(argv, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--builds', type=int, default=5000,
+                        help='number of synthetic builds in the cache')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per command, the best is reported')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_path:
+        populate_cache(cache_path, args.builds)
+        size = sum(os.path.getsize(os.path.join(cache_path, i)) for i in os.listdir(cache_path))
+        print("cache: {0} builds, {1:.1f} MiB".format(args.builds, size / 1024.0 / 1024.0))
+
+        for lazy in (False, True):
+            loaded, first = time_load(cache_path, lazy)
+            print("load_cache(lazy={0}): load {1:.3f}s, first lookup {2:.3f}s".format(
+                lazy, loaded, first))
+
+    for name, argv in [
+            ('python startup', [sys.executable, '-c', 'pass']),
+            ('group_test_parse --help',
+             [sys.executable, '-m', 'container_processing.group_test_parse', '--help']),
+            ('update_internal_container_registry --help',
+             [sys.executable, '-m', 'container_processing.update_internal_container_registry', '--help']),
+            ('import caching_koji',
+             [sys.executable, '-c', 'import container_processing.caching_koji'])]:
+        print("{0}: {1:.3f}s".format(name, time_command(argv, args.repeat)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""Parent/child index over container image builds
+
+Container images are built on top of a parent image, following those links
+gives a forest rooted at the base images.  BuildGraph keeps both directions
+of the links so ancestry and "what is built on top of X" are lookups
+rather than scans.
+"""
+
+from __future__ import print_function
+import json
+import threading
+
+
+class BuildGraph(object):
+    """Adjacency index of build ids
+
+    parents maps build id to parent build id (None for roots) and children
+    maps build id to a tuple of child build ids.  Both are plain mappings,
+    CachingKojiWrapper passes its caches so the index is persisted with them.
+    """
+
+    def __init__(self, parents=None, children=None):
+        self.parents = parents if parents is not None else {}
+        self.children = children if children is not None else {}
+        self.lock = threading.RLock()
+
+    def add(self, build_id, parent_build_id):
+        """Record that build_id is built on parent_build_id (None for a root)"""
+        with self.lock:
+            self.parents[build_id] = parent_build_id
+            if parent_build_id is None:
+                return
+            siblings = self.children.get(parent_build_id, ())
+            if build_id not in siblings:
+                self.children[parent_build_id] = tuple(sorted(siblings + (build_id,)))
+
+    def __contains__(self, build_id):
+        return build_id in self.parents
+
+    def parent(self, build_id):
+        return self.parents.get(build_id)
+
+    def get_children(self, build_id):
+        return list(self.children.get(build_id, ()))
+
+    def ancestors(self, build_id):
+        """Parent, grandparent ... of build_id, nearest first"""
+        ancestors = []
+        seen = set([build_id])
+        parent_build_id = self.parent(build_id)
+        while parent_build_id is not None and parent_build_id not in seen:
+            ancestors.append(parent_build_id)
+            seen.add(parent_build_id)
+            parent_build_id = self.parent(parent_build_id)
+        return ancestors
+
+    def descendants(self, build_id):
+        """Every build built (directly or not) on build_id, level by level"""
+        descendants = []
+        seen = set([build_id])
+        frontier = [build_id]
+        while frontier:
+            next_frontier = []
+            for node in frontier:
+                for child in self.get_children(node):
+                    if child not in seen:
+                        seen.add(child)
+                        next_frontier.append(child)
+            descendants.extend(next_frontier)
+            frontier = next_frontier
+        return descendants
+
+    def topological_order(self, build_ids):
+        """build_ids ordered so every parent comes before its children"""
+        build_ids = set(build_ids)
+        depths = {}
+
+        for build_id in build_ids:
+            chain = []
+            node = build_id
+            while node in build_ids and node not in depths and node not in chain:
+                chain.append(node)
+                node = self.parent(node)
+            depth = depths.get(node, -1) if node in build_ids else -1
+            for node in reversed(chain):
+                depth += 1
+                depths[node] = depth
+
+        return sorted(build_ids, key=lambda build_id: (depths[build_id], build_id))
+
+    def edges(self, build_ids):
+        """(parent, child) pairs among build_ids in topological order"""
+        ordered = self.topological_order(build_ids)
+        nodes = set(ordered)
+        for build_id in ordered:
+            parent_build_id = self.parent(build_id)
+            if parent_build_id is not None and parent_build_id in nodes:
+                yield parent_build_id, build_id
+
+    def write_dot(self, fout, build_ids, label=str):
+        """Stream a graphviz digraph of build_ids, label maps id to text"""
+        build_ids = self.topological_order(build_ids)
+        print("digraph builds {", file=fout)
+        for build_id in build_ids:
+            print("{0} [label = {1} ];".format(build_id, json.dumps(label(build_id))), file=fout)
+        for parent_build_id, build_id in self.edges(build_ids):
+            print("{0} -> {1} ;".format(parent_build_id, build_id), file=fout)
+        print("}", file=fout)
+
+    def write_json(self, fout, build_ids, label=str):
+        """Stream {"nodes": [...], "edges": [...]} for build_ids"""
+        build_ids = self.topological_order(build_ids)
+        fout.write('{"nodes": [')
+        for index, build_id in enumerate(build_ids):
+            node = {'build_id': build_id, 'label': label(build_id),
+                    'parent_build_id': self.parent(build_id)}
+            fout.write((',\n' if index else '\n') + json.dumps(node, sort_keys=True))
+        fout.write('\n], "edges": [')
+        for index, edge in enumerate(self.edges(build_ids)):
+            fout.write((',\n' if index else '\n') + json.dumps(list(edge)))
+        fout.write('\n]}\n')
+
+
+def main():
+    """Write the image build forest of a rhos tag as DOT or JSON"""
+
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('osp', type=float,
+                        help='osp version to work with')
+    parser.add_argument('--rhel', default=7, type=str,
+                        help='rhel version to work with (should match rhos-XX-rhel-<rhel_ver> of branch)')
+    parser.add_argument('--sub-tag', default='candidate', type=str,
+                        help='tag suffix, rhos-XX-rhel-<rhel_ver>-<sub_tag>')
+    parser.add_argument('--latest', default=False, action='store_true',
+                        help='only the latest build of each image')
+    parser.add_argument('--descendants-of', type=str, default=None,
+                        help='only builds built on top of this nvr')
+    parser.add_argument('--format', dest='output_format', choices=['dot', 'json'], default='dot',
+                        help='output format')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='file to write the graph to (default stdout)')
+    parser.add_argument('--stats', default=False, action='store_true',
+                        help='Print cache and hub call statistics as JSON on stderr')
+    parser.add_argument('--prometheus-textfile', type=str, default=None,
+                        help='Write cache and hub call statistics to this Prometheus textfile')
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument('--record', type=str, default=None, metavar='CASSETTE',
+                          help='Record every hub call and response to this cassette file')
+    cassette.add_argument('--replay', type=str, default=None, metavar='CASSETTE',
+                          help='Answer hub calls from this cassette file instead of the hub')
+    parser.add_argument('--replay-latency', type=float, default=0.0,
+                        help='Seconds slept per hub round trip with --replay')
+    args = parser.parse_args()
+
+    from container_processing.caching_koji import CachingKojiWrapper
+    from container_processing.stats import report_stats
+
+    koji_session = CachingKojiWrapper(profile='brew', record_to=args.record,
+                                      replay_from=args.replay, replay_latency=args.replay_latency)
+    koji_session.load_cache()
+
+    containers = koji_session.get_list_containers(args.osp, args.rhel, sub_tag=args.sub_tag,
+                                                  latest=args.latest)
+    build_ids = koji_session.resolve_ancestry(sorted(containers))
+    if args.descendants_of:
+        base_build_id = koji_session.getBuildId(args.descendants_of)
+        build_ids = [base_build_id] + koji_session.get_descendants(base_build_id)
+
+    if args.output:
+        with open(args.output, 'w') as fout:
+            koji_session.write_graph(build_ids, fout, output_format=args.output_format)
+    else:
+        koji_session.write_graph(build_ids, sys.stdout, output_format=args.output_format)
+
+    koji_session.save_cache()
+    if args.record:
+        koji_session.save_cassette()
+    if args.stats or args.prometheus_textfile:
+        report_stats(koji_session, show=args.stats, prometheus_textfile=args.prometheus_textfile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Manage the CachingKojiWrapper cache directory
+
+    cache_manage warm 16.0:8 16.0:8:container-released
+    cache_manage export /srv/bundles
+    cache_manage import /srv/bundles/cache-<sha256>.tar.xz
+
+warm fills the caches for every container image of the given tags so the
+next run starts warm, export packs the cache directory into one compressed
+content addressed bundle a nightly job can publish and import unpacks one
+on a CI worker.
+"""
+
+from __future__ import print_function
+import argparse
+from container_processing.cache_util import CACHE_BACKENDS
+from container_processing.cache_util import CACHE_PATH
+from container_processing.cache_util import export_bundle
+from container_processing.cache_util import import_bundle
+import os.path
+import sys
+
+
+def parse_target(target):
+    """osp:rhel[:sub_tag] to (osp, rhel, sub_tag)"""
+    parts = target.split(':')
+    if len(parts) not in (2, 3):
+        raise argparse.ArgumentTypeError(
+            "{0} is not osp:rhel or osp:rhel:sub_tag".format(target))
+    osp, rhel = float(parts[0]), parts[1]
+    sub_tag = parts[2] if len(parts) == 3 else 'candidate'
+    return osp, rhel, sub_tag
+
+
+def warm_cache(koji_session, targets, latest=False):
+    """Fetch every container build of each (osp, rhel, sub_tag) with task info
+
+    Returns the number of builds now cached.
+    """
+    build_ids = set()
+    results = koji_session.get_containers_for_targets(targets, latest=latest, extra_info=True)
+    for matching_containers in results.values():
+        for records in matching_containers.values():
+            build_ids.update(records)
+    # parents are what get_tree walks
+    koji_session.resolve_ancestry(sorted(build_ids))
+    return len(build_ids)
+
+
+def get_options(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache-path', type=str, default=CACHE_PATH,
+                        help='Directory the koji caches are kept in')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    warm = subparsers.add_parser('warm', help='fill the caches for the container images of tags')
+    warm.add_argument('targets', nargs='+', type=parse_target, metavar='OSP:RHEL[:SUB_TAG]',
+                      help='tags rhos-OSP-rhel-RHEL-SUB_TAG (SUB_TAG defaults to candidate)')
+    warm.add_argument('--latest', default=False, action='store_true',
+                      help='only the latest build of each image')
+    warm.add_argument('--max-workers', type=int, default=None,
+                      help='Resolve koji records on a thread pool of this size')
+    warm.add_argument('--cache-backend', choices=CACHE_BACKENDS, default='pickle',
+                      help='How the koji caches are persisted between runs')
+
+    export = subparsers.add_parser('export', help='pack the caches into a bundle')
+    export.add_argument('bundle', type=str,
+                        help='bundle file, or directory to write cache-<sha256>.tar.xz in')
+
+    unpack = subparsers.add_parser('import', help='unpack a bundle into the cache directory')
+    unpack.add_argument('bundle', type=str, help='bundle file made by export')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None, koji_session=None):
+    args = get_options(argv)
+    cache_path = os.path.expanduser(args.cache_path)
+
+    # koji is slow to import, only pay for it once the options are valid
+    from container_processing.caching_koji import CACHE_SCHEMA_VERSION
+
+    if args.command == 'warm':
+        if koji_session is None:
+            from container_processing.caching_koji import CachingKojiWrapper
+            koji_session = CachingKojiWrapper(profile='brew', max_workers=args.max_workers,
+                                              cache_backend=args.cache_backend)
+        koji_session.load_cache(path=cache_path)
+        count = warm_cache(koji_session, args.targets, latest=args.latest)
+        koji_session.save_cache(path=cache_path)
+        print("{0} builds cached in {1}".format(count, cache_path))
+
+    elif args.command == 'export':
+        try:
+            print(export_bundle(cache_path, args.bundle))
+        except ValueError as ex:
+            print("cache_manage: error: {0}".format(ex), file=sys.stderr)
+            return 1
+
+    elif args.command == 'import':
+        try:
+            written = import_bundle(args.bundle, cache_path, CACHE_SCHEMA_VERSION)
+        except ValueError as ex:
+            print("cache_manage: error: {0}".format(ex), file=sys.stderr)
+            return 1
+        print("{0} caches updated in {1}".format(len(written), cache_path))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,36 @@
 from __future__ import print_function
+import contextlib
+import hashlib
+import io
+import json
+import os
 import os.path
 import pickle
+import tarfile
+import tempfile
+import threading
+
+from cachetools import Cache
+from concurrent.futures import Future
+
+try:
+    import fcntl
+except ImportError:
+    # no flock, processes sharing a cache directory are not coordinated
+    fcntl = None
+
+CACHE_PATH = "~/.cache/container-processing"
+
+# where CachingKojiWrapper.load_cache/save_cache persist the caches
+CACHE_BACKENDS = ('pickle', 'sqlite')
+
+MANIFEST_FILENAME = 'manifest.json'
+
+# flock()ed by processes reading or writing a cache directory
+LOCK_FILENAME = '.lock'
+
+# maxsize of a cachetools Cache that never evicts
+UNBOUNDED = float('inf')
 
 
 def load_cache(cache_to_load, cache_file):
@@ -19,6 +49,420 @@ def save_cache(cache_to_save, cache_file):
         pickle.dump(data, f)
 
 
+def atomic_write(filename, data):
+    """Write data to filename through a temp file and rename
+
+    Readers see either the old or the new file, never a truncated one.
+    """
+    dirname = os.path.dirname(filename) or '.'
+    fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix='.{0}.'.format(os.path.basename(filename)))
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            fout.write(data)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+        raise
+
+
+@contextlib.contextmanager
+def cache_dir_lock(cache_path, exclusive=True):
+    """Hold a shared or exclusive lock on a cache directory
+
+    Writers hold it exclusive while they write the cache files and the
+    manifest, readers shared so the files they read match the manifest.
+    """
+    if fcntl is None or not os.path.isdir(cache_path):
+        yield
+        return
+
+    fd = os.open(os.path.join(cache_path, LOCK_FILENAME), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        # closing the file releases the lock
+        os.close(fd)
+
+
+def checksum(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def load_manifest(cache_path, schema_version):
+    """Load the cache directory manifest
+
+    Returns None when there is no manifest or it is from an older schema
+    version, the caller treats those caches as legacy and migrates them.  An
+    empty manifest is returned when it is unreadable or from a newer schema
+    version, which invalidates every cache it describes.
+    """
+    filename = os.path.join(cache_path, MANIFEST_FILENAME)
+    if not os.path.isfile(filename):
+        return None
+
+    empty = {'schema_version': schema_version, 'caches': {}}
+    try:
+        with open(filename) as fin:
+            manifest = json.load(fin)
+    except ValueError:
+        return empty
+
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('schema_version'), int):
+        return empty
+    if manifest['schema_version'] < schema_version:
+        return None
+    if manifest['schema_version'] != schema_version:
+        return empty
+    manifest.setdefault('caches', {})
+    return manifest
+
+
+def save_manifest(cache_path, manifest):
+    atomic_write(os.path.join(cache_path, MANIFEST_FILENAME),
+                 json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+
+
+def export_bundle(cache_path, bundle):
+    """Pack the (pickle backend) caches of cache_path into a compressed bundle
+
+    The bundle is an xz tarball of manifest.json and every cache file as
+    objects/<sha256>, packed deterministically so the same caches always
+    give the same bundle.  When bundle is a directory the bundle is written
+    in it as cache-<sha256 of the bundle>.tar.xz.  Returns the filename.
+    """
+    if not os.path.isfile(os.path.join(cache_path, MANIFEST_FILENAME)):
+        raise ValueError("{0} holds no pickle backend caches to export (no {1})".format(
+            cache_path, MANIFEST_FILENAME))
+
+    with cache_dir_lock(cache_path, exclusive=False):
+        with open(os.path.join(cache_path, MANIFEST_FILENAME), 'rb') as fin:
+            manifest_data = fin.read()
+        manifest = json.loads(manifest_data.decode('utf-8'))
+
+        objects = {}
+        for name, entry in manifest['caches'].items():
+            with open(os.path.join(cache_path, name), 'rb') as fin:
+                data = fin.read()
+            if checksum(data) != entry['sha256']:
+                raise ValueError("{0} does not match the manifest".format(name))
+            objects[entry['sha256']] = data
+
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:xz') as tar:
+        members = [(MANIFEST_FILENAME, manifest_data)]
+        members += [('objects/' + sha256, objects[sha256]) for sha256 in sorted(objects)]
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+    data = buf.getvalue()
+
+    if os.path.isdir(bundle):
+        bundle = os.path.join(bundle, 'cache-{0}.tar.xz'.format(checksum(data)))
+    atomic_write(bundle, data)
+    return bundle
+
+
+def import_bundle(bundle, cache_path, schema_version):
+    """Unpack a bundle made by export_bundle into cache_path
+
+    Every object is checked against its name, and the bundle against its
+    own name when it carries one.  The caches in the bundle replace the
+    local ones, files already matching the bundle are left alone.  Returns
+    the names of the caches written.
+    """
+    with open(bundle, 'rb') as fin:
+        data = fin.read()
+
+    basename = os.path.basename(bundle)
+    if basename.startswith('cache-') and basename.endswith('.tar.xz') and \
+            basename[len('cache-'):-len('.tar.xz')] != checksum(data):
+        raise ValueError("{0} does not match its checksum".format(bundle))
+
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:xz') as tar:
+        manifest = json.loads(tar.extractfile(MANIFEST_FILENAME).read().decode('utf-8'))
+        if manifest.get('schema_version') != schema_version:
+            raise ValueError("{0} holds caches of schema version {1} not {2}".format(
+                bundle, manifest.get('schema_version'), schema_version))
+
+        objects = {}
+        for entry in manifest['caches'].values():
+            sha256 = entry['sha256']
+            if sha256 not in objects:
+                objects[sha256] = tar.extractfile('objects/' + sha256).read()
+                if checksum(objects[sha256]) != sha256:
+                    raise ValueError("object {0} of {1} is corrupt".format(sha256, bundle))
+
+    if not os.path.isdir(cache_path):
+        os.makedirs(cache_path)
+
+    written = []
+    with cache_dir_lock(cache_path, exclusive=True):
+        current = load_manifest(cache_path, schema_version) or {'caches': {}}
+        for name, entry in sorted(manifest['caches'].items()):
+            if current['caches'].get(name) == entry and \
+                    os.path.exists(os.path.join(cache_path, name)):
+                continue
+            atomic_write(os.path.join(cache_path, name), objects[entry['sha256']])
+            written.append(name)
+        # caches the bundle does not have stay as they are
+        current['caches'].update(manifest['caches'])
+        save_manifest(cache_path, {'schema_version': schema_version,
+                                   'caches': current['caches']})
+    return written
+
+
+class LockedCache(object):
+    """Wrap a cachetools cache so it can be shared between threads
+
+    cachetools caches are not thread-safe (even lookups reorder an LRUCache),
+    every access goes through a per-cache lock.  Iteration helpers return
+    snapshots so callers never iterate a cache another thread is changing.
+
+    dirty is set whenever an entry is added, changed or removed so unchanged
+    caches can be skipped when saving.
+
+    lazy_load() defers reading the cache until it is first used, loader
+    returns the cache to use or None to keep the current (empty) one.  The
+    loader runs before lock is handed out, never while it is held: it waits
+    for the cache directory lock, which save_cache holds while it takes the
+    lock of every loaded cache.
+
+    Lookups (in, get, and [] misses) are counted as hits and misses, and
+    entries dropped by a cachetools cache to make room or because their ttl
+    ran out as evictions and expirations, see stats().
+    """
+
+    _missing = object()
+
+    def __init__(self, cache):
+        self._cache = cache
+        self.loader = None
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()
+        self.dirty = False
+        self.reset_stats()
+
+    def __getstate__(self):
+        return {'cache': self.cache}
+
+    def __setstate__(self, state):
+        self._cache = state['cache']
+        self.loader = None
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()
+        self.dirty = False
+        self.reset_stats()
+
+    def __getattr__(self, name):
+        # currsize, maxsize, ttl ... from the wrapped cache
+        if name in ('_cache', 'loader', '_lock', '_load_lock', 'dirty', 'hits', 'misses', 'evictions', 'expirations'):
+            raise AttributeError(name)
+        return getattr(self.cache, name)
+
+    @property
+    def lock(self):
+        """The lock of every access, taken once a pending loader ran"""
+        if self.loader is not None:
+            self.load()
+        return self._lock
+
+    @property
+    def cache(self):
+        if self.loader is not None:
+            self.load()
+        return self._cache
+
+    @cache.setter
+    def cache(self, cache):
+        with self._lock:
+            self._cache = cache
+            self.loader = None
+
+    @property
+    def loaded(self):
+        return self.loader is None
+
+    def lazy_load(self, loader):
+        with self._lock:
+            self.loader = loader
+
+    def load(self):
+        """Run a pending loader, one thread at a time and outside lock"""
+        with self._load_lock:
+            loader = self.loader
+            if loader is None:
+                return
+            loaded = loader()
+            with self._lock:
+                if loaded is not None:
+                    self._cache = loaded
+                # only loaded once the cache is in place, save_cache skips
+                # caches still loading
+                self.loader = None
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def stats(self):
+        """Counters and size, size is None while the cache is not loaded and
+        maxsize None for an unbounded cache"""
+        with self._lock:
+            size = None
+            if self.loaded:
+                size = len(self._cache)
+            maxsize = getattr(self._cache, 'maxsize', None)
+            if maxsize == UNBOUNDED:
+                maxsize = None
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'expirations': self.expirations, 'size': size, 'maxsize': maxsize}
+
+    def _count(self, found):
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    def __contains__(self, key):
+        with self.lock:
+            return self._count(key in self.cache)
+
+    def __getitem__(self, key):
+        with self.lock:
+            try:
+                return self.cache[key]
+            except KeyError:
+                self.misses += 1
+                raise
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            cache = self.cache
+            if cache.get(key, self._missing) != value:
+                self.dirty = True
+
+            if not isinstance(cache, Cache):
+                cache[key] = value
+                return
+
+            if hasattr(cache, 'expire'):
+                self.expirations += len(cache.expire() or ())
+            before = len(cache)
+            added = key not in cache
+            cache[key] = value
+            self.evictions += max(0, before + added - len(cache))
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.cache[key]
+            self.dirty = True
+
+    def __len__(self):
+        with self.lock:
+            return len(self.cache)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.cache.get(key, self._missing)
+            if self._count(value is not self._missing):
+                return value
+            return default
+
+    def keys(self):
+        with self.lock:
+            return list(self.cache.keys())
+
+    def values(self):
+        with self.lock:
+            return list(self.cache.values())
+
+    def items(self):
+        with self.lock:
+            return list(self.cache.items())
+
+
+class SingleFlight(object):
+    """Merge concurrent calls for the same key into one
+
+    The first caller for a key runs the function, callers arriving while it
+    is in flight wait for and share its result (or exception).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def do(self, key, function, *args, **kwargs):
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.in_flight[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def do_many(self, name, keys, function):
+        """Run function(keys) for the keys not in flight under name
+
+        function fills a cache for a batch of keys (a multicall) and returns
+        nothing.  Keys another caller already has in flight are left to it,
+        do_many returns once they landed too.
+        """
+        future = Future()
+        claimed = []
+        others = []
+        with self.lock:
+            for key in keys:
+                other = self.in_flight.get((name, key))
+                if other is None:
+                    self.in_flight[(name, key)] = future
+                    claimed.append(key)
+                elif other not in others:
+                    others.append(other)
+
+        try:
+            if claimed:
+                function(claimed)
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        else:
+            future.set_result(None)
+        finally:
+            with self.lock:
+                for key in claimed:
+                    del self.in_flight[(name, key)]
+
+        for other in others:
+            other.result()
+
+
 class CacheUtil:
     def __init__(self, cache, cache_file, debug=False):
         self.cache = cache
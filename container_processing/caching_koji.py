@@ -1,129 +1,481 @@
+from cachetools import Cache
 from cachetools import LRUCache
 from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from container_processing.build_graph import BuildGraph
+from container_processing.cache_util import atomic_write
+from container_processing.cache_util import cache_dir_lock
+from container_processing.cache_util import CACHE_BACKENDS
+from container_processing.cache_util import CACHE_PATH
+from container_processing.cache_util import checksum
+from container_processing.cache_util import load_manifest
+from container_processing.cache_util import LockedCache
+from container_processing.cache_util import save_manifest
+from container_processing.cache_util import SingleFlight
+from container_processing.cache_util import UNBOUNDED
+from container_processing.cassette import Cassette
+from container_processing.cassette import RecordingSession
+from container_processing.cassette import ReplaySession
+from container_processing.hub_governor import HUB_RETRIES
+from container_processing.hub_governor import HubGovernor
+from container_processing.hub_governor import MAX_HUB_CONCURRENCY
+from container_processing.records import as_build_record
+from container_processing.records import as_task_record
+from container_processing.records import is_fault
+from container_processing.records import BuildRecord
+from container_processing.records import TaskRecord
+from container_processing.stats import HubCallStats
+import koji
 from koji_wrapper.base import KojiWrapperBase
-from koji_wrapper.tag import KojiTag
 import os
 import os.path
 import pickle
+import sys
+import time
 
-CACHE_PATH = "~/.cache/container-processing"
+# keys kept from listTagged entries in the tag listing cache
+TAGGED_BUILD_FIELDS = ('id', 'build_id', 'nvr', 'name', 'package_name', 'version', 'release',
+                       'tag_name', 'create_event')
+
+# default seconds a cached tag listing is used without asking the hub
+TAG_LISTING_MAX_AGE = 0
+
+# bump when the layout of the pickled caches changes
+CACHE_SCHEMA_VERSION = 5
+
+# number of calls sent to the hub in a single multiCall round trip
+MULTICALL_CHUNK_SIZE = 200
+
+# seconds a lookup that found nothing is answered from the cache
+NEGATIVE_CACHE_TTL = 300
+
+# caches of sorted tuples, merged on save by taking the union of both sides
+UNION_MERGED_CACHES = ('build_id_to_child_ids', 'batch_label_to_build_ids')
+
+# caches whose entries can go stale, every other cache holds data of
+# completed builds (or derived from it) which never changes
+MUTABLE_CACHES = ('tag_listings', 'negative_lookups')
+
+# entries of an immutable cache kept in memory in front of the sqlite store
+MEMORY_TIER_SIZE = 8000
+
+# tagged builds resolved at a time when iterating over a tag
+TAG_PAGE_SIZE = 1000
+
+_NOT_CACHED = object()
+
+
+def pullspec_labels(pullspecs):
+    """Tags (the part after ':') of pullspecs, digest references are skipped"""
+    labels = []
+    for pullspec in pullspecs:
+        if '@' in pullspec or ':' not in pullspec:
+            continue
+        label = pullspec.rsplit(':', 1)[1]
+        # registry:port/name without a tag
+        if '/' not in label:
+            labels.append(label)
+    return labels
+
+
+def _pages(iterable, page_size):
+    """Lists of up to page_size items of iterable"""
+    page = []
+    for item in iterable:
+        page.append(item)
+        if len(page) >= page_size:
+            yield page
+            page = []
+    if page:
+        yield page
 
 
 # TODO(jmls): reflect this is caching for container images
 class CachingKojiWrapper(KojiWrapperBase):
 
-    def __init__(self, **kwargs):
+    def __init__(self, multicall_chunk_size=MULTICALL_CHUNK_SIZE, max_workers=None,
+                 cache_backend='pickle', keep_raw_payloads=False,
+                 tag_listing_max_age=TAG_LISTING_MAX_AGE,
+                 negative_cache_ttl=NEGATIVE_CACHE_TTL, cache_read_only=False,
+                 record_to=None, replay_from=None, replay_latency=0.0,
+                 max_hub_concurrency=MAX_HUB_CONCURRENCY, hub_retries=HUB_RETRIES, **kwargs):
+        if replay_from is not None:
+            # answer every hub call from the cassette, no hub is contacted
+            kwargs['session'] = ReplaySession(Cassette.load(replay_from), latency=replay_latency)
         super().__init__(**kwargs)
 
-        self._build_data = TTLCache(maxsize=6000, ttl=604800)
-        self._task_results = TTLCache(maxsize=8000, ttl=604800)
-        self._build_id_to_parent_id = LRUCache(maxsize=16000)
-        self._build_id_to_build_task_id = LRUCache(maxsize=16000)
-        self._nvr_to_build_id = LRUCache(maxsize=16000)
-        self._build_id_to_nvr = LRUCache(maxsize=16000)
+        # cassette file every hub call and response is recorded to
+        self.record_to = record_to
+        if record_to is not None:
+            self.session = RecordingSession(self.session)
+
+        if cache_backend not in CACHE_BACKENDS:
+            raise ValueError("Unknown cache backend {0}".format(cache_backend))
+        self.cache_backend = cache_backend
+        self._cache_store = None
+        # never write the cache directory, for jobs sharing one that another keeps up to date
+        self.cache_read_only = cache_read_only
+        # sha256 of the file each loaded (or saved) cache was read from
+        self._cache_checksums = {}
+
+        # falsy multicall_chunk_size disables the multicall prefetch
+        self.multicall_chunk_size = multicall_chunk_size
+        # resolve records on a thread pool of this size, None is serial
+        self.max_workers = max_workers
+        # also keep the full koji payloads in the build and task records
+        self.keep_raw_payloads = keep_raw_payloads
+        # seconds a cached tag listing is used before checking the tag history
+        self.tag_listing_max_age = tag_listing_max_age
+        # seconds a missing build is not asked for again
+        self.negative_cache_ttl = negative_cache_ttl
+
+        # completed builds and their task results never change, neither
+        # they nor the maps derived from them are evicted or expire; with
+        # the sqlite backend only MEMORY_TIER_SIZE entries of each stay in
+        # memory in front of the store
+        self._build_data = LockedCache(Cache(maxsize=UNBOUNDED))
+        self._task_results = LockedCache(Cache(maxsize=UNBOUNDED))
+        self._build_id_to_parent_id = LockedCache(Cache(maxsize=UNBOUNDED))
+        self._build_id_to_build_task_id = LockedCache(Cache(maxsize=UNBOUNDED))
+        self._nvr_to_build_id = LockedCache(Cache(maxsize=UNBOUNDED))
+        self._build_id_to_nvr = LockedCache(Cache(maxsize=UNBOUNDED))
+        self._build_id_to_child_ids = LockedCache(Cache(maxsize=UNBOUNDED))
+        self._batch_label_to_build_ids = LockedCache(Cache(maxsize=UNBOUNDED))
+        self._tag_listings = LockedCache(LRUCache(maxsize=64))
+        # (method, key) -> None for lookups that found nothing, wall clock timed
+        # so the entries stay meaningful when loaded by a later run
+        self._negative_lookups = LockedCache(TTLCache(maxsize=4000, ttl=negative_cache_ttl,
+                                                      timer=time.time))
+
+        # hub lookups currently in flight, keyed by (method, key)
+        self._in_flight = SingleFlight()
+
+        self._hub_stats = HubCallStats()
+        # bounds and retries every hub request
+        self._governor = HubGovernor(max_limit=max_hub_concurrency, retries=hub_retries)
+
+        self.build_graph = BuildGraph(self._build_id_to_parent_id, self._build_id_to_child_ids)
+
+    def _caches(self):
+        return [('build_id_to_parent_id', self._build_id_to_parent_id),
+                ('build_id_to_build_task_id', self._build_id_to_build_task_id),
+                ('build_data', self._build_data),
+                ('task_results', self._task_results),
+                ('nvr_to_build_id', self._nvr_to_build_id),
+                ('build_id_to_nvr', self._build_id_to_nvr),
+                ('build_id_to_child_ids', self._build_id_to_child_ids),
+                ('tag_listings', self._tag_listings),
+                ('batch_label_to_build_ids', self._batch_label_to_build_ids),
+                ('negative_lookups', self._negative_lookups)]
+
+    def _open_cache_store(self, cache_path):
+        """Put every cache in front of a sqlite store under cache_path
+
+        Entries already in memory are written through to the store.
+        """
+        if self._cache_store is not None:
+            return
+
+        from container_processing.sqlite_cache import CACHE_DB_FILENAME
+        from container_processing.sqlite_cache import SqliteCache
+        from container_processing.sqlite_cache import SqliteCacheStore
+
+        filename = os.path.join(cache_path, CACHE_DB_FILENAME)
+        if self.cache_read_only:
+            if not os.path.exists(filename):
+                # nothing shared yet, keep to the in-memory caches
+                return
+        elif not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
 
-    def _load_one(self, path, filename, default=None, debug=False):
-        cache_in = default
+        self._cache_store = SqliteCacheStore(filename, read_only=self.cache_read_only)
+        self._cache_store.purge_expired()
+
+        for name, cache in self._caches():
+            if name not in MUTABLE_CACHES:
+                # rows written when every cache had a ttl
+                self._cache_store.clear_expiry(name)
+            with cache.lock:
+                entries = list(cache.cache.items())
+                front = cache.cache
+                if name not in MUTABLE_CACHES:
+                    front = LRUCache(maxsize=MEMORY_TIER_SIZE)
+                disk_cache = SqliteCache(self._cache_store, name, front,
+                                         ttl=getattr(front, 'ttl', None))
+                for key, value in entries:
+                    disk_cache[key] = value
+                cache.cache = disk_cache
+
+    def _load_one(self, path, filename, default=None, expected=None, convert=False,
+                  debug=False):
+        """Unpickle one cache file
+
+        expected is the cache's manifest entry, a checksum mismatch or a file
+        that does not unpickle to the same type as default invalidates only
+        this cache and returns None.  With convert a cache of another type
+        has its entries copied into default instead.
+        """
         filename = os.path.join(path, filename)
-        if os.path.exists(filename):
-            with open(filename, 'rb') as fin:
-                cache_in = pickle.load(fin)
+        if not os.path.exists(filename):
+            return default
+
+        with open(filename, 'rb') as fin:
+            data = fin.read()
+
+        if expected is not None and checksum(data) != expected.get('sha256'):
+            if debug:
+                print("Checksum mismatch, ignoring {0}".format(filename))
+            return None
+
+        try:
+            cache_in = pickle.loads(data)
+        except Exception:
+            if debug:
+                print("Unable to load {0}, ignoring it".format(filename))
+            return None
+
+        if default is not None and type(cache_in) is not type(default):
+            if convert and isinstance(cache_in, Cache):
+                # e.g. a TTLCache of build data from before schema version 5
+                for key, value in list(cache_in.items()):
+                    default[key] = value
+                cache_in = default
+            else:
                 if debug:
-                    print("Loaded {0} entries from {1}".format(cache_in.currsize, filename))
+                    print("Unexpected cache type in {0}, ignoring it".format(filename))
+                return None
+
+        if debug:
+            print("Loaded {0} entries from {1}".format(cache_in.currsize, filename))
         return cache_in
 
-    def _cross_populate_cache(self):
+    def _migrate_legacy_caches(self):
+        """Convert caches written before the manifest to records and index them
 
-        # populate direct lookup caches from build data entries have
+        Runs once for such caches, the next save_cache writes them with a
+        manifest.  The derived maps are otherwise kept up to date as primary
+        data is inserted and never rebuilt on load.
+        """
         for build_id, val in self._build_data.items():
             if val is None:
                 continue
+            build_record = as_build_record(val)
+            self._build_data[build_id] = build_record
+            self._index_build(build_record)
 
-            if val['nvr'] not in self._nvr_to_build_id:
-                self._nvr_to_build_id[val['nvr']] = build_id
-
-            if build_id not in self._build_id_to_nvr:
-                self._build_id_to_nvr[build_id] = val['nvr']
-
-            if 'extra' not in val or val['extra'] is None:
+        for task_id, val in self._task_results.items():
+            task_record = as_task_record(val)
+            if task_record is None:
+                # a cached fault, looked up again once needed
+                del self._task_results[task_id]
                 continue
+            self._task_results[task_id] = task_record
+            self._index_task_result(task_id, task_record)
+
+    def verify_indexes(self):
+        """Check the derived maps against the build and task records
 
-            if 'container_koji_task_id' in val['extra']:
-                self._build_id_to_build_task_id[build_id] = int(val['extra']['container_koji_task_id'])
+        Returns a list of the inconsistencies found, empty when there are
+        none.
+        """
+        problems = []
 
-            if 'image' in val['extra'] and 'parent_build_id' in val['extra']['image']:
-                parent_build_id = int(val['extra']['image']['parent_build_id'])
-                if parent_build_id is not None:
-                    self._build_id_to_parent_id[build_id] = parent_build_id
+        for build_id, val in self._build_data.items():
+            build_record = as_build_record(val)
+            if build_record.id != build_id:
+                problems.append("build {0} cached as {1}".format(build_record.id, build_id))
+            if self._nvr_to_build_id.get(build_record.nvr) != build_id:
+                problems.append("nvr {0} maps to {1} not {2}".format(
+                    build_record.nvr, self._nvr_to_build_id.get(build_record.nvr), build_id))
+            if self._build_id_to_nvr.get(build_id) != build_record.nvr:
+                problems.append("build {0} maps to nvr {1} not {2}".format(
+                    build_id, self._build_id_to_nvr.get(build_id), build_record.nvr))
+            if self._build_id_to_parent_id.get(build_id, _NOT_CACHED) != build_record.parent_build_id:
+                problems.append("build {0} has parent {1} not {2}".format(
+                    build_id, self._build_id_to_parent_id.get(build_id), build_record.parent_build_id))
+            if build_record.task_id is not None and \
+                    self._build_id_to_build_task_id.get(build_id) != build_record.task_id:
+                problems.append("build {0} maps to task {1} not {2}".format(
+                    build_id, self._build_id_to_build_task_id.get(build_id), build_record.task_id))
+
+        for nvr, build_id in self._nvr_to_build_id.items():
+            if self._build_id_to_nvr.get(build_id, nvr) != nvr:
+                problems.append("nvr {0} maps to build {1} which maps to nvr {2}".format(
+                    nvr, build_id, self._build_id_to_nvr.get(build_id)))
+
+        for build_id, parent_build_id in self._build_id_to_parent_id.items():
+            if parent_build_id is not None and \
+                    build_id not in self._build_id_to_child_ids.get(parent_build_id, ()):
+                problems.append("build {0} missing from the children of {1}".format(
+                    build_id, parent_build_id))
+        for parent_build_id, child_ids in self._build_id_to_child_ids.items():
+            for build_id in child_ids:
+                if self._build_id_to_parent_id.get(build_id) != parent_build_id:
+                    problems.append("build {0} listed as a child of {1}".format(
+                        build_id, parent_build_id))
 
-        # populate _build_id_to_build_task_id from task results
         for task_id, val in self._task_results.items():
-            # if not valid task results for a container image skip it
-            if 'repositories' not in val:
+            task_record = as_task_record(val)
+            if task_record is None:
+                problems.append("task {0} has a cached fault".format(task_id))
                 continue
+            for build_id in task_record.koji_builds or ():
+                if build_id not in self._build_id_to_build_task_id:
+                    problems.append("build {0} of task {1} has no task".format(build_id, task_id))
+            if not task_record.koji_builds or not task_record.repositories:
+                continue
+            for label in pullspec_labels(task_record.repositories):
+                label_build_ids = self._batch_label_to_build_ids.get(label, ())
+                for build_id in task_record.koji_builds:
+                    if build_id not in label_build_ids:
+                        problems.append("build {0} missing from label {1}".format(build_id, label))
 
-            if 'koji_builds' in val:
-                for build_id in [int(build_id) for build_id in val['koji_builds']]:
-                    if build_id not in self._build_id_to_build_task_id:
-                        self._build_id_to_build_task_id[int(build_id)] = task_id
-
-        # populate _build_id_to_nvr from _nvr_to_build_id
-        for nvr in set(self._build_id_to_nvr.values()) - set(self._nvr_to_build_id):
-            build_id = self._nvr_to_build_id[nvr]
-            if build_id is not None:
-                self._build_id_to_nvr[build_id] = nvr
+        return problems
 
-        # populate _nvr_to_build_id from _build_to_nvr
-        for build_id in set(self._nvr_to_build_id.values()) - set(self._build_id_to_nvr):
-            nvr = self._build_id_to_nvr[build_id]
-            if nvr is not None:
-                self._nvr_to_build_id[nvr] = build_id
+    def load_cache(self, path=CACHE_PATH, debug=False, lazy=True):
+        """Load persisted caches from path
 
-    def load_cache(self, path=CACHE_PATH, debug=False):
+        With lazy (the default) each cache file is only read the first time
+        that cache is used.  Caches written before the manifest existed are
+        loaded eagerly and migrated once.
+        """
         cache_path = os.path.expanduser(path)
 
-        self._build_id_to_parent_id = self._load_one(
-            cache_path, 'build_id_to_parent_id', self._build_id_to_parent_id, debug=debug)
-        self._nvr_to_build_id = self._load_one(
-            cache_path, 'build_id_or_nvr_to_build_id', self._nvr_to_build_id,
-            debug=debug)
-        self._build_id_to_build_task_id = self._load_one(
-            cache_path, 'build_id_to_build_task_id', self._build_id_to_build_task_id, debug=debug)
-
-        self._build_data = self._load_one(cache_path, 'build_data', self._build_data, debug=debug)
-        self._task_results = self._load_one(cache_path, 'task_results', self._task_results, debug=debug)
-        self._build_id_to_nvr = self._load_one(
-            cache_path, 'build_id_to_nvr', self._build_id_to_nvr, debug=debug)
-
-        self._cross_populate_cache()
+        if self.cache_backend == 'sqlite':
+            # entries are read from disk on first use, nothing to load up front
+            self._open_cache_store(cache_path)
+            if debug and self._cache_store is not None:
+                print("Using cache store {0}".format(self._cache_store.filename))
+            return
+
+        with cache_dir_lock(cache_path, exclusive=False):
+            manifest = load_manifest(cache_path, CACHE_SCHEMA_VERSION)
+
+        for name, cache in self._caches():
+            expected = None
+            if manifest is not None:
+                expected = manifest['caches'].get(name)
+                if expected is None:
+                    # not described by the manifest, don't trust the file
+                    if os.path.exists(os.path.join(cache_path, name)):
+                        cache.dirty = True
+                    continue
+
+            loader = self._cache_loader(cache_path, name, cache, expected,
+                                        legacy=manifest is None, debug=debug)
+            if lazy and manifest is not None:
+                cache.lazy_load(loader)
+            else:
+                cache.cache = loader()
+
+        if manifest is None:
+            self._migrate_legacy_caches()
+
+    def _cache_loader(self, cache_path, name, cache, expected, legacy=False, debug=False):
+        default = cache.cache
+
+        def loader():
+            with cache_dir_lock(cache_path, exclusive=False):
+                current = expected
+                if not legacy:
+                    # another process may have saved since load_cache
+                    manifest = load_manifest(cache_path, CACHE_SCHEMA_VERSION)
+                    if manifest is not None and name in manifest['caches']:
+                        current = manifest['caches'][name]
+                loaded = self._load_one(cache_path, name, default, expected=current,
+                                        convert=legacy, debug=debug)
+            if loaded is None:
+                # invalid on disk, rewrite it on the next save
+                cache.dirty = True
+                return default
+            if current is not None:
+                self._cache_checksums[name] = current['sha256']
+            # caches from before the manifest existed get one rewrite
+            cache.dirty = legacy
+            return loaded
+
+        return loader
+
+    def _merge_cache(self, name, cache, on_disk):
+        """Add the entries of on_disk that cache does not have
+
+        on_disk was saved by another process since this one loaded cache,
+        entries set here win except for the UNION_MERGED_CACHES.
+        """
+        with cache.lock:
+            current_cache = cache.cache
+            for key, value in list(on_disk.items()):
+                current = current_cache.get(key, _NOT_CACHED)
+                if current is _NOT_CACHED:
+                    cache[key] = value
+                elif name in UNION_MERGED_CACHES and current != value:
+                    cache[key] = tuple(sorted(set(current) | set(value)))
 
     def save_cache(self, path=CACHE_PATH, debug=False):
+        """Persist the changed caches to path
+
+        Processes sharing path are serialized by a lock on the directory, a
+        cache another process saved since this one loaded it is merged in
+        first so neither loses the other's entries.
+        """
         cache_path = os.path.expanduser(path)
 
+        if self.cache_backend == 'sqlite':
+            # entries were written as they were set
+            self._open_cache_store(cache_path)
+            return
+
+        if self.cache_read_only:
+            return
+
         if not os.path.isdir(cache_path):
             os.makedirs(cache_path)
 
-        for filename, cache in [('build_id_to_parent_id', self._build_id_to_parent_id),
-                                ('build_id_to_build_task_id', self._build_id_to_build_task_id),
-                                ('build_data', self._build_data),
-                                ('task_results', self._task_results),
-                                ('nvr_to_build_id', self._nvr_to_build_id),
-                                ('build_id_to_nvr', self._build_id_to_nvr)]:
-
-            with open(os.path.join(cache_path, filename), 'wb') as fout:
-                pickle.dump(cache, fout)
-                if debug:
-                    print("saving {0} now with {1}".format(filename, cache.currsize))
+        with cache_dir_lock(cache_path, exclusive=True):
+            manifest = load_manifest(cache_path, CACHE_SCHEMA_VERSION)
+            if manifest is None:
+                manifest = {'schema_version': CACHE_SCHEMA_VERSION, 'caches': {}}
+
+            for filename, cache in self._caches():
+                # never loaded means never changed, a cache still loading
+                # waits for the directory lock held here so its lock is not
+                # waited for
+                if not cache.loaded:
+                    if debug:
+                        print("skipping unchanged {0}".format(filename))
+                    continue
+
+                with cache.lock:
+                    on_disk = manifest['caches'].get(filename)
+                    exists = os.path.exists(os.path.join(cache_path, filename))
+                    if not cache.dirty and on_disk is not None and exists:
+                        if debug:
+                            print("skipping unchanged {0}".format(filename))
+                        continue
+
+                    if on_disk is not None and exists and \
+                            on_disk['sha256'] != self._cache_checksums.get(filename):
+                        saved = self._load_one(cache_path, filename, cache.cache,
+                                               expected=on_disk, debug=debug)
+                        if saved is not None:
+                            self._merge_cache(filename, cache, saved)
+
+                    data = pickle.dumps(cache.cache)
+                    atomic_write(os.path.join(cache_path, filename), data)
+                    manifest['caches'][filename] = {'entries': len(cache.cache),
+                                                    'sha256': checksum(data)}
+                    self._cache_checksums[filename] = manifest['caches'][filename]['sha256']
+                    cache.dirty = False
+                    if debug:
+                        print("saving {0} now with {1}".format(filename, cache.currsize))
+
+            save_manifest(cache_path, manifest)
 
     # Search for batch for a tag (will not pick up isolated builds)
     def get_matching_batch_from_tag(self, osp, rhel, batch, latest=False, sub_tag='candidate'):
         """Get matching container images from koji_tag"""
         tag = "rhos-{0}-rhel-{1}-{2}".format(float(osp), rhel, sub_tag)
-        koji_tag = KojiTag(session=self, tag=tag)
-
-        koji_tag.builds(latest=latest, type='image', inherit=False)
-
-        return self.get_matching_batch_from_koji_tag(koji_tag, batch)
+        return self._by_component(self.iter_matching_batch(tag, batch, latest=latest))
 
     def get_build_trees(self, matching_containers):
 
@@ -139,63 +491,293 @@ class CachingKojiWrapper(KojiWrapperBase):
         return trees
 
     def get_matching_batch_from_koji_tag(self, koji_tag, batch):
-        matching_containers = {}
-        for build in koji_tag.builds():
-            if '-container' not in build['package_name']:
-                continue
-
-            record = self.getRecordForBuild(build['id'], grab_build_task_info=True)
-            component = record['package_name']
-
-            if 'task_pullspecs' in record and [i for i in record['task_pullspecs'] if batch in i]:
-                if component not in matching_containers:
-                    matching_containers[component] = {}
-                matching_containers[component][record['build_id']] = record
-            else:
+        return self._by_component(self._iter_batch_records(koji_tag.builds(), batch))
+
+    def iter_matching_batch(self, tag, batch, latest=False, offset=0, limit=None,
+                            page_size=TAG_PAGE_SIZE):
+        """Yield the records of the builds of tag built in batch, one page at a time
+
+        Each record is followed by the record of its openstack parent image.
+        offset and limit select the tagged builds looked at, see iter_tagged.
+        """
+        for page in self.iter_tagged(tag, latest=latest, offset=offset, limit=limit,
+                                     page_size=page_size):
+            for record in self._iter_batch_records(page, batch, page_size=page_size):
+                yield record
+
+    def _iter_batch_records(self, builds, batch, page_size=TAG_PAGE_SIZE):
+        for page in _pages(builds, page_size):
+            build_ids = [build['id'] for build in page if '-container' in build['package_name']]
+            self._index_batch_task_results(build_ids)
+
+            build_ids = self._builds_with_batch(build_ids, batch)
+            for record in self._iter_batch_matches(
+                    self.get_records(build_ids, grab_build_task_info=True), batch):
+                yield record
+
+    def _index_batch_task_results(self, build_ids):
+        """Fetch the task results of build_ids the batch label index lacks"""
+        # only builds whose task result has never been seen need fetching,
+        # the rest are answered by the batch label index
+        unindexed = [i for i in build_ids if not self._task_result_indexed(i)]
+        if self.multicall_chunk_size:
+            # a task the multicall could not fetch would fault again
+            self.prefetch_records(unindexed, grab_build_task_info=True)
+        else:
+            self.get_records(unindexed, grab_build_task_info=True)
+
+    def _iter_batch_matches(self, records, batch):
+        """The records built in batch, each followed by its openstack parent image"""
+        for record in records:
+            if not ('task_pullspecs' in record and
+                    [i for i in record['task_pullspecs'] if batch in i]):
                 continue
+            yield record
 
-            if 'parent_build_id' in record:
+            if record.get('parent_build_id') is not None:
                 parent_record = self.getRecordForBuild(record['parent_build_id'])
-                parent_component = parent_record['package_name']
-                if 'openstack' in parent_component:
+                if 'openstack' in parent_record['package_name']:
                     print("Adding {0} as parent of {1}".format(parent_record['nvr'], record['nvr']))
-                    if parent_component not in matching_containers:
-                        matching_containers[parent_component] = {}
-                    matching_containers[parent_component][parent_record['build_id']] = parent_record
+                    yield parent_record
+
+    @staticmethod
+    def _by_component(records):
+        """{component: {build_id: record}} of records"""
+        matching_containers = {}
+        for record in records:
+            component = record['package_name']
+            if component not in matching_containers:
+                matching_containers[component] = {}
+            matching_containers[component][record['build_id']] = record
         return matching_containers
 
+    def get_containers_for_targets(self, targets, latest=False, batch=None, extra_info=False):
+        """Container builds of several (osp, rhel, sub_tag) tags resolved together
+
+        Every tag is listed at one koji event and each build id tagged into
+        any of them is resolved once, however many of the tags carry it.
+        With batch only the builds of that batch (and their openstack
+        parents) are kept, like get_matching_batch_from_tag, else every
+        build is, like get_latest_cdn_containers.  Returns {(osp, rhel,
+        sub_tag): {component: {build_id: record}}}.
+        """
+        targets = list(dict.fromkeys((float(osp), str(rhel), sub_tag)
+                                     for osp, rhel, sub_tag in targets))
+        tags = dict((target, "rhos-{0}-rhel-{1}-{2}".format(*target)) for target in targets)
+        listings = self._refresh_tag_listings([tags[target] for target in targets])
+
+        tagged = {}
+        for target in targets:
+            tagged[target] = self._select_tagged(listings[tags[target]], latest)
+            for build in tagged[target]:
+                self._index_nvr(build['id'], build['nvr'])
+
+        builds = dict((build['id'], build) for target in targets for build in tagged[target])
+        build_ids = list(builds)
+        if batch:
+            build_ids = [i for i in build_ids if '-container' in builds[i]['package_name']]
+            self._index_batch_task_results(build_ids)
+            build_ids = self._builds_with_batch(build_ids, batch)
+
+        grab_build_task_info = bool(batch) or extra_info
+        self.prefetch_records(build_ids, grab_build_task_info=grab_build_task_info)
+        records = dict(zip(build_ids, self.get_records(
+            build_ids, grab_build_task_info=grab_build_task_info)))
+
+        results = {}
+        for target in targets:
+            target_records = [records[build['id']] for build in tagged[target]
+                              if build['id'] in records]
+            if batch:
+                target_records = self._iter_batch_matches(target_records, batch)
+            results[target] = self._by_component(target_records)
+        return results
+
     def get_latest_cdn_containers(self, osp, rhel, latest=True, extra_info=False):
         tag = "rhos-{0}-rhel-{1}-container-released".format(float(osp), rhel)
-        koji_tag = KojiTag(session=self, tag=tag)
+        return self._by_component(self.iter_container_records(tag, latest=latest,
+                                                              get_extra_info=extra_info))
 
-        koji_tag.builds(latest=latest, type='image', inherit=False)
+    def get_koji_tag(self, tag, latest=False, inherit=False):
+        """KojiTag for tag with its image builds listed through list_tagged"""
+        from koji_wrapper.tag import KojiTag
+        koji_tag = KojiTag(session=self, tag=tag)
+        koji_tag.tagged_list = self.list_tagged(tag, latest=latest, inherit=inherit)
+        return koji_tag
+
+    def list_tagged(self, tag, latest=False, inherit=False):
+        """listTagged(type='image') for tag, cached with the koji event it was taken at
+
+        A cached listing younger than tag_listing_max_age seconds is used as
+        is, an older one is brought up to date by applying the tag history
+        since its event.  Inherited listings are not cached.
+        """
+        if inherit:
+            return self._hub_call('listTagged', tag, latest=latest, type='image', inherit=True)
+
+        return [dict(i) for i in self._select_tagged(self._refresh_tag_listings([tag])[tag],
+                                                     latest)]
+
+    def iter_tagged(self, tag, latest=False, inherit=False, offset=0, limit=None,
+                    page_size=TAG_PAGE_SIZE):
+        """Yield the builds of list_tagged(tag) in pages (lists) of page_size
+
+        Only the builds from offset on are yielded, at most limit of them.
+        listTagged can not page so the listing is still fetched whole, but
+        kept once in the cache in its compact form and copied a page at a
+        time.
+        """
+        if inherit:
+            tagged = [self._project_tagged(i)
+                      for i in self.list_tagged(tag, latest=latest, inherit=True)]
+        else:
+            tagged = self._select_tagged(self._refresh_tag_listings([tag])[tag], latest)
+
+        stop = None if limit is None else offset + limit
+        for page in _pages(tagged[offset:stop], page_size):
+            yield [dict(i) for i in page]
+
+    def iter_container_records(self, tag, latest=False, inherit=False, get_extra_info=False,
+                               offset=0, limit=None, page_size=TAG_PAGE_SIZE):
+        """Yield getRecordForBuild of the builds of tag as each page resolves
+
+        offset and limit select the tagged builds, see iter_tagged.
+        """
+        for page in self.iter_tagged(tag, latest=latest, inherit=inherit, offset=offset,
+                                     limit=limit, page_size=page_size):
+            for record in self._iter_records(page, get_extra_info=get_extra_info,
+                                             page_size=page_size):
+                yield record
+
+    def _iter_records(self, builds, get_extra_info=False, page_size=TAG_PAGE_SIZE):
+        for page in _pages(builds, page_size):
+            for build in page:
+                self._index_nvr(build['id'], build['nvr'])
+            build_ids = [build['id'] for build in page]
+            self.prefetch_records(build_ids, grab_build_task_info=get_extra_info)
+            for record in self.get_records(build_ids, grab_build_task_info=get_extra_info):
+                yield record
+
+    def _refresh_tag_listings(self, tags):
+        """Cached listing of each tag, brought up to date at one koji event
+
+        Tags never listed before are fetched together in one multicall.
+        Returns {tag: listing}.
+        """
+        listings = {}
+        stale = []
+        now = time.time()
+        for tag in dict.fromkeys(tags):
+            listing = self._tag_listings.get(tag)
+            if listing is None or now - listing['timestamp'] >= self.tag_listing_max_age:
+                stale.append(tag)
+            else:
+                listings[tag] = listing
+        if not stale:
+            return listings
+
+        event_id = self._hub_call('getLastEvent')['id']
+        missing = [tag for tag in stale if self._tag_listings.get(tag) is None]
+        if len(missing) > 1 and self.multicall_chunk_size:
+            fetched = dict(self._multicall('listTagged', missing, event=event_id, type='image'))
+        else:
+            fetched = dict((tag, self._hub_call('listTagged', tag, event=event_id, type='image'))
+                           for tag in missing)
+
+        for tag in stale:
+            listing = self._tag_listings.get(tag)
+            if listing is None:
+                if tag not in fetched:
+                    raise koji.GenericError("listTagged failed for {0}".format(tag))
+                tagged = [self._project_tagged(i) for i in fetched[tag]]
+            elif listing['event_id'] != event_id:
+                tagged = self._apply_tag_history(tag, listing, event_id)
+            else:
+                tagged = listing['builds']
+            listing = {'event_id': event_id, 'timestamp': now, 'builds': tagged}
+            self._tag_listings[tag] = listing
+            listings[tag] = listing
+        return listings
+
+    @staticmethod
+    def _select_tagged(listing, latest=False):
+        """Builds of a listing, only the newest per package with latest"""
+        tagged = listing['builds']
+        if latest:
+            # koji's latest is the most recently tagged build of each package
+            seen = set()
+            latest_tagged = []
+            for i in sorted(tagged, key=lambda i: i['create_event'], reverse=True):
+                if i['package_name'] not in seen:
+                    seen.add(i['package_name'])
+                    latest_tagged.append(i)
+            tagged = latest_tagged
+
+        return tagged
+
+    @staticmethod
+    def _project_tagged(tagged):
+        return dict((key, tagged.get(key)) for key in TAGGED_BUILD_FIELDS)
+
+    def _apply_tag_history(self, tag, listing, event_id):
+        """listing['builds'] moved forward from listing['event_id'] to event_id"""
+        history = self._hub_call('queryHistory', tables=['tag_listing'], tag=tag,
+                                 afterEvent=listing['event_id'],
+                                 beforeEvent=event_id + 1)['tag_listing']
+
+        untagged = set()
+        tagged = {}
+        for entry in sorted(history, key=lambda i: i['create_event']):
+            if entry['revoke_event'] is not None:
+                untagged.add((entry['build_id'], entry['create_event']))
+            elif entry['create_event'] > listing['event_id']:
+                tagged[entry['build_id']] = entry['create_event']
+
+        builds = [i for i in listing['builds']
+                  if (i['build_id'], i['create_event']) not in untagged and i['build_id'] not in tagged]
+
+        fetched = self._multicall('getBuild', sorted(tagged))
+        failed = sorted(set(tagged) - set(build_id for build_id, _ in fetched))
+        if failed:
+            # the listing stays at its old event, the delta is tried again
+            raise koji.GenericError("getBuild failed for builds {0} tagged in {1}".format(
+                failed, tag))
+
+        for build_id, builddata in fetched:
+            # listTagged(type='image') only lists image builds
+            if builddata is None or 'image' not in (builddata.get('extra') or {}):
+                continue
+            self._store_build(builddata)
+            builds.append({'id': builddata['id'], 'build_id': builddata['id'],
+                           'nvr': builddata['nvr'], 'name': builddata['package_name'],
+                           'package_name': builddata['package_name'],
+                           'version': builddata.get('version'), 'release': builddata.get('release'),
+                           'tag_name': tag, 'create_event': tagged[build_id]})
 
-        return self.get_container_builds_from_koji_tag(koji_tag, get_extra_info=extra_info)
+        return sorted(builds, key=lambda i: i['create_event'], reverse=True)
 
     def get_list_containers(self, osp, rhel, sub_tag='candidate', latest=False, inherit=False):
         """Load Cache with builds from a tag"""
         tag = "rhos-{0}-rhel-{1}-{2}".format(float(osp), rhel, sub_tag)
-        koji_tag = KojiTag(session=self, tag=tag)
-
-        koji_tag.builds(latest=latest, type='image', inherit=inherit)
         containers = set()
-        for i in koji_tag.builds():
-            if 'container' in i['package_name']:
-                if i['nvr'] not in self._nvr_to_build_id:
-                    self._nvr_to_build_id[i['nvr']] = i['build_id']
-                self._build_id_to_nvr[i['build_id']] = i['nvr']
-                containers.add(i['nvr'])
+        for page in self.iter_tagged(tag, latest=latest, inherit=inherit):
+            for i in page:
+                if 'container' in i['package_name']:
+                    self._index_nvr(i['build_id'], i['nvr'])
+                    containers.add(i['nvr'])
         return containers
 
     def getParentBuildId(self, build_id_or_nvr):
         build_id = self.getBuildId(build_id_or_nvr)
-        if build_id not in self._build_id_to_parent_id:
-            build_data = self.build(build_id)
+        if build_id is None:
+            return None
 
-            if build_id not in self._build_id_to_parent_id and 'extra' in build_data and build_data['extra'] is not None and 'image' in build_data['extra'] and 'parent_build_id' in build_data['extra']['image']:
-                self._build_id_to_parent_id[build_id] = int(build_data['extra']['image']['parent_build_id'])
-            else:
-                self._build_id_to_parent_id[build_id] = None
+        if build_id not in self._build_id_to_parent_id:
+            # getBuildId has just cached the build when it had to fetch it
+            build_record = self._build_record(build_id)
+            if build_record is None:
+                return None
+            self.build_graph.add(build_id, build_record.parent_build_id)
 
         if build_id in self._build_id_to_parent_id:
             return self._build_id_to_parent_id[build_id]
@@ -203,9 +785,9 @@ class CachingKojiWrapper(KojiWrapperBase):
         return None
 
     def get_package_name(self, build_id_or_nvr):
-        build_data = self.build(build_id_or_nvr)
-        if build_data:
-            return build_data['package_name']
+        build_record = self._build_record(build_id_or_nvr)
+        if build_record:
+            return build_record.package_name
 
         return None
 
@@ -224,8 +806,9 @@ class CachingKojiWrapper(KojiWrapperBase):
             build_id = self._nvr_to_build_id[build_id_or_nvr]
 
         if build_id is None:
-            build_data = self.build(build_id_or_nvr)
-            build_id = build_data['id']
+            build_record = self._build_record(build_id_or_nvr)
+            if build_record is not None:
+                build_id = build_record.id
 
         return build_id
 
@@ -233,13 +816,25 @@ class CachingKojiWrapper(KojiWrapperBase):
         build_id = self.getBuildId(build_id_or_nvr)
 
         if build_id is None or build_id not in self._build_id_to_nvr:
-            build_data = self.build(build_id_or_nvr)
-            return build_data['nvr']
+            build_record = self._build_record(build_id_or_nvr)
+            if build_record is None:
+                return None
+            return build_record.nvr
 
         return self._build_id_to_nvr[build_id]
 
     def build(self, build_id_or_nvr):
+        """koji getBuild, served from the build cache
 
+        Unless keep_raw_payloads is set only the fields kept in BuildRecord
+        are present in the returned dict.  None when there is no such build.
+        """
+        build_record = self._build_record(build_id_or_nvr)
+        if build_record is None:
+            return None
+        return build_record.to_build()
+
+    def _build_record(self, build_id_or_nvr):
         build_id = None
 
         try:
@@ -254,113 +849,418 @@ class CachingKojiWrapper(KojiWrapperBase):
             build_id = self._nvr_to_build_id[build_id_or_nvr]
 
         if (build_id is None or build_id not in self._build_data):
-            builddata = super().build(build_id_or_nvr)
-
-            build_id = builddata['id']
+            build_id = self._in_flight.do(('getBuild', build_id_or_nvr),
+                                          self._fetch_build, build_id_or_nvr)
+            if build_id is None:
+                return None
+
+        return as_build_record(self._build_data[build_id])
+
+    def _fetch_build(self, build_id_or_nvr):
+        """getBuild from the hub unless cached meanwhile or known missing
+
+        Returns the build id, None when there is no such build.  Faults are
+        raised and not cached, the next lookup asks the hub again.
+        """
+        build_id = self._cached_build_id(build_id_or_nvr)
+        if build_id is not None:
+            return build_id
+
+        key = ('getBuild', build_id_or_nvr)
+        if self._negative_lookups.get(key, _NOT_CACHED) is None:
+            return None
+
+        builddata = self._hub_call('getBuild', build_id_or_nvr)
+        if builddata is None:
+            self._negative_lookups[key] = None
+            return None
+
+        return self._store_build(builddata)
+
+    def _store_build(self, builddata):
+        build_record = BuildRecord.from_build(builddata, keep_raw=self.keep_raw_payloads)
+        self._build_data[build_record.id] = build_record
+        self._index_build(build_record)
+        return build_record.id
+
+    def _index_build(self, build_record):
+        """Derived maps for a build record just put in the build cache"""
+        self._index_nvr(build_record.id, build_record.nvr)
+        self.build_graph.add(build_record.id, build_record.parent_build_id)
+        if build_record.task_id is not None:
+            self._build_id_to_build_task_id[build_record.id] = build_record.task_id
+
+    def _index_nvr(self, build_id, nvr):
+        self._nvr_to_build_id[nvr] = build_id
+        self._build_id_to_nvr[build_id] = nvr
 
-            self._build_data[build_id] = builddata
-            self._nvr_to_build_id[builddata['nvr']] = builddata['id']
-            if 'parent_build_id' in builddata['extra']['image']:
-                self._build_id_to_parent_id[build_id] = builddata['extra']['image']['parent_build_id']
-            else:
-                self._build_id_to_parent_id[build_id] = None
-            self._build_id_to_build_task_id[build_id] = builddata['extra']['container_koji_task_id']
+    def getTaskResult(self, task_id):
+        """koji getTaskResult, served from the task cache
 
-        return self._build_data[build_id]
+        Unless keep_raw_payloads is set only the fields kept in TaskRecord
+        are present in the returned dict.
+        """
+        return self._task_record(task_id).to_result()
 
-    def getTaskResult(self, task_id):
+    def _task_record(self, task_id):
         task_id = int(task_id)
+        if is_fault(self._task_results.get(task_id)):
+            # kept by a cache from before faults stopped being cached
+            try:
+                del self._task_results[task_id]
+            except KeyError:
+                pass
         if task_id not in self._task_results:
-            result = self.session.getTaskResult(task_id, raise_fault=False)
-            self._task_results[task_id] = result
-
-        return self._task_results[task_id]
+            self._in_flight.do(('getTaskResult', task_id), self._fetch_task_result, task_id)
+
+        task_record = self._task_results.get(task_id)
+        if task_record is None or is_fault(task_record):
+            # the task faulted, failed tasks have no result
+            return TaskRecord()
+        return as_task_record(task_record)
+
+    def _fetch_task_result(self, task_id):
+        """getTaskResult from the hub unless cached meanwhile"""
+        if task_id in self._task_results:
+            return
+
+        result = self._hub_call('getTaskResult', task_id, raise_fault=False)
+        self._store_task_result(task_id, result)
+
+    def _store_task_result(self, task_id, result):
+        if is_fault(result):
+            # failed (or unfinished) task, never cached so a later lookup
+            # sees the task once it is done
+            return
+
+        task_record = TaskRecord.from_result(result, keep_raw=self.keep_raw_payloads)
+        self._task_results[task_id] = task_record
+        self._index_task_result(task_id, task_record)
+
+    def _index_task_result(self, task_id, task_record):
+        """Derived maps for a task record just put in the task cache"""
+        for build_id in task_record.koji_builds or ():
+            if build_id not in self._build_id_to_build_task_id:
+                self._build_id_to_build_task_id[build_id] = task_id
+        self._index_batch_labels(task_record)
+
+    def _index_batch_labels(self, task_record):
+        """Add the builds of a task to the label index of its repositories"""
+        if not task_record.koji_builds or not task_record.repositories:
+            return
+
+        with self._batch_label_to_build_ids.lock:
+            for label in pullspec_labels(task_record.repositories):
+                build_ids = self._batch_label_to_build_ids.get(label, ())
+                missing = tuple(i for i in task_record.koji_builds if i not in build_ids)
+                if missing:
+                    self._batch_label_to_build_ids[label] = tuple(sorted(build_ids + missing))
+
+    def _task_result_indexed(self, build_id):
+        task_id = self._build_id_to_build_task_id.get(build_id)
+        if task_id is None:
+            return False
+        task_record = self._task_results.get(int(task_id))
+        return task_record is not None and not is_fault(task_record)
+
+    def get_batch_labels(self, koji_tag):
+        """Map of every pullspec label (batch, version-release, floating tag)
+        used by builds in koji_tag to the build ids carrying it
+
+        Only task results already in the caches are considered, use
+        get_matching_batch_from_koji_tag or prefetch_records first to make
+        sure the whole tag is covered.
+        """
+        build_ids = set(build['id'] for build in koji_tag.builds())
+        labels = {}
+        for label, label_build_ids in self._batch_label_to_build_ids.items():
+            in_tag = [i for i in label_build_ids if i in build_ids]
+            if in_tag:
+                labels[label] = in_tag
+        return labels
+
+    def _builds_with_batch(self, build_ids, batch):
+        """The build_ids whose task pullspecs carry a label containing batch
+
+        Only the task records of build_ids are looked at, so the answer does
+        not depend on which other tags were scanned before.
+        """
+        matched = []
+        for build_id in build_ids:
+            task_id = self._build_id_to_build_task_id.get(build_id)
+            if task_id is None:
+                continue
+            task_record = self._task_results.get(int(task_id))
+            if task_record is None or is_fault(task_record):
+                continue
+            task_record = as_task_record(task_record)
+            if [i for i in pullspec_labels(task_record.repositories or ()) if batch in i]:
+                matched.append(build_id)
+        return matched
+
+    def _hub_call(self, method, *args, **kwargs):
+        """Call method on the hub through the governor, accounting for it in stats()"""
+        def call():
+            start = time.monotonic()
+            error = True
+            try:
+                result = getattr(self.session, method)(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                self._hub_stats.record(method, time.monotonic() - start, error=error)
+
+        return self._governor.call(method, call)
+
+    def save_cassette(self, filename=None):
+        """Write the hub calls recorded so far to filename (default record_to)"""
+        filename = filename or self.record_to
+        if filename is None or not isinstance(self.session, RecordingSession):
+            raise ValueError("No hub calls are being recorded")
+        self.session.cassette.save(filename)
+
+    def stats(self):
+        """Counters for every cache and every kind of hub call made
+
+        {'caches': {name: {hits, misses, evictions, expirations, size,
+        maxsize}}, 'hub': {method: {calls, round_trips, errors, seconds,
+        buckets}}, 'governor': {limit, max_limit, in_flight, retries,
+        decreases, latency}}, multicalls are accounted as 'multicall:<method>'.
+        """
+        return {'caches': dict((name, cache.stats()) for name, cache in self._caches()),
+                'hub': self._hub_stats.as_dict(), 'governor': self._governor.stats()}
+
+    def _multicall(self, method, keys, **kwargs):
+        """Call method once per key through koji multicall
+
+        Calls are sent in chunks of multicall_chunk_size, returns a list of
+        (key, result) for every call that did not fault.
+        """
+        results = []
+        if not keys:
+            return results
+
+        def send(chunk):
+            start = time.monotonic()
+            error = True
+            try:
+                with self.session.multicall(strict=False) as m:
+                    chunk_calls = [(key, getattr(m, method)(key, **kwargs)) for key in chunk]
+                error = False
+                return chunk_calls
+            finally:
+                self._hub_stats.record('multicall:' + method, time.monotonic() - start,
+                                       error=error, calls=len(chunk))
+
+        calls = []
+        chunk_size = self.multicall_chunk_size or len(keys)
+        for index in range(0, len(keys), chunk_size):
+            calls.extend(self._governor.call('multicall:' + method, send,
+                                             keys[index:index + chunk_size]))
+
+        for key, call in calls:
+            try:
+                results.append((key, call.result))
+            except koji.GenericError:
+                continue
+        return results
+
+    def prefetch_records(self, build_ids, grab_build_task_info=False):
+        """Fill build (and task) caches for build_ids in bulk
+
+        Only entries missing from the caches are requested from the hub, so
+        the per-build getRecordForBuild calls that follow are cache hits.
+        """
+        if not self.multicall_chunk_size:
+            return
+
+        keys = []
+        for build_id_or_nvr in build_ids:
+            try:
+                keys.append(int(build_id_or_nvr))
+            except ValueError:
+                keys.append(build_id_or_nvr)
+
+        def missing_builds(keys):
+            return [key for key in keys if self._cached_build_id(key) is None and
+                    self._negative_lookups.get(('getBuild', key), _NOT_CACHED) is not None]
+
+        def fetch_builds(keys):
+            # another thread may have stored some while these were claimed
+            for build_id_or_nvr, builddata in self._multicall('getBuild', missing_builds(keys)):
+                if builddata is None:
+                    self._negative_lookups[('getBuild', build_id_or_nvr)] = None
+                else:
+                    self._store_build(builddata)
+
+        # builds another thread is prefetching are waited for, not fetched twice
+        self._in_flight.do_many('multicall:getBuild', missing_builds(dict.fromkeys(keys)),
+                                fetch_builds)
+
+        if not grab_build_task_info:
+            return
+
+        task_ids = []
+        for key in keys:
+            build_id = self._cached_build_id(key)
+            if build_id is None or build_id not in self._build_id_to_build_task_id:
+                continue
+            task_id = self._build_id_to_build_task_id[build_id]
+            if task_id is None:
+                continue
+            task_id = int(task_id)
+            if task_id not in self._task_results:
+                task_ids.append(task_id)
+
+        def fetch_task_results(task_ids):
+            task_ids = [i for i in task_ids if i not in self._task_results]
+            for task_id, result in self._multicall('getTaskResult', task_ids, raise_fault=False):
+                self._store_task_result(task_id, result)
+
+        self._in_flight.do_many('multicall:getTaskResult', list(dict.fromkeys(task_ids)),
+                                fetch_task_results)
+
+    def _cached_build_id(self, build_id_or_nvr):
+        """Build id for a build id or nvr whose build data is cached, else None"""
+        build_id = build_id_or_nvr
+        if not isinstance(build_id_or_nvr, int):
+            build_id = self._nvr_to_build_id.get(build_id_or_nvr)
+        if build_id is not None and build_id in self._build_data:
+            return build_id
+        return None
 
     def getBuildTaskId(self, build_id):
         build_id = int(build_id)
         if build_id not in self._build_id_to_build_task_id:
-            self.build(build_id)
+            build_record = self._build_record(build_id)
+            if build_record is None:
+                return None
+            if build_id not in self._build_id_to_build_task_id:
+                # build data cached but the index entry was lost
+                self._build_id_to_build_task_id[build_id] = build_record.task_id
 
         return self._build_id_to_build_task_id[build_id]
 
     def getRecordForBuild(self, build_id_or_nvr, grab_build_task_info=False):
+        """Summary of a build (and its task), None when there is no such build"""
         build_id = self.getBuildId(build_id_or_nvr)
-        builddata = self.build(build_id)
+        if build_id is None:
+            return None
+        build_record = self._build_record(build_id)
+        if build_record is None:
+            return None
 
         # Useful information but does not include floating tags
-        # pullspecs = builddata['extra']['image']['index']['pull']
-        # tags = builddata['extra']['image']['index']['tags']
+        # pullspecs = build_record.pullspecs
+        # tags = build_record.tags
 
         build_task_id = self.getBuildTaskId(build_id)
 
         # tags from builddata will be only non floating tags
         # pullsepcs from builddata will only be main :{ver}-{rel}
         ret_data = {
-            'package_name': builddata['package_name'],
-            'nvr': builddata['nvr'],
-            'build_id': builddata['id'],
-            'build_pullspecs': builddata['extra']['image']['index']['pull'],
-            'build_tags': builddata['extra']['image']['index']['tags'],
+            'package_name': build_record.package_name,
+            'nvr': build_record.nvr,
+            'build_id': build_record.id,
+            'build_pullspecs': list(build_record.pullspecs),
+            'build_tags': list(build_record.tags),
         }
         if build_id in self._build_id_to_parent_id:
             ret_data['parent_build_id'] = self._build_id_to_parent_id[build_id]
 
-        if grab_build_task_info:
-            task_results = self.getTaskResult(build_task_id)
+        # builds not made by OSBS have no task
+        if grab_build_task_info and build_task_id is not None:
+            task_record = self._task_record(build_task_id)
 
-            if 'repositories' in task_results:
-                ret_data['task_pullspecs'] = task_results['repositories']
+            if task_record.repositories is not None:
+                ret_data['task_pullspecs'] = list(task_record.repositories)
 
         return ret_data
 
-    def get_container_builds_from_koji_tag(self, koji_tag, get_extra_info=False):
-        matching_containers = {}
-
-        for build in koji_tag.builds():
-            if build['nvr'] not in self._nvr_to_build_id:
-                self._nvr_to_build_id[build['nvr']] = build['id']
+    def get_records(self, build_ids_or_nvrs, grab_build_task_info=False):
+        """getRecordForBuild for each entry, returned in the same order
 
-            component = build['package_name']
-
-            if component not in matching_containers:
-                matching_containers[component] = {}
+        With max_workers set the lookups run on a bounded thread pool so
+        cache misses overlap their hub round trips.
+        """
+        build_ids_or_nvrs = list(build_ids_or_nvrs)
 
-            record = self.getRecordForBuild(build['id'], grab_build_task_info=get_extra_info)
-            matching_containers[component][build['id']] = record
+        def get_record(build_id_or_nvr):
+            return self.getRecordForBuild(build_id_or_nvr, grab_build_task_info=grab_build_task_info)
 
-            if 'parent_build_id' in record and False:
-                parent_record = self.getRecordForBuild(record['parent_build_id'])
-                parent_component = parent_record['package_name']
-                if 'openstack' in parent_component:
-                    if parent_component not in matching_containers:
-                        matching_containers[parent_component] = {}
-                    matching_containers[parent_component][parent_record['build_id']] = parent_record
+        if not self.max_workers or len(build_ids_or_nvrs) < 2:
+            return [get_record(i) for i in build_ids_or_nvrs]
 
-        return matching_containers
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(get_record, build_ids_or_nvrs))
 
-    def get_tree(self, list_of_nvrs):
-        container_set = set()
-        tree = {}
-        queue = []
-        queue.extend(list_of_nvrs)
-        while queue:
-            nvr = self.get_nvr(queue.pop())
-            build_id = self.getBuildId(nvr)
-            parent_build_id = self.getParentBuildId(nvr)
-            if parent_build_id is not None and parent_build_id not in tree:
-                queue.append(parent_build_id)
-
-            if parent_build_id is not None:
-                container_set.add(parent_build_id)
-            container_set.add(build_id)
-            tree[build_id] = parent_build_id
-
-        for build_id in container_set:
-            print("{0} [label = {1} ];".format(build_id, self.get_nvr(build_id)))
-
-        for build_id, parent_build_id in tree.items():
-            if parent_build_id is not None:
-                print("{0} -> {1} ;".format(parent_build_id, build_id))
+    def get_container_builds_from_koji_tag(self, koji_tag, get_extra_info=False):
+        return self._by_component(self._iter_records(koji_tag.builds(),
+                                                     get_extra_info=get_extra_info))
+
+    def resolve_ancestry(self, build_ids_or_nvrs):
+        """Resolve builds and all their ancestors into build_graph
+
+        The graph is walked breadth first and each level is fetched from the
+        hub in one batch.  Returns the build ids visited, starting with the
+        builds asked for.
+        """
+        build_ids_or_nvrs = list(build_ids_or_nvrs)
+        self.prefetch_records(build_ids_or_nvrs)
+
+        # builds that do not exist are left out
+        frontier = [build_id for build_id in dict.fromkeys(self.getBuildId(i)
+                                                           for i in build_ids_or_nvrs)
+                    if build_id is not None and self._build_record(build_id) is not None]
+        visited = list(frontier)
+        seen = set(frontier)
+        while frontier:
+            self.prefetch_records(frontier)
+            next_frontier = []
+            for build_id in frontier:
+                parent_build_id = self.getParentBuildId(build_id)
+                if parent_build_id is not None and parent_build_id not in seen:
+                    seen.add(parent_build_id)
+                    next_frontier.append(parent_build_id)
+            visited.extend(next_frontier)
+            frontier = next_frontier
+
+        return visited
+
+    def get_ancestors(self, build_id_or_nvr):
+        """Parent, grandparent ... build ids of a build, nearest first"""
+        build_id = self.getBuildId(build_id_or_nvr)
+        self.resolve_ancestry([build_id])
+        return self.build_graph.ancestors(build_id)
+
+    def get_descendants(self, build_id_or_nvr):
+        """Build ids known to be built on top of a build, level by level
+
+        Only builds that have passed through the caches are known, resolve a
+        tag (get_list_containers/prefetch_records) first to cover it.
+        """
+        return self.build_graph.descendants(self.getBuildId(build_id_or_nvr))
+
+    def write_graph(self, build_ids, fout, output_format='dot'):
+        """Stream the graph of build_ids as 'dot' or 'json' to fout"""
+        if output_format == 'dot':
+            self.build_graph.write_dot(fout, build_ids, label=self.get_nvr)
+        elif output_format == 'json':
+            self.build_graph.write_json(fout, build_ids, label=self.get_nvr)
+        else:
+            raise ValueError("Unknown graph format {0}".format(output_format))
+
+    def get_tree(self, list_of_nvrs, fout=None, output_format='dot'):
+        """Resolve the ancestry of list_of_nvrs and write it to fout (stdout)
+
+        Returns a dict of build id to parent build id.
+        """
+        build_ids = self.resolve_ancestry(list_of_nvrs)
+        tree = dict((build_id, self.build_graph.parent(build_id)) for build_id in build_ids)
+
+        if fout is None:
+            fout = sys.stdout
+        self.write_graph(build_ids, fout, output_format=output_format)
 
         return tree
 
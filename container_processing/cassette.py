@@ -0,0 +1,159 @@
+"""Record koji hub traffic to a cassette file and replay it offline
+
+A RecordingSession sits between CachingKojiWrapper and the real
+koji.ClientSession and keeps every call made with its response (or fault).
+The calls inside a multiCall are kept one by one, so a replay answers them
+however they end up chunked.  A ReplaySession serves a cassette without a
+hub, optionally sleeping a fixed latency per round trip like FakeKojiHub:
+
+    koji_session = CachingKojiWrapper(profile='brew', record_to='run.cassette')
+    ...
+    koji_session.save_cassette()
+
+    koji_session = CachingKojiWrapper(replay_from='run.cassette', replay_latency=0.05)
+
+Cassettes are gzip compressed JSON.
+"""
+
+from collections import Counter
+from container_processing.cache_util import atomic_write
+import gzip
+import io
+import json
+import threading
+import time
+import xmlrpc.client
+
+import koji
+
+# bump when the layout of the cassette file changes
+CASSETTE_FORMAT = 1
+
+
+class CassetteMiss(LookupError):
+    """A replayed call that is not in the cassette"""
+
+
+def _call_key(method, args, kwargs):
+    return json.dumps([method, list(args), kwargs or {}], sort_keys=True, separators=(',', ':'))
+
+
+class Cassette(object):
+    """Responses of hub calls in the order the hub gave them, per call
+
+    A call made more often than it was recorded is answered with its last
+    response.
+    """
+
+    def __init__(self, interactions=None):
+        # call key -> [{'result': ...} or {'fault': {faultCode, faultString}}]
+        self.interactions = dict(interactions or {})
+        self._played = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, method, args, kwargs, outcome):
+        with self._lock:
+            self.interactions.setdefault(_call_key(method, args, kwargs), []).append(outcome)
+
+    def play(self, method, args, kwargs):
+        """Next recorded outcome of the call, raises CassetteMiss if there is none"""
+        key = _call_key(method, args, kwargs)
+        with self._lock:
+            outcomes = self.interactions.get(key)
+            if not outcomes:
+                raise CassetteMiss("{0} not recorded with args {1} {2}".format(
+                    method, list(args), kwargs or {}))
+            index = min(self._played[key], len(outcomes) - 1)
+            self._played[key] += 1
+            return outcomes[index]
+
+    def __len__(self):
+        return sum(len(outcomes) for outcomes in self.interactions.values())
+
+    def save(self, filename):
+        with self._lock:
+            data = {'format': CASSETTE_FORMAT, 'interactions': self.interactions}
+            payload = json.dumps(data, sort_keys=True, separators=(',', ':'))
+        buf = io.BytesIO()
+        # gzip.compress only takes mtime from python 3.8
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as fout:
+            fout.write(payload.encode('utf-8'))
+        atomic_write(filename, buf.getvalue())
+
+    @classmethod
+    def load(cls, filename):
+        with gzip.open(filename, 'rt') as fin:
+            data = json.load(fin)
+        if data.get('format') != CASSETTE_FORMAT:
+            raise ValueError("{0} is cassette format {1}, expected {2}".format(
+                filename, data.get('format'), CASSETTE_FORMAT))
+        return cls(data['interactions'])
+
+
+def _fault_outcome(faultCode, faultString):
+    return {'fault': {'faultCode': faultCode, 'faultString': faultString}}
+
+
+class RecordingSession(koji.ClientSession):
+    """koji.ClientSession passing every call to session and recording it"""
+
+    def __init__(self, session, cassette=None):
+        super().__init__(session.baseurl, opts=session.opts)
+        self.session = session
+        self.cassette = cassette if cassette is not None else Cassette()
+
+    def _callMethod(self, name, args, kwargs=None, retry=True):
+        if name == 'multiCall':
+            results = self.session._callMethod(name, args, kwargs, retry=retry)
+            for call, result in zip(args[0], results):
+                call_args, call_kwargs = koji.decode_args(*call['params'])
+                if isinstance(result, dict):
+                    outcome = _fault_outcome(result['faultCode'], result['faultString'])
+                else:
+                    outcome = {'result': result[0]}
+                self.cassette.record(call['methodName'], call_args, call_kwargs, outcome)
+            return results
+
+        try:
+            result = self.session._callMethod(name, args, kwargs, retry=retry)
+        except koji.GenericError as ex:
+            self.cassette.record(name, args, kwargs, _fault_outcome(ex.faultCode, str(ex)))
+            raise
+        self.cassette.record(name, args, kwargs, {'result': result})
+        return result
+
+
+class ReplaySession(koji.ClientSession):
+    """koji.ClientSession answering calls from a cassette, no hub needed
+
+    Every round trip (a multiCall counts once) sleeps latency seconds and
+    is counted in calls.
+    """
+
+    def __init__(self, cassette, latency=0.0):
+        super().__init__('http://replay.invalid/kojihub')
+        self.cassette = cassette
+        self.latency = latency
+        self.calls = Counter()
+
+    def _callMethod(self, name, args, kwargs=None, retry=True):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if name == 'multiCall':
+            results = []
+            for call in args[0]:
+                call_args, call_kwargs = koji.decode_args(*call['params'])
+                outcome = self.cassette.play(call['methodName'], call_args, call_kwargs)
+                if 'fault' in outcome:
+                    results.append(outcome['fault'])
+                else:
+                    results.append([outcome['result']])
+            return results
+
+        outcome = self.cassette.play(name, args, kwargs)
+        if 'fault' in outcome:
+            fault = outcome['fault']
+            raise koji.convertFault(xmlrpc.client.Fault(fault['faultCode'], fault['faultString']))
+        return outcome['result']
@@ -1,12 +1,27 @@
 """Helper module to parse container images from group test event message"""
 
+from cachetools import LRUCache
 import json
+import sys
+
+# bytes read from a message dump at a time
+READ_CHUNK_SIZE = 65536
+
+# characters a single message may take, a dump growing past it without
+# completing a message is not parsed any further
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# message ids remembered to skip messages seen again in a dump
+SEEN_MESSAGE_IDS = 100000
 
 
 def extract_summary_from_group_test_event(json_blob_string):
     """Extract details from group test event message"""
-    json_blob = json.loads(json_blob_string)
+    return summarize_group_test_event(json.loads(json_blob_string))
 
+
+def summarize_group_test_event(json_blob):
+    """Extract details from an already decoded group test event message"""
     ret_data = {}
     message_id = json_blob['headers']['message-id']
     containers = []
@@ -21,6 +36,105 @@ def extract_summary_from_group_test_event(json_blob_string):
     return ret_data
 
 
+def iter_json_messages(fin, chunk_size=READ_CHUNK_SIZE, line_buffered=False,
+                       max_message_size=MAX_MESSAGE_SIZE):
+    """Yield each JSON value of a JSONL or concatenated JSON dump
+
+    fin is read incrementally, only the message being decoded is held in
+    memory however large the dump is.  A message that does not parse before
+    the end of its line is reported on stderr and decoding goes on with the
+    next line, one still incomplete after max_message_size characters raises
+    ValueError.  line_buffered reads fin a line at a
+    time so a message on a pipe or FIFO is yielded as soon as its line ends,
+    every line then holds whole messages and a line that does not parse is
+    reported on stderr and skipped.
+    """
+    if line_buffered:
+        for message in _iter_json_lines(fin):
+            yield message
+        return
+
+    read = fin.read
+    decoder = json.JSONDecoder()
+    buf = ''
+    eof = False
+    while True:
+        buf = buf.lstrip()
+        if buf:
+            try:
+                message, end = decoder.raw_decode(buf)
+            except ValueError as ex:
+                # JSON tokens never span lines, an error before a newline is
+                # not just a message cut short by the end of buf
+                newline = buf.find('\n', getattr(ex, 'pos', len(buf)))
+                if newline != -1:
+                    print("# skipping a message that does not parse: {0}".format(ex),
+                          file=sys.stderr)
+                    buf = buf[newline + 1:]
+                    continue
+                if eof:
+                    raise
+                if len(buf) > max_message_size:
+                    raise ValueError("no message within {0} characters".format(max_message_size))
+            else:
+                if end < len(buf) or eof:
+                    # a value ending exactly at the end of buf may be cut short
+                    yield message
+                    buf = buf[end:]
+                    continue
+        elif eof:
+            return
+
+        # read at least as much again as is buffered so a large message is
+        # not decoded over and over
+        data = read(max(chunk_size, len(buf)))
+        if not data:
+            eof = True
+        buf += data
+
+
+def _iter_json_lines(fin):
+    decoder = json.JSONDecoder()
+    for line_number, line in enumerate(iter(fin.readline, ''), 1):
+        messages = []
+        rest = line.strip()
+        try:
+            while rest:
+                message, end = decoder.raw_decode(rest)
+                messages.append(message)
+                rest = rest[end:].lstrip()
+        except ValueError as ex:
+            print("# skipping line {0}, it does not parse: {1}".format(line_number, ex),
+                  file=sys.stderr)
+            continue
+
+        for message in messages:
+            yield message
+
+
+def iter_group_test_summaries(fin, seen=None, chunk_size=READ_CHUNK_SIZE, line_buffered=False):
+    """Yield summaries of the group test events in a message dump
+
+    Messages whose message-id is a key of the mapping seen are skipped, it
+    defaults to remembering the SEEN_MESSAGE_IDS most recent ids.  Messages
+    that are not group test events are skipped.
+    """
+    if seen is None:
+        seen = LRUCache(maxsize=SEEN_MESSAGE_IDS)
+
+    for message in iter_json_messages(fin, chunk_size=chunk_size, line_buffered=line_buffered):
+        try:
+            summary = summarize_group_test_event(message)
+        except (KeyError, TypeError):
+            continue
+
+        if summary['message_id'] in seen:
+            continue
+        seen[summary['message_id']] = True
+
+        yield summary
+
+
 def main():
     """Main for taking file with Group Test json message
 
@@ -34,9 +148,30 @@ def main():
                         help="json file with group_test blob in it")
     parser.add_argument('--debug', action='store_true', default=False,
                         help='Enable additional debugging output')
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='test_file is a JSONL or concatenated message dump (- for stdin, '
+                        'may be gzipped), print one JSON summary per new message')
 
     args = parser.parse_args()
 
+    if args.stream:
+        import gzip
+
+        if args.test_file == '-':
+            fin = sys.stdin
+        elif args.test_file.endswith('.gz'):
+            fin = gzip.open(args.test_file, 'rt')
+        else:
+            fin = open(args.test_file)
+
+        try:
+            for summary in iter_group_test_summaries(fin):
+                print(json.dumps(summary, sort_keys=True))
+        finally:
+            if fin is not sys.stdin:
+                fin.close()
+        return
+
     json_blob_string = None
     with open(args.test_file) as fin:
         json_blob_string = fin.read()
@@ -0,0 +1,139 @@
+"""Concurrency limit and retries for hub calls made by CachingKojiWrapper
+
+The HubGovernor admits at most `limit` hub requests at a time across all
+threads.  The limit follows AIMD: every request completing in reasonable
+time adds 1/limit to it (about one more slot per round of requests), a
+transient failure or a request much slower than usual halves it.  Requests
+failing transiently are retried with jittered exponential backoff.
+"""
+
+import random
+import threading
+import time
+import xmlrpc.client
+
+# default most hub requests in flight at the same time
+MAX_HUB_CONCURRENCY = 16
+
+# default times a request failing transiently is sent again
+HUB_RETRIES = 3
+
+# seconds the first retry waits at most, doubled for every further one
+HUB_RETRY_BACKOFF = 1.0
+
+# longest wait in seconds before a retry
+HUB_RETRY_MAX_BACKOFF = 30.0
+
+# a request slower than this many times the usual latency counts as congestion
+LATENCY_TOLERANCE = 4.0
+
+# requests faster than this many seconds never count as congestion
+LATENCY_FLOOR = 0.1
+
+# weight of the newest sample in the usual (moving average) latency
+LATENCY_SMOOTHING = 0.1
+
+# errors of the connection to the hub that are worth retrying, the requests
+# exceptions are OSErrors too; koji.ServerOffline is added by HubGovernor
+TRANSIENT_ERRORS = (xmlrpc.client.ProtocolError, OSError)
+
+
+class HubGovernor(object):
+    """AIMD limit on concurrent hub requests with retries of transient errors"""
+
+    def __init__(self, max_limit=MAX_HUB_CONCURRENCY, retries=HUB_RETRIES,
+                 backoff=HUB_RETRY_BACKOFF, max_backoff=HUB_RETRY_MAX_BACKOFF,
+                 latency_tolerance=LATENCY_TOLERANCE, sleep=time.sleep, clock=time.monotonic,
+                 rng=None):
+        self.max_limit = max_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.latency_tolerance = latency_tolerance
+        self.sleep = sleep
+        self.clock = clock
+        self.rng = rng or random.Random()
+
+        # koji is slow to import, the cli scripts only load it once their
+        # options are valid
+        import koji
+        self.transient_errors = TRANSIENT_ERRORS + (koji.ServerOffline,)
+
+        self.condition = threading.Condition()
+        # start at the maximum, the hub is assumed healthy until it is not
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        # method -> moving average of the latency of its successful requests,
+        # a multicall is slower than a single call without being congested
+        self.latency = {}
+        # bumped on every decrease, requests started before the last one do
+        # not decrease the limit again
+        self.epoch = 0
+        self.retried = 0
+        self.decreases = 0
+
+    def acquire(self):
+        """Wait for a free slot, returns the epoch the request started in"""
+        with self.condition:
+            while self.in_flight >= max(1, int(self.limit)):
+                self.condition.wait()
+            self.in_flight += 1
+            return self.epoch
+
+    def release(self, epoch, method, seconds, failed=False):
+        """Free the slot of a request and adjust the limit to how it went
+
+        failed is a transient failure, a request much slower than usual for
+        its method counts as one too.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if not failed:
+                usual = self.latency.get(method)
+                if usual is None:
+                    self.latency[method] = seconds
+                else:
+                    failed = seconds > max(LATENCY_FLOOR, usual * self.latency_tolerance)
+                    self.latency[method] = usual + LATENCY_SMOOTHING * (seconds - usual)
+
+            if not failed:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            elif epoch == self.epoch:
+                self.limit = max(1.0, self.limit / 2)
+                self.epoch += 1
+                self.decreases += 1
+            self.condition.notify_all()
+
+    def backoff_delay(self, attempt):
+        """Full jitter: uniform up to backoff * 2**attempt, capped at max_backoff"""
+        return self.rng.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def call(self, method, function, *args, **kwargs):
+        """function(*args, **kwargs) sending a method request, in a slot and
+        retried on transient errors"""
+        for attempt in range(self.retries + 1):
+            epoch = self.acquire()
+            start = self.clock()
+            try:
+                result = function(*args, **kwargs)
+            except self.transient_errors:
+                self.release(epoch, method, self.clock() - start, failed=True)
+                if attempt == self.retries:
+                    raise
+            except BaseException:
+                # the hub answered, just not with a result
+                self.release(epoch, method, self.clock() - start)
+                raise
+            else:
+                self.release(epoch, method, self.clock() - start)
+                return result
+
+            with self.condition:
+                self.retried += 1
+            self.sleep(self.backoff_delay(attempt))
+
+    def stats(self):
+        with self.condition:
+            return {'limit': self.limit, 'max_limit': self.max_limit,
+                    'in_flight': self.in_flight, 'retries': self.retried,
+                    'decreases': self.decreases, 'latency': dict(self.latency)}
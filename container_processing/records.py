@@ -0,0 +1,145 @@
+"""Compact records kept in the CachingKojiWrapper caches
+
+koji build() and getTaskResult() payloads for container images are large
+(the build 'extra' holds full index manifests) while only a handful of
+fields are ever used.  These records keep just those fields; the raw
+payload is only kept when asked for.
+"""
+
+
+class BuildRecord(object):
+    """Projection of a koji container image build"""
+
+    __slots__ = ('id', 'nvr', 'package_name', 'task_id', 'parent_build_id',
+                 'pullspecs', 'tags', 'raw')
+
+    def __init__(self, id, nvr, package_name, task_id=None, parent_build_id=None,
+                 pullspecs=(), tags=(), raw=None):
+        self.id = id
+        self.nvr = nvr
+        self.package_name = package_name
+        self.task_id = task_id
+        self.parent_build_id = parent_build_id
+        self.pullspecs = tuple(pullspecs)
+        self.tags = tuple(tags)
+        self.raw = raw
+
+    @classmethod
+    def from_build(cls, builddata, keep_raw=False):
+        """Project a koji getBuild() dict"""
+        extra = builddata.get('extra') or {}
+        image = extra.get('image') or {}
+        index = image.get('index') or {}
+
+        task_id = extra.get('container_koji_task_id')
+        if task_id is not None:
+            task_id = int(task_id)
+        parent_build_id = image.get('parent_build_id')
+        if parent_build_id is not None:
+            parent_build_id = int(parent_build_id)
+
+        return cls(builddata['id'], builddata['nvr'], builddata['package_name'],
+                   task_id=task_id, parent_build_id=parent_build_id,
+                   pullspecs=index.get('pull') or (), tags=index.get('tags') or (),
+                   raw=builddata if keep_raw else None)
+
+    def to_build(self):
+        """Return the raw payload, or a koji shaped dict of the kept fields"""
+        if self.raw is not None:
+            return self.raw
+
+        image = {'index': {'pull': list(self.pullspecs), 'tags': list(self.tags)}}
+        if self.parent_build_id is not None:
+            image['parent_build_id'] = self.parent_build_id
+        extra = {'image': image}
+        if self.task_id is not None:
+            extra['container_koji_task_id'] = self.task_id
+
+        return {'id': self.id, 'build_id': self.id, 'nvr': self.nvr,
+                'package_name': self.package_name, 'extra': extra}
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "BuildRecord(id={0!r}, nvr={1!r})".format(self.id, self.nvr)
+
+
+class TaskRecord(object):
+    """Projection of a koji buildContainer task result"""
+
+    __slots__ = ('koji_builds', 'repositories', 'raw')
+
+    def __init__(self, koji_builds=None, repositories=None, raw=None):
+        self.koji_builds = None if koji_builds is None else tuple(int(i) for i in koji_builds)
+        self.repositories = None if repositories is None else tuple(repositories)
+        self.raw = raw
+
+    @classmethod
+    def from_result(cls, result, keep_raw=False):
+        """Project a koji getTaskResult() value (a dict for container builds)"""
+        if not isinstance(result, dict):
+            return cls(raw=result if keep_raw else None)
+        return cls(koji_builds=result.get('koji_builds'),
+                   repositories=result.get('repositories'),
+                   raw=result if keep_raw else None)
+
+    def to_result(self):
+        """Return the raw payload, or a koji shaped dict of the kept fields"""
+        if self.raw is not None:
+            return self.raw
+
+        result = {}
+        if self.koji_builds is not None:
+            result['koji_builds'] = [str(i) for i in self.koji_builds]
+        if self.repositories is not None:
+            result['repositories'] = list(self.repositories)
+        return result
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "TaskRecord(koji_builds={0!r})".format(self.koji_builds)
+
+
+def as_build_record(value):
+    """Accept both records and build dicts from caches written before records"""
+    if value is None or isinstance(value, BuildRecord):
+        return value
+    return BuildRecord.from_build(value)
+
+
+def is_fault(value):
+    """A getTaskResult(raise_fault=False) fault, caches written before faults
+    stopped being cached still hold some"""
+    return isinstance(value, dict) and 'faultCode' in value
+
+
+def as_task_record(value):
+    """Accept both records and task results, None for a fault"""
+    if isinstance(value, TaskRecord):
+        return value
+    if is_fault(value):
+        return None
+    return TaskRecord.from_result(value)
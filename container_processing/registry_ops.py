@@ -0,0 +1,247 @@
+"""oc operations that bring container images into the internal registry
+
+A RegistryUpdate describes what one container image needs: an import of
+its version-release pullspec and the tags pointing at it.  The updates
+can be printed as oc command lines, run directly on a bounded pool of
+workers, or written as one ImageStream list manifest for `oc apply -f`.
+
+Against a RegistrySnapshot of the image streams currently in the registry
+an update is reduced to the operations that would change something.
+"""
+
+from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+import json
+import subprocess
+import time
+
+# default number of oc commands run at the same time
+OC_WORKERS = 8
+
+# default number of times a failing oc command is run again
+OC_RETRIES = 2
+
+# seconds slept before the first retry, doubled for every further one
+OC_RETRY_BACKOFF = 1.0
+
+
+class RegistryUpdate(object):
+    """Import container_name:version_release from from_pullspec and tag it"""
+
+    __slots__ = ('container_name', 'version_release', 'from_pullspec', 'tags')
+
+    def __init__(self, container_name, version_release, from_pullspec=None, tags=()):
+        self.container_name = container_name
+        self.version_release = version_release
+        self.from_pullspec = from_pullspec
+        self.tags = tuple(tags)
+
+    @classmethod
+    def from_record(cls, record, registry_tag, skip_latest=False):
+        """Update for a getRecordForBuild record"""
+        # strip off brew package name plus '-' to leave version-release
+        version_release = record['nvr'][len(record['package_name'])+1:]
+
+        # weird construct here to deal with openstack-swift-container-container
+        container_name = record['package_name']
+        if container_name.endswith('-container'):
+            container_name = container_name[0:- len("-container")]
+
+        # find version-release pullspec
+        from_pullspec = None
+        for pullspec in record['build_pullspecs']:
+            if version_release in pullspec:
+                from_pullspec = pullspec
+                break
+
+        tags = [registry_tag]
+        if not skip_latest:
+            tags.append('latest')
+
+        return cls(container_name, version_release, from_pullspec, tags)
+
+    @property
+    def source(self):
+        """name:tag of the build in the image stream"""
+        return "{0}:{1}".format(self.container_name, self.version_release)
+
+    def commands(self, namespace):
+        """argv of every oc command needed, in the order they must run"""
+        commands = []
+        if self.from_pullspec is not None:
+            commands.append(['oc', '-n', namespace, 'import-image', self.source,
+                             '--from', self.from_pullspec, '--insecure'])
+        if self.tags:
+            commands.append(['oc', '-n', namespace, 'tag', self.source] +
+                            ["{0}:{1}".format(self.container_name, tag) for tag in self.tags])
+        return commands
+
+    def command_lines(self, namespace):
+        """commands() as shell command lines"""
+        lines = []
+        if self.from_pullspec is not None:
+            lines.append("oc -n {0} import-image {1} --from \"{2}\" --insecure".format(
+                namespace, self.source, self.from_pullspec))
+        if self.tags:
+            lines.append("oc -n {0} tag {1} {2}".format(
+                namespace, self.source,
+                ' '.join("{0}:{1}".format(self.container_name, tag) for tag in self.tags)))
+        return lines
+
+    def diff(self, snapshot):
+        """This update reduced to what snapshot does not have yet, None if nothing"""
+        from_pullspec = self.from_pullspec
+        if snapshot.imported(self.container_name, self.version_release):
+            from_pullspec = None
+        tags = [tag for tag in self.tags
+                if not snapshot.points_to(self.container_name, tag, self.version_release)]
+        if from_pullspec is None and not tags:
+            return None
+        return RegistryUpdate(self.container_name, self.version_release, from_pullspec, tags)
+
+    def image_stream(self, namespace):
+        """ImageStream with this update's tags, for use in a manifest"""
+        spec_tags = []
+        if self.from_pullspec is not None:
+            spec_tags.append({'name': self.version_release,
+                              'from': {'kind': 'DockerImage', 'name': self.from_pullspec},
+                              'importPolicy': {'insecure': True}})
+        for tag in self.tags:
+            spec_tags.append({'name': tag,
+                              'from': {'kind': 'ImageStreamTag', 'name': self.source}})
+        return {'apiVersion': 'image.openshift.io/v1', 'kind': 'ImageStream',
+                'metadata': {'name': self.container_name, 'namespace': namespace},
+                'spec': {'tags': spec_tags}}
+
+    def __repr__(self):
+        return 'RegistryUpdate({0!r}, {1!r}, {2!r}, {3!r})'.format(
+            self.container_name, self.version_release, self.from_pullspec, self.tags)
+
+
+class RegistrySnapshot(object):
+    """Tags of the image streams in a namespace, from `oc get is -o json`"""
+
+    def __init__(self, spec_tags=None, images=None):
+        # (stream, tag) -> ImageStreamTag name the spec tag follows
+        self.spec_tags = dict(spec_tags or {})
+        # (stream, tag) -> image digest the tag currently resolves to
+        self.images = dict(images or {})
+
+    @classmethod
+    def from_image_streams(cls, image_streams):
+        """Snapshot of an ImageStream (or a List of them) as json decoded"""
+        items = image_streams.get('items')
+        if items is None:
+            items = [image_streams]
+
+        spec_tags = {}
+        images = {}
+        for stream in items:
+            name = stream['metadata']['name']
+            for tag in (stream.get('spec') or {}).get('tags') or ():
+                source = tag.get('from') or {}
+                if source.get('kind') == 'ImageStreamTag':
+                    reference = source['name']
+                    if ':' not in reference:
+                        reference = '{0}:{1}'.format(name, reference)
+                    spec_tags[(name, tag['name'])] = reference
+            for tag in (stream.get('status') or {}).get('tags') or ():
+                if tag.get('items'):
+                    images[(name, tag['tag'])] = tag['items'][0]['image']
+        return cls(spec_tags, images)
+
+    def imported(self, stream, tag):
+        return (stream, tag) in self.images
+
+    def points_to(self, stream, tag, source_tag):
+        """Does stream:tag already follow or resolve to stream:source_tag"""
+        if self.spec_tags.get((stream, tag)) == '{0}:{1}'.format(stream, source_tag):
+            return True
+        image = self.images.get((stream, source_tag))
+        return image is not None and self.images.get((stream, tag)) == image
+
+
+def load_snapshot(filename):
+    """RegistrySnapshot of a file holding `oc get is -o json` output"""
+    with open(filename) as fin:
+        return RegistrySnapshot.from_image_streams(json.load(fin))
+
+
+def fetch_snapshot(namespace, runner=None):
+    """RegistrySnapshot of the image streams in namespace, read with oc"""
+    if runner is None:
+        runner = run_oc
+    returncode, output = runner(['oc', '-n', namespace, 'get', 'imagestreams', '-o', 'json'])
+    if returncode != 0:
+        raise RuntimeError("oc get imagestreams in {0} failed: {1}".format(namespace, output))
+    return RegistrySnapshot.from_image_streams(json.loads(output))
+
+
+def diff_updates(updates, snapshot):
+    """updates reduced against snapshot, images already up to date dropped"""
+    changed = []
+    for update in updates:
+        update = update.diff(snapshot)
+        if update is not None:
+            changed.append(update)
+    return changed
+
+
+def imagestream_manifest(updates, namespace):
+    """One List of ImageStreams applying every update in a single oc apply
+
+    Image streams are merged per container, applying the manifest sets
+    spec.tags of each stream to exactly the tags listed here.
+    """
+    streams = {}
+    for update in updates:
+        stream = update.image_stream(namespace)
+        name = update.container_name
+        if name in streams:
+            streams[name]['spec']['tags'].extend(stream['spec']['tags'])
+        else:
+            streams[name] = stream
+    return {'apiVersion': 'v1', 'kind': 'List',
+            'items': [streams[name] for name in sorted(streams)]}
+
+
+def run_oc(argv):
+    """Default runner, run argv and return (returncode, output)
+
+    An oc that can not be run returns 127 like the shell does.
+    """
+    try:
+        proc = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True)
+    except OSError as ex:
+        return 127, str(ex)
+    return proc.returncode, proc.stdout
+
+
+def run_updates(updates, namespace, runner=run_oc, max_workers=OC_WORKERS,
+                retries=OC_RETRIES, backoff=OC_RETRY_BACKOFF, sleep=time.sleep):
+    """Run the commands of every update on a pool of max_workers
+
+    The commands of one update run in order, a command failing more than
+    retries times stops its update.  runner(argv) returns (returncode,
+    output).  Returns [(update, None or (argv, returncode, output))] in the
+    order of updates.
+    """
+    def run_update(update):
+        for argv in update.commands(namespace):
+            for attempt in range(retries + 1):
+                if attempt:
+                    sleep(backoff * 2 ** (attempt - 1))
+                returncode, output = runner(argv)
+                if returncode == 0:
+                    break
+            else:
+                return update, (argv, returncode, output)
+        return update, None
+
+    updates = list(updates)
+    if not updates:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run_update, updates))
@@ -0,0 +1,199 @@
+"""SQLite backed storage for CachingKojiWrapper caches
+
+Every cache entry is its own row, written as soon as it is set, so a run
+never has to load or rewrite the whole cache and an interrupted run keeps
+everything it fetched.  The database runs in WAL mode so readers are not
+blocked by the writer, and is memory mapped so processes reading the same
+database share its pages instead of each holding a private copy.  Opened
+read only a store never writes, entries set are only kept in memory.
+"""
+
+import pickle
+import sqlite3
+import threading
+import time
+
+CACHE_DB_FILENAME = 'caches.sqlite'
+
+# bytes of the database file memory mapped by each connection
+MMAP_SIZE = 256 * 1024 * 1024
+
+# pickle protocol of the keys, fixed so every python finds the rows of the
+# others (the highest protocol changes between python versions)
+KEY_PICKLE_PROTOCOL = 4
+
+# milliseconds a writer waits for another process holding the write lock
+BUSY_TIMEOUT = 30000
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS entries (
+           cache TEXT NOT NULL,
+           key BLOB NOT NULL,
+           value BLOB,
+           expires REAL,
+           PRIMARY KEY (cache, key))''',
+    'CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)',
+]
+
+
+def _dumps(obj):
+    return sqlite3.Binary(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def _dumps_key(key):
+    return sqlite3.Binary(pickle.dumps(key, protocol=KEY_PICKLE_PROTOCOL))
+
+
+class SqliteCacheStore(object):
+    """One sqlite database holding the rows of several named caches"""
+
+    def __init__(self, filename, timer=time.time, read_only=False):
+        self.filename = filename
+        self.timer = timer
+        self.read_only = read_only
+        self.lock = threading.RLock()
+        if read_only:
+            self.conn = sqlite3.connect('file:{0}?mode=ro'.format(filename), uri=True,
+                                        isolation_level=None, check_same_thread=False)
+        else:
+            # autocommit, every write is its own (cheap under WAL) transaction
+            self.conn = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA busy_timeout={0}'.format(BUSY_TIMEOUT))
+        self.conn.execute('PRAGMA mmap_size={0}'.format(MMAP_SIZE))
+        if read_only:
+            return
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in _SCHEMA:
+            self.conn.execute(statement)
+
+    def get(self, cache, key):
+        """Return (found, value) for key in cache, expired rows are not found"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value FROM entries WHERE cache = ? AND key = ? '
+                'AND (expires IS NULL OR expires > ?)',
+                (cache, _dumps_key(key), self.timer())).fetchone()
+        if row is None:
+            return False, None
+        return True, pickle.loads(row[0])
+
+    def set(self, cache, key, value, ttl=None):
+        if self.read_only:
+            return
+        expires = None
+        if ttl is not None:
+            expires = self.timer() + ttl
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO entries (cache, key, value, expires) VALUES (?, ?, ?, ?)',
+                (cache, _dumps_key(key), _dumps(value), expires))
+
+    def delete(self, cache, key):
+        if self.read_only:
+            return
+        with self.lock:
+            self.conn.execute('DELETE FROM entries WHERE cache = ? AND key = ?',
+                              (cache, _dumps_key(key)))
+
+    def items(self, cache):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT key, value FROM entries WHERE cache = ? '
+                'AND (expires IS NULL OR expires > ?)',
+                (cache, self.timer())).fetchall()
+        return [(pickle.loads(key), pickle.loads(value)) for key, value in rows]
+
+    def count(self, cache):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM entries WHERE cache = ? '
+                'AND (expires IS NULL OR expires > ?)',
+                (cache, self.timer())).fetchone()[0]
+
+    def clear_expiry(self, cache):
+        """Keep every row of cache until it is deleted"""
+        if self.read_only:
+            return
+        with self.lock:
+            self.conn.execute('UPDATE entries SET expires = NULL WHERE cache = ? '
+                              'AND expires IS NOT NULL', (cache,))
+
+    def purge_expired(self):
+        if self.read_only:
+            return
+        with self.lock:
+            self.conn.execute('DELETE FROM entries WHERE expires <= ?', (self.timer(),))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SqliteCache(object):
+    """Mapping backed by a SqliteCacheStore with an in-memory front cache
+
+    Reads are served from front (a cachetools cache) and fall back to disk on
+    a miss, writes go to both.  Entries evicted from front stay on disk; ttl
+    (seconds) is stored with each row and checked on read.
+    """
+
+    def __init__(self, store, name, front, ttl=None):
+        self.store = store
+        self.name = name
+        self.front = front
+        self.ttl = ttl
+
+    @property
+    def currsize(self):
+        return self.store.count(self.name)
+
+    @property
+    def maxsize(self):
+        return self.front.maxsize
+
+    def _load(self, key):
+        if key in self.front:
+            return True, self.front[key]
+        found, value = self.store.get(self.name, key)
+        if found:
+            self.front[key] = value
+        return found, value
+
+    def __contains__(self, key):
+        return self._load(key)[0]
+
+    def __getitem__(self, key):
+        found, value = self._load(key)
+        if not found:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.front[key] = value
+        self.store.set(self.name, key, value, ttl=self.ttl)
+
+    def __delitem__(self, key):
+        self.front.pop(key, None)
+        self.store.delete(self.name, key)
+
+    def __len__(self):
+        return self.currsize
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        found, value = self._load(key)
+        if found:
+            return value
+        return default
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def items(self):
+        return self.store.items(self.name)
@@ -0,0 +1,119 @@
+"""Hub call accounting and reporting of CachingKojiWrapper statistics"""
+
+from __future__ import print_function
+import json
+import sys
+import threading
+
+from container_processing.cache_util import atomic_write
+
+# upper bounds (seconds) of the hub call latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class HubCallStats(object):
+    """Per method call counts, errors and latency histograms"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.methods = {}
+
+    def record(self, method, seconds, error=False, calls=1):
+        """Account one hub round trip, calls is the number of calls it carried"""
+        with self.lock:
+            entry = self.methods.get(method)
+            if entry is None:
+                entry = {'calls': 0, 'round_trips': 0, 'errors': 0, 'seconds': 0.0,
+                         'buckets': [0] * (len(self.buckets) + 1)}
+                self.methods[method] = entry
+            entry['calls'] += calls
+            entry['round_trips'] += 1
+            entry['seconds'] += seconds
+            if error:
+                entry['errors'] += 1
+            index = len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    index = i
+                    break
+            entry['buckets'][index] += 1
+
+    def as_dict(self):
+        with self.lock:
+            ret = {}
+            for method, entry in self.methods.items():
+                ret[method] = dict(entry)
+                ret[method]['buckets'] = dict(
+                    (str(bound), count) for bound, count in
+                    zip(self.buckets + ('+Inf',), entry['buckets']))
+            return ret
+
+
+def _labels(**kwargs):
+    return ','.join('{0}="{1}"'.format(key, value) for key, value in sorted(kwargs.items()))
+
+
+def format_prometheus(stats, prefix='container_processing'):
+    """stats() of a CachingKojiWrapper in the Prometheus text format"""
+    lines = []
+
+    cache_metrics = [('hits', 'counter', 'cache lookups answered from the cache'),
+                     ('misses', 'counter', 'cache lookups not in the cache'),
+                     ('evictions', 'counter', 'entries evicted to stay under maxsize'),
+                     ('expirations', 'counter', 'entries dropped when their ttl ran out'),
+                     ('size', 'gauge', 'entries in the cache')]
+    for metric, metric_type, help_text in cache_metrics:
+        name = '{0}_cache_{1}'.format(prefix, metric)
+        if metric_type == 'counter':
+            name += '_total'
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} {1}'.format(name, metric_type))
+        for cache, values in sorted(stats['caches'].items()):
+            if values.get(metric) is not None:
+                lines.append('{0}{{{1}}} {2}'.format(name, _labels(cache=cache), values[metric]))
+
+    hub = sorted(stats['hub'].items())
+    for metric, key, help_text in [('calls', 'calls', 'koji calls made'),
+                                   ('round_trips', 'round_trips', 'requests sent to the hub'),
+                                   ('errors', 'errors', 'hub requests that failed')]:
+        name = '{0}_hub_{1}_total'.format(prefix, metric)
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} counter'.format(name))
+        for method, values in hub:
+            lines.append('{0}{{{1}}} {2}'.format(name, _labels(method=method), values[key]))
+
+    name = '{0}_hub_call_seconds'.format(prefix)
+    lines.append('# HELP {0} hub request latency'.format(name))
+    lines.append('# TYPE {0} histogram'.format(name))
+    for method, values in hub:
+        cumulative = 0
+        for bound, count in values['buckets'].items():
+            cumulative += count
+            lines.append('{0}_bucket{{{1}}} {2}'.format(name, _labels(method=method, le=bound), cumulative))
+        lines.append('{0}_sum{{{1}}} {2}'.format(name, _labels(method=method), values['seconds']))
+        lines.append('{0}_count{{{1}}} {2}'.format(name, _labels(method=method), values['round_trips']))
+
+    governor = stats.get('governor')
+    if governor is not None:
+        for metric, metric_type, key, help_text in [
+                ('hub_concurrency_limit', 'gauge', 'limit', 'hub requests allowed in flight'),
+                ('hub_retries_total', 'counter', 'retries', 'hub requests sent again'),
+                ('hub_limit_decreases_total', 'counter', 'decreases',
+                 'times the hub request limit was cut')]:
+            name = '{0}_{1}'.format(prefix, metric)
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+            lines.append('{0} {1}'.format(name, governor[key]))
+
+    return '\n'.join(lines) + '\n'
+
+
+def report_stats(koji_session, show=False, prometheus_textfile=None):
+    """Print stats as JSON on stderr and/or write a Prometheus textfile"""
+    stats = koji_session.stats()
+    if show:
+        print(json.dumps(stats, indent=2, sort_keys=True), file=sys.stderr)
+    if prometheus_textfile:
+        atomic_write(prometheus_textfile, format_prometheus(stats).encode('utf-8'))
+    return stats
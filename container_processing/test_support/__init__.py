@@ -0,0 +1,11 @@
+"""Helpers for exercising container_processing without a live koji hub"""
+
+from container_processing.test_support.fake_hub import FakeKojiHub
+from container_processing.test_support.fake_hub import make_container_build
+from container_processing.test_support.fake_hub import make_task_result
+from container_processing.test_support.synthetic import batch_label
+from container_processing.test_support.synthetic import make_synthetic_hub
+from container_processing.test_support.synthetic import synthetic_tag_names
+
+__all__ = ['FakeKojiHub', 'make_container_build', 'make_task_result', 'batch_label',
+           'make_synthetic_hub', 'synthetic_tag_names']
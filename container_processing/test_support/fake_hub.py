@@ -0,0 +1,208 @@
+"""In-process stand-in for a koji hub serving container image builds"""
+
+from collections import Counter
+import time
+
+import koji
+
+
+def make_container_build(build_id, package_name, version='1.0', release='1',
+                         task_id=None, parent_build_id=None,
+                         registry='registry.example.com', namespace='rhosp'):
+    """Build a dict shaped like koji getBuild() output for a container image"""
+    nvr = "{0}-{1}-{2}".format(package_name, version, release)
+    name = package_name
+    if name.endswith('-container'):
+        name = name[0:- len("-container")]
+    pull = "{0}/{1}/{2}:{3}-{4}".format(registry, namespace, name, version, release)
+    image = {
+        'index': {
+            'pull': [pull],
+            'tags': ["{0}-{1}".format(version, release)],
+        },
+    }
+    if parent_build_id is not None:
+        image['parent_build_id'] = parent_build_id
+
+    return {
+        'id': build_id,
+        'build_id': build_id,
+        'nvr': nvr,
+        'name': package_name,
+        'package_name': package_name,
+        'version': version,
+        'release': release,
+        'extra': {
+            'image': image,
+            'container_koji_task_id': task_id if task_id is not None else build_id + 100000,
+        },
+    }
+
+
+def make_task_result(build, batch=None, registry='registry.example.com', namespace='rhosp'):
+    """Build a dict shaped like koji getTaskResult() output for a buildContainer task"""
+    name = build['package_name']
+    if name.endswith('-container'):
+        name = name[0:- len("-container")]
+    repositories = list(build['extra']['image']['index']['pull'])
+    if batch is not None:
+        repositories.append("{0}/{1}/{2}:{3}".format(registry, namespace, name, batch))
+    return {
+        'koji_builds': [str(build['id'])],
+        'repositories': repositories,
+    }
+
+
+class FakeKojiHub(koji.ClientSession):
+    """koji.ClientSession that answers calls from in-memory data
+
+    Calls are dispatched through ``_callMethod`` just like the real session,
+    so koji's own multicall machinery works unchanged against it.  Every hub
+    call (including each ``multiCall`` round trip) is counted in ``calls``.
+
+    Tagging is recorded as tag_listing history with an event id per change,
+    like the real hub, so listings at an event and history queries work.
+    """
+
+    def __init__(self, builds=None, task_results=None, tags=None, latency=0.0):
+        super().__init__('http://fake-hub.invalid/kojihub')
+        self.latency = latency
+        self.calls = Counter()
+        self.builds = {}
+        self.nvrs = {}
+        self.task_results = {}
+        # tag name -> list of tag_listing history entries
+        self.tags = {}
+        self.event_id = 1000
+
+        for build in builds or []:
+            self.add_build(build)
+        if task_results:
+            self.task_results.update(task_results)
+        for tag, build_ids in (tags or {}).items():
+            for build_id in build_ids:
+                self.tag_build(tag, build_id)
+
+    def add_build(self, build, task_result=None, tags=None):
+        self.builds[build['id']] = build
+        self.nvrs[build['nvr']] = build['id']
+        if task_result is not None:
+            self.task_results[int(build['extra']['container_koji_task_id'])] = task_result
+        for tag in tags or []:
+            self.tag_build(tag, build['id'])
+
+    def tag_build(self, tag, build_id):
+        self.event_id += 1
+        self.tags.setdefault(tag, []).append({
+            'build_id': build_id, 'create_event': self.event_id, 'revoke_event': None,
+            'active': True})
+
+    def untag_build(self, tag, build_id):
+        self.event_id += 1
+        for entry in self.tags.get(tag, []):
+            if entry['build_id'] == build_id and entry['active']:
+                entry['revoke_event'] = self.event_id
+                entry['active'] = None
+
+    def _callMethod(self, name, args, kwargs=None, retry=True):
+        if kwargs is None:
+            kwargs = {}
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if name == 'multiCall':
+            return self._multi_call(args[0])
+
+        return self._dispatch(name, args, kwargs)
+
+    def _dispatch(self, name, args, kwargs):
+        # not getattr(self, ...), ClientSession answers any missing attribute
+        # with a hub call
+        handler = self.__dict__.get('_hub_' + name)
+        if handler is None and hasattr(type(self), '_hub_' + name):
+            handler = getattr(self, '_hub_' + name)
+        if handler is None:
+            raise koji.GenericError("Invalid method: {0}".format(name))
+        return handler(*args, **kwargs)
+
+    def _multi_call(self, calls):
+        results = []
+        for call in calls:
+            args, kwargs = koji.decode_args(*call['params'])
+            try:
+                results.append([self._dispatch(call['methodName'], args, kwargs)])
+            except koji.GenericError as e:
+                results.append({'faultCode': e.faultCode, 'faultString': str(e)})
+        return results
+
+    def _lookup_build(self, build_info):
+        if isinstance(build_info, int) or str(build_info).isdigit():
+            return self.builds.get(int(build_info))
+        return self.builds.get(self.nvrs.get(build_info))
+
+    def _hub_getBuild(self, buildInfo, strict=False):
+        build = self._lookup_build(buildInfo)
+        if build is None and strict:
+            raise koji.GenericError("No such build: {0}".format(buildInfo))
+        return build
+
+    def _hub_getTaskResult(self, taskId, raise_fault=True):
+        taskId = int(taskId)
+        if taskId not in self.task_results:
+            fault = koji.GenericError("Task {0} has no result".format(taskId))
+            if raise_fault:
+                raise fault
+            return {'faultCode': fault.faultCode, 'faultString': str(fault)}
+        return self.task_results[taskId]
+
+    def _hub_listTagged(self, tag, event=None, inherit=False, prefix=None, latest=False,
+                        package=None, owner=None, type=None):
+        if tag not in self.tags:
+            raise koji.GenericError("No such tagInfo: '{0}'".format(tag))
+        if event is None:
+            event = self.event_id
+
+        tagged = []
+        for entry in sorted(self.tags[tag], key=lambda i: i['create_event'], reverse=True):
+            if entry['create_event'] > event:
+                continue
+            if entry['revoke_event'] is not None and entry['revoke_event'] <= event:
+                continue
+            build = self.builds[entry['build_id']]
+            if type == 'image' and 'image' not in (build.get('extra') or {}):
+                continue
+            if package is not None and build['package_name'] != package:
+                continue
+            item = dict(build)
+            item['tag_name'] = tag
+            item['create_event'] = entry['create_event']
+            tagged.append(item)
+
+        if latest:
+            seen = set()
+            latest_tagged = []
+            for item in tagged:
+                if item['package_name'] not in seen:
+                    seen.add(item['package_name'])
+                    latest_tagged.append(item)
+            tagged = latest_tagged
+        return tagged
+
+    def _hub_getLastEvent(self, before=None, strict=True):
+        return {'id': self.event_id, 'ts': float(self.event_id)}
+
+    def _hub_queryHistory(self, tables=None, tag=None, afterEvent=None, beforeEvent=None, **kwargs):
+        entries = []
+        for entry in self.tags.get(tag, []):
+            events = [entry['create_event']]
+            if entry['revoke_event'] is not None:
+                events.append(entry['revoke_event'])
+            if afterEvent is not None and not [i for i in events if i > afterEvent]:
+                continue
+            if beforeEvent is not None and not [i for i in events if i < beforeEvent]:
+                continue
+            item = dict(entry)
+            item['tag.name'] = tag
+            entries.append(item)
+        return {'tag_listing': entries}
@@ -0,0 +1,67 @@
+"""Synthetic container image tags for a FakeKojiHub
+
+Builds are laid out like an OSP container image set: one base image, a
+layer of per-service base images built on it and leaf images built on
+those.  Every package is rebuilt once per batch and each rebuild's parent is
+the same batch's rebuild of the parent package.
+"""
+
+import random
+
+from container_processing.test_support.fake_hub import FakeKojiHub
+from container_processing.test_support.fake_hub import make_container_build
+from container_processing.test_support.fake_hub import make_task_result
+
+
+def batch_label(index):
+    return "2019{0:02d}{1:02d}.1".format(1 + index // 28 % 12, 1 + index % 28)
+
+
+def synthetic_tag_names(osp=16.0, rhel=8):
+    return ("rhos-{0}-rhel-{1}-candidate".format(float(osp), rhel),
+            "rhos-{0}-rhel-{1}-container-released".format(float(osp), rhel))
+
+
+def make_synthetic_hub(builds=1000, batches=4, osp=16.0, rhel=8, latency=0.0, seed=0):
+    """FakeKojiHub with about builds container builds tagged for osp/rhel
+
+    All builds are tagged into the candidate tag, every batch but the last
+    is tagged into the container-released tag.  Returns the hub.
+    """
+    rng = random.Random(seed)
+    hub = FakeKojiHub(latency=latency)
+    candidate, released = synthetic_tag_names(osp, rhel)
+
+    packages = max(2, builds // batches)
+    service_bases = max(1, packages // 20)
+    names = ['openstack-base-container']
+    names.extend('openstack-svc{0}-base-container'.format(i) for i in range(service_bases))
+    names.extend('openstack-svc{0}-img{1}-container'.format(rng.randrange(service_bases), i)
+                 for i in range(packages - len(names)))
+
+    # rhel base image every chain ends at, not tagged into the osp tags
+    rhel_base = make_container_build(1, 'rhel{0}-base-container'.format(rhel))
+    hub.add_build(rhel_base, make_task_result(rhel_base))
+
+    build_id = 1
+    for batch in range(batches):
+        label = batch_label(batch)
+        tags = [candidate] if batch == batches - 1 else [candidate, released]
+        batch_builds = {}
+        for name in names:
+            if name == 'openstack-base-container':
+                parent_build_id = rhel_base['id']
+            elif name.endswith('-base-container'):
+                parent_build_id = batch_builds['openstack-base-container']
+            else:
+                service = name.split('-img')[0] + '-base-container'
+                parent_build_id = batch_builds[service]
+
+            build_id += 1
+            build = make_container_build(build_id, name, version='16.0', release=str(batch + 1),
+                                         parent_build_id=parent_build_id)
+            hub.add_build(build, make_task_result(build, batch=label), tags=tags)
+            batch_builds[name] = build_id
+
+    hub.calls.clear()
+    return hub
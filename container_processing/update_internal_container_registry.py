@@ -2,10 +2,48 @@
 
 from __future__ import print_function
 import argparse
-from container_processing.caching_koji import CachingKojiWrapper
+from cachetools import LRUCache
+from concurrent.futures import ThreadPoolExecutor
+from container_processing.cache_util import CACHE_BACKENDS
+from container_processing.cache_util import CACHE_PATH
 from container_processing.group_test_parse import extract_summary_from_group_test_event
+from container_processing.group_test_parse import iter_group_test_summaries
+from container_processing.group_test_parse import SEEN_MESSAGE_IDS
+from container_processing.hub_governor import HUB_RETRIES
+from container_processing.hub_governor import MAX_HUB_CONCURRENCY
+from container_processing.registry_ops import diff_updates
+from container_processing.registry_ops import fetch_snapshot
+from container_processing.registry_ops import imagestream_manifest
+from container_processing.registry_ops import load_snapshot
+from container_processing.registry_ops import OC_RETRIES
+from container_processing.registry_ops import OC_WORKERS
+from container_processing.registry_ops import RegistryUpdate
+from container_processing.registry_ops import run_oc
+from container_processing.registry_ops import run_updates
+from container_processing.stats import report_stats
+import json
+import os
+import os.path
+import stat
+import sys
+import time
 
-def get_options():
+# seconds between saves of the caches in daemon mode
+CHECKPOINT_INTERVAL = 300
+
+# seconds between scans of an empty spool directory in daemon mode
+SPOOL_POLL_INTERVAL = 2
+
+
+def parse_release(release):
+    """osp:rhel to (osp, rhel)"""
+    parts = release.split(':')
+    if len(parts) != 2:
+        raise argparse.ArgumentTypeError("{0} is not osp:rhel".format(release))
+    return float(parts[0]), parts[1]
+
+
+def get_options(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('osp', type=float,
                         help='osp version to work with')
@@ -13,6 +51,10 @@ def get_options():
                         help='rhel version to work with (should match rhos-XX-rhel-<rhel_ver> of branch)')
     parser.add_argument('registry_tag', type=str,
                         help='container registry tag desired')
+    parser.add_argument('--release', type=parse_release, action='append', default=[],
+                        metavar='OSP:RHEL',
+                        help='also update the registry of this release, the tags of all '
+                        'releases are listed together and shared images resolved once')
     parser.add_argument('--batch', type=str, default=None,
                         help='batch label (from Dockerfile) of the container images')
     parser.add_argument('-Z', '--debug', action='store_true',
@@ -26,56 +68,164 @@ def get_options():
                         help='Default to using cdn content if no other images available')
     parser.add_argument('--from-group-testing-json', type=str,
                         help='Filename to load group testing json blob from')
-    return parser.parse_args()
+    parser.add_argument('--max-workers', type=int, default=None,
+                        help='Resolve koji records on a thread pool of this size')
+    parser.add_argument('--max-hub-concurrency', type=int, default=MAX_HUB_CONCURRENCY,
+                        help='Most hub requests in flight at once, lowered automatically '
+                        'while the hub is slow or failing')
+    parser.add_argument('--hub-retries', type=int, default=HUB_RETRIES,
+                        help='times a hub request failing transiently is sent again')
+    parser.add_argument('--cache-backend', choices=CACHE_BACKENDS, default='pickle',
+                        help='How the koji caches are persisted between runs')
+    parser.add_argument('--cache-path', type=str, default=CACHE_PATH,
+                        help='Directory the koji caches are kept in')
+    parser.add_argument('--cache-read-only', default=False, action='store_true',
+                        help='Use the caches in --cache-path without ever writing them')
+    parser.add_argument('--stats', default=False, action='store_true',
+                        help='Print cache and hub call statistics as JSON on stderr')
+    parser.add_argument('--prometheus-textfile', type=str, default=None,
+                        help='Write cache and hub call statistics to this Prometheus textfile')
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument('--record', type=str, default=None, metavar='CASSETTE',
+                          help='Record every hub call and response to this cassette file')
+    cassette.add_argument('--replay', type=str, default=None, metavar='CASSETTE',
+                          help='Answer hub calls from this cassette file instead of the hub')
+    parser.add_argument('--replay-latency', type=float, default=0.0,
+                        help='Seconds slept per hub round trip with --replay')
+    parser.add_argument('--daemon', type=str, default=None, metavar='SOURCE',
+                        help='Keep running and emit the commands for every group test message '
+                        'read from SOURCE, a spool directory, a FIFO or - for JSONL on stdin')
+    parser.add_argument('--checkpoint-interval', type=float, default=CHECKPOINT_INTERVAL,
+                        help='Seconds between saves of the caches in daemon mode')
+    parser.add_argument('--poll-interval', type=float, default=SPOOL_POLL_INTERVAL,
+                        help='Seconds between scans of an empty spool directory in daemon mode')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--execute', default=False, action='store_true',
+                      help='Run the oc commands instead of printing them')
+    mode.add_argument('--manifest', type=str, default=None,
+                      help='Write one ImageStream list manifest to this file for a single '
+                      'oc apply -f instead of printing oc commands')
+    current = parser.add_mutually_exclusive_group()
+    current.add_argument('--current-tags', type=str, default=None,
+                         help='JSON file with the current image streams (oc get is -o json), '
+                         'only images whose tags differ are updated')
+    current.add_argument('--diff', default=False, action='store_true',
+                         help='Read the current image streams with oc and only update images '
+                         'whose tags differ')
+    parser.add_argument('--stream', default=False, action='store_true',
+                        help='Print the oc commands of each image as soon as its build resolves '
+                        'instead of after every tag was scanned, bounds memory on huge tags')
+    parser.add_argument('--oc-workers', type=int, default=OC_WORKERS,
+                        help='oc commands run at the same time with --execute')
+    parser.add_argument('--oc-retries', type=int, default=OC_RETRIES,
+                        help='times a failing oc command is run again with --execute')
+    args = parser.parse_args(argv)
+    if args.release and (args.daemon or args.manifest):
+        parser.error('--release can not be used with --daemon or --manifest')
+    if args.release and (args.from_file or args.from_group_testing_json):
+        # explicit nvrs belong to a single release
+        parser.error('--release can not be used with --from-file or --from-group-testing-json')
+    namespaces = {}
+    for osp, rhel in requested_releases(args):
+        namespace = registry_namespace(osp)
+        if namespace in namespaces:
+            parser.error('rhos-{0}-rhel-{1} and rhos-{2}-rhel-{3} both update namespace {4}'.format(
+                namespaces[namespace][0], namespaces[namespace][1], osp, rhel, namespace))
+        namespaces[namespace] = (osp, rhel)
+    if args.stream and (args.release or args.daemon or args.execute or args.manifest or
+                        args.current_tags or args.diff):
+        parser.error('--stream only prints the oc commands of a single release')
+    return args
 
 
-def main():
+def read_nvrs_from_file(filename):
+    """Read container image nvrs, one per line"""
+    nvrs = []
+    with open(filename) as fin:
+        for row in fin:
+            row = row.rstrip()
+            if row:
+                nvrs.append(row)
+    return nvrs
 
-    args = get_options()
 
-    koji_session = CachingKojiWrapper(profile='brew')
-    koji_session.load_cache()
+def registry_namespace(osp):
+    """Registry namespace of the images of an osp version"""
+    return "rhosp{0}".format(int(osp))
 
-    # using latest
-    # might also want to use latest from batch
-    print('# Checking on builds for rhos-{0}-rhel-{1}'.format(args.osp, args.rhel))
-    print('oc login')
 
+def requested_releases(args):
+    """(osp, rhel) of every release to update, the positional one first"""
+    return list(dict.fromkeys([(float(args.osp), str(args.rhel))] + args.release))
+
+
+def release_options(args, osp, rhel):
+    """args for a single release"""
+    return argparse.Namespace(**dict(vars(args), osp=osp, rhel=rhel))
+
+
+def gather_sources(koji_session, args, group_test_nvrs=(), file_nvrs=()):
+    """Resolve every requested source concurrently against one koji session
+
+    The cdn and batch tag scans and the explicit nvr lookups run side by
+    side, nvrs named by both the group test message and the file are only
+    looked up once.  Returns (cdn_data, batch_data, group_test_data, from_file).
+    """
+    release = (float(args.osp), str(args.rhel))
+    return gather_release_sources(koji_session, args, [release], group_test_nvrs,
+                                  file_nvrs)[release]
+
+
+def gather_release_sources(koji_session, args, releases, group_test_nvrs=(), file_nvrs=()):
+    """gather_sources for several (osp, rhel) releases at once
+
+    The cdn and batch tags of all releases are each listed together
+    through get_containers_for_targets, so images shared between releases
+    are resolved once.  Returns {(osp, rhel): (cdn_data, batch_data,
+    group_test_data, from_file)}.
+    """
     cdn_data = {}
-    from_file = {}
     batch_data = {}
     group_test_data = {}
+    from_file = {}
 
-    if args.from_cdn:
-        cdn_data = koji_session.get_latest_cdn_containers(args.osp, args.rhel)
+    nvrs = list(dict.fromkeys(list(group_test_nvrs) + list(file_nvrs)))
 
-    if args.batch:
-        batch_data = koji_session.get_matching_batch_from_tag(args.osp, args.rhel, args.batch)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        cdn_future = None
+        batch_future = None
+        if args.from_cdn:
+            cdn_future = executor.submit(
+                koji_session.get_containers_for_targets,
+                [(osp, rhel, 'container-released') for osp, rhel in releases], latest=True)
+        if args.batch:
+            batch_future = executor.submit(
+                koji_session.get_containers_for_targets,
+                [(osp, rhel, 'candidate') for osp, rhel in releases], batch=args.batch)
+        records_future = executor.submit(koji_session.get_records, nvrs)
 
-    if args.from_group_testing_json:
-        json_blob_string = None
-        with open(args.from_group_testing_json) as fin:
-            json_blob_string = fin.read()
+        records = dict(zip(nvrs, records_future.result()))
+        if cdn_future is not None:
+            cdn_data = cdn_future.result()
+        if batch_future is not None:
+            batch_data = batch_future.result()
 
-        if json_blob_string:
-            group_test_json = extract_summary_from_group_test_event(json_blob_string)
-            for image in group_test_json['images']:
-                print([image])
-                record = koji_session.getRecordForBuild(image['nvr'])
-                group_test_data[record['package_name']] = [record]
+    for nvr in group_test_nvrs:
+        record = records[nvr]
+        group_test_data[record['package_name']] = [record]
 
-    if args.from_file:
-        with open(args.from_file) as fin:
-            row = fin.readline()
-            while row:
-                row = row.rstrip()
-                record = koji_session.getRecordForBuild(row)
+    for nvr in file_nvrs:
+        record = records[nvr]
+        from_file[record['package_name']] = [record]
 
-                from_file[record['package_name']] = [record]
-                row = fin.readline()
+    return dict(((osp, rhel), (cdn_data.get((osp, rhel, 'container-released'), {}),
+                               batch_data.get((osp, rhel, 'candidate'), {}),
+                               group_test_data, from_file))
+                for osp, rhel in releases)
 
-    koji_session.save_cache()
 
+def merge_sources(cdn_data, batch_data, from_file, group_test_data):
+    """Pick records per component, group test > file > batch > cdn"""
     data = {}
     for key in set(from_file.keys()) | set(cdn_data.keys()) | set(group_test_data.keys()) | set(batch_data.keys()):
         if key in cdn_data:
@@ -86,39 +236,295 @@ def main():
             data[key] = from_file[key]
         if key in group_test_data:
             data[key] = group_test_data[key]
+    return data
+
 
+def registry_updates(data, args, fout=None):
+    """RegistryUpdate for the record picked for each component"""
+    updates = []
     for record_list in data.values():
         if len(record_list) > 1:
-            print("# Multiple records found picking one {0}".format(record_list))
-        record = record_list[0]
-
-        # strip off brew package name plus '-' to leave version-release
-        version_release = record['nvr'][len(record['package_name'])+1:]
-
-        # weird construct here to deal with openstack-swift-container-container
-        container_name = record['package_name']
-        if container_name.endswith('-container'):
-            container_name = container_name[0:- len("-container")]
-
-        # form up name:tag of build for oc
-        latest_container = "{0}:{1}".format(container_name, version_release)
-
-        # find version-release pullspec
-        from_pullspec = None
-        for pullspec in record['build_pullspecs']:
-            if version_release in pullspec:
-                from_pullspec = pullspec
-                break
-        if from_pullspec is not None:
-            print("oc -n rhosp{0} import-image {1} --from \"{2}\" --insecure".format(
-                str(int(args.osp)), latest_container, from_pullspec))
-        additional_tag = ''
-        if not args.skip_latest:
-            additional_tag = "{0}:latest".format(container_name)
-        print("oc -n rhosp{0} tag {1} {2}:{3} {4}".format(
-            str(int(args.osp)), latest_container, container_name,
-            args.registry_tag, additional_tag))
+            print("# Multiple records found picking one {0}".format(record_list), file=fout)
+        updates.append(RegistryUpdate.from_record(record_list[0], args.registry_tag,
+                                                  skip_latest=args.skip_latest))
+    return updates
+
+
+def stream_registry_updates(koji_session, args, group_test_nvrs=(), file_nvrs=(), fout=None):
+    """Print the oc commands of every component as soon as its record resolves
+
+    The batch and cdn tags are walked page by page, with the precedence of
+    merge_sources: group test > file > batch > cdn, the first record of a
+    component in a source is used.  Returns the number of images.
+    """
+    namespace = registry_namespace(args.osp)
+    nvrs = list(dict.fromkeys(list(group_test_nvrs) + list(file_nvrs)))
+    records = dict(zip(nvrs, koji_session.get_records(nvrs)))
+
+    # a later nvr of the same component wins, like in gather_sources
+    group_test_data = dict((records[nvr]['package_name'], records[nvr])
+                           for nvr in group_test_nvrs)
+    from_file = dict((records[nvr]['package_name'], records[nvr]) for nvr in file_nvrs)
+
+    def candidates():
+        for record in group_test_data.values():
+            yield record
+        for record in from_file.values():
+            yield record
+        if args.batch:
+            tag = "rhos-{0}-rhel-{1}-candidate".format(float(args.osp), args.rhel)
+            for record in koji_session.iter_matching_batch(tag, args.batch):
+                yield record
+        if args.from_cdn:
+            tag = "rhos-{0}-rhel-{1}-container-released".format(float(args.osp), args.rhel)
+            for record in koji_session.iter_container_records(tag, latest=True):
+                yield record
+
+    seen = set()
+    for record in candidates():
+        if record['package_name'] in seen:
+            continue
+        seen.add(record['package_name'])
+        update = RegistryUpdate.from_record(record, args.registry_tag,
+                                            skip_latest=args.skip_latest)
+        for line in update.command_lines(namespace):
+            print(line, file=fout)
+        (fout or sys.stdout).flush()
+    return len(seen)
+
+
+def current_snapshot(args, namespace, runner=run_oc, fetcher=fetch_snapshot):
+    """RegistrySnapshot asked for by --current-tags or --diff, else None"""
+    if args.current_tags:
+        return load_snapshot(args.current_tags)
+    if args.diff:
+        return fetcher(namespace, runner=runner)
+    return None
+
+
+def apply_registry_updates(data, args, fout=None, runner=run_oc, fetcher=fetch_snapshot):
+    """Print, run (--execute) or write as a manifest (--manifest) the updates
+
+    With a snapshot of the current tags (--current-tags or --diff) only the
+    operations changing something are kept, a manifest keeps every tag of
+    the images that changed.  Returns the number of updates that failed to
+    run.
+    """
+    namespace = registry_namespace(args.osp)
+    updates = registry_updates(data, args, fout=fout)
+
+    snapshot = current_snapshot(args, namespace, runner=runner, fetcher=fetcher)
+    if snapshot is not None:
+        changed = diff_updates(updates, snapshot)
+        print("# {0} of {1} images up to date".format(len(updates) - len(changed), len(updates)),
+              file=fout)
+        if args.manifest:
+            changed_names = set(update.container_name for update in changed)
+            updates = [update for update in updates if update.container_name in changed_names]
+        else:
+            updates = changed
+
+    if args.manifest:
+        with open(args.manifest, 'w') as mout:
+            json.dump(imagestream_manifest(updates, namespace), mout, indent=2, sort_keys=True)
+        print("oc apply -f {0}".format(args.manifest), file=fout)
+        return 0
+
+    if not args.execute:
+        for update in updates:
+            for line in update.command_lines(namespace):
+                print(line, file=fout)
+        return 0
+
+    failed = 0
+    for update, error in run_updates(updates, namespace, runner=runner,
+                                     max_workers=args.oc_workers, retries=args.oc_retries):
+        if error is None:
+            print("# updated {0}".format(update.source), file=fout)
+            continue
+        failed += 1
+        argv, returncode, output = error
+        print("# {0} failed ({1}): {2}\n{3}".format(update.source, returncode, ' '.join(argv),
+                                                    output), file=sys.stderr)
+    return failed
+
+
+def save_state(koji_session, args):
+    """Save the caches and the cassette being recorded, report the stats asked for"""
+    koji_session.save_cache(path=args.cache_path)
+    if args.record:
+        koji_session.save_cassette(args.record)
+    if args.stats or args.prometheus_textfile:
+        report_stats(koji_session, show=args.stats, prometheus_textfile=args.prometheus_textfile)
+
+
+def iter_spool_dir(spool_dir, seen, poll_interval=SPOOL_POLL_INTERVAL, once=False):
+    """Yield summaries of the group test messages in files put in spool_dir
+
+    Files are handled in name order and then moved to done/ (or failed/ when
+    they do not parse), dot files and *.tmp are left for their writer to
+    finish and rename.  once returns when the directory is empty instead of
+    waiting for more files.
+    """
+    for subdir in ('done', 'failed'):
+        if not os.path.isdir(os.path.join(spool_dir, subdir)):
+            os.makedirs(os.path.join(spool_dir, subdir))
+
+    while True:
+        names = sorted(name for name in os.listdir(spool_dir)
+                       if not name.startswith('.') and not name.endswith('.tmp') and
+                       os.path.isfile(os.path.join(spool_dir, name)))
+        for name in names:
+            filename = os.path.join(spool_dir, name)
+            subdir = 'done'
+            with open(filename) as fin:
+                try:
+                    for summary in iter_group_test_summaries(fin, seen=seen):
+                        yield summary
+                except ValueError as ex:
+                    print("# {0} does not parse: {1}".format(filename, ex), file=sys.stderr)
+                    subdir = 'failed'
+            os.rename(filename, os.path.join(spool_dir, subdir, name))
+
+        if not names:
+            if once:
+                return
+            time.sleep(poll_interval)
+
+
+def iter_daemon_messages(source, poll_interval=SPOOL_POLL_INTERVAL):
+    """Yield group test summaries from a spool directory, a FIFO or - (stdin)
+
+    A FIFO is reopened whenever its writer goes away, stdin ends the daemon
+    at EOF.  Messages are deduplicated by message-id across the whole run.
+    """
+    seen = LRUCache(maxsize=SEEN_MESSAGE_IDS)
+
+    if source == '-':
+        for summary in iter_group_test_summaries(sys.stdin, seen=seen, line_buffered=True):
+            yield summary
+        return
+
+    if os.path.isdir(source):
+        for summary in iter_spool_dir(source, seen, poll_interval=poll_interval):
+            yield summary
+        return
+
+    if not stat.S_ISFIFO(os.stat(source).st_mode):
+        raise ValueError("{0} is not a directory or a FIFO".format(source))
+
+    while True:
+        with open(source) as fin:
+            for summary in iter_group_test_summaries(fin, seen=seen, line_buffered=True):
+                yield summary
+
+
+def run_daemon(koji_session, args, messages, file_nvrs=(), fout=None, clock=time.monotonic):
+    """Emit the registry commands for each group test summary in messages
+
+    koji_session stays warm across messages so only new builds are looked
+    up, the caches are saved every checkpoint_interval seconds and when
+    messages ends (or the daemon is stopped).  A message that fails is
+    reported on stderr and skipped.
+    """
+    def checkpoint():
+        save_state(koji_session, args)
+
+    last_checkpoint = clock()
+    try:
+        for summary in messages:
+            print('# group test message {0} errata {1}'.format(
+                summary['message_id'], summary['errata_id']), file=fout)
+            group_test_nvrs = [image['nvr'] for image in summary['images']]
+            try:
+                cdn_data, batch_data, group_test_data, from_file = gather_sources(
+                    koji_session, args, group_test_nvrs, file_nvrs)
+                apply_registry_updates(merge_sources(cdn_data, batch_data, from_file,
+                                                     group_test_data), args, fout=fout)
+            except Exception as ex:
+                print('# group test message {0} failed: {1!r}'.format(
+                    summary['message_id'], ex), file=sys.stderr)
+                continue
+            finally:
+                (fout or sys.stdout).flush()
+
+            if clock() - last_checkpoint >= args.checkpoint_interval:
+                checkpoint()
+                last_checkpoint = clock()
+    finally:
+        checkpoint()
+
+
+def main(argv=None, koji_session=None):
+
+    args = get_options(argv)
+
+    if koji_session is None:
+        # koji is slow to import, only pay for it once the options are valid
+        from container_processing.caching_koji import CachingKojiWrapper
+        koji_session = CachingKojiWrapper(profile='brew', max_workers=args.max_workers,
+                                          cache_backend=args.cache_backend,
+                                          cache_read_only=args.cache_read_only,
+                                          record_to=args.record, replay_from=args.replay,
+                                          replay_latency=args.replay_latency,
+                                          max_hub_concurrency=args.max_hub_concurrency,
+                                          hub_retries=args.hub_retries)
+    koji_session.load_cache(path=args.cache_path)
+
+    # using latest
+    # might also want to use latest from batch
+    for osp, rhel in requested_releases(args):
+        print('# Checking on builds for rhos-{0}-rhel-{1}'.format(osp, rhel))
+    print('oc login')
+
+    if args.daemon:
+        import signal
+
+        # run the final checkpoint on SIGTERM too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        file_nvrs = []
+        if args.from_file:
+            file_nvrs = read_nvrs_from_file(args.from_file)
+        run_daemon(koji_session, args, iter_daemon_messages(args.daemon, args.poll_interval),
+                   file_nvrs=file_nvrs)
+        return 0
+
+    group_test_nvrs = []
+    if args.from_group_testing_json:
+        json_blob_string = None
+        with open(args.from_group_testing_json) as fin:
+            json_blob_string = fin.read()
+
+        if json_blob_string:
+            group_test_json = extract_summary_from_group_test_event(json_blob_string)
+            for image in group_test_json['images']:
+                print([image])
+                group_test_nvrs.append(image['nvr'])
+
+    file_nvrs = []
+    if args.from_file:
+        file_nvrs = read_nvrs_from_file(args.from_file)
+
+    if args.stream:
+        stream_registry_updates(koji_session, args, group_test_nvrs, file_nvrs)
+        save_state(koji_session, args)
+        return 0
+
+    sources = gather_release_sources(koji_session, args, requested_releases(args),
+                                     group_test_nvrs, file_nvrs)
+    save_state(koji_session, args)
+
+    failed = 0
+    for osp, rhel in requested_releases(args):
+        if len(sources) > 1:
+            print('# Updating rhos-{0}-rhel-{1}'.format(osp, rhel))
+        cdn_data, batch_data, group_test_data, from_file = sources[(osp, rhel)]
+        data = merge_sources(cdn_data, batch_data, from_file, group_test_data)
+        failed += apply_registry_updates(data, release_options(args, osp, rhel))
+    if failed:
+        return 1
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,67 @@
+from container_processing.build_graph import BuildGraph
+from container_processing.caching_koji import CachingKojiWrapper
+from container_processing.test_support import FakeKojiHub
+from container_processing.test_support import make_container_build
+import io
+import json
+import pytest
+
+
+@pytest.fixture
+def fake_hub():
+    # 1 <- 2 <- (3, 4 <- 5), 6 is its own root
+    hub = FakeKojiHub()
+    for build_id, parent_build_id in [(1, None), (2, 1), (3, 2), (4, 2), (5, 4), (6, None)]:
+        hub.add_build(make_container_build(build_id, 'openstack-img{0}-container'.format(build_id),
+                                           parent_build_id=parent_build_id))
+    return hub
+
+
+class TestBuildGraph(object):
+
+    def test_queries(self):
+        graph = BuildGraph()
+        for build_id, parent_build_id in [(2, 1), (3, 2), (4, 2), (5, 4), (1, None)]:
+            graph.add(build_id, parent_build_id)
+
+        assert graph.ancestors(5) == [4, 2, 1]
+        assert graph.descendants(2) == [3, 4, 5]
+        assert graph.get_children(2) == [3, 4]
+        assert graph.topological_order([5, 3, 4, 2, 1]) == [1, 2, 3, 4, 5]
+        assert list(graph.edges([5, 4, 2])) == [(2, 4), (4, 5)]
+
+    def test_levels_fetched_in_batches(self, fake_hub):
+        koji_session = CachingKojiWrapper(session=fake_hub)
+        visited = koji_session.resolve_ancestry(['openstack-img5-container-1.0-1',
+                                                 'openstack-img3-container-1.0-1'])
+
+        assert visited == [5, 3, 4, 2, 1]
+        # one multicall per level: (5, 3), (4, 2), (1,)
+        assert fake_hub.calls['multiCall'] == 3
+        assert fake_hub.calls['getBuild'] == 0
+
+    def test_descendants_from_index(self, fake_hub, tmpdir):
+        koji_session = CachingKojiWrapper(session=fake_hub)
+        koji_session.prefetch_records(range(1, 7))
+        koji_session.save_cache(path=str(tmpdir))
+
+        loaded = CachingKojiWrapper(session=FakeKojiHub())
+        loaded.load_cache(path=str(tmpdir))
+        assert loaded.get_descendants(1) == [2, 3, 4, 5]
+        assert loaded.get_descendants('openstack-img6-container-1.0-1') == []
+        assert loaded.get_ancestors(3) == [2, 1]
+
+    def test_get_tree_streams_output(self, fake_hub):
+        koji_session = CachingKojiWrapper(session=fake_hub)
+        dot = io.StringIO()
+        tree = koji_session.get_tree(['openstack-img5-container-1.0-1'], fout=dot)
+
+        assert tree == {5: 4, 4: 2, 2: 1, 1: None}
+        assert '2 -> 4 ;' in dot.getvalue()
+        assert '5 [label = "openstack-img5-container-1.0-1" ];' in dot.getvalue()
+
+        out = io.StringIO()
+        koji_session.write_graph([5, 4, 2, 1], out, output_format='json')
+        data = json.loads(out.getvalue())
+        assert [node['build_id'] for node in data['nodes']] == [1, 2, 4, 5]
+        assert data['edges'] == [[1, 2], [2, 4], [4, 5]]
@@ -0,0 +1,84 @@
+from container_processing.cache_manage import main
+from container_processing.cache_manage import parse_target
+from container_processing.cache_util import export_bundle
+from container_processing.cache_util import import_bundle
+from container_processing.caching_koji import CACHE_SCHEMA_VERSION
+from container_processing.caching_koji import CachingKojiWrapper
+from container_processing.test_support import make_synthetic_hub
+import os
+import pytest
+import tarfile
+
+
+@pytest.fixture
+def hub():
+    return make_synthetic_hub(builds=40, batches=2)
+
+
+@pytest.fixture
+def warm_cache_path(hub, tmpdir):
+    cache_path = str(tmpdir.join('cache'))
+    main(['--cache-path', cache_path, 'warm', '16.0:8', '16.0:8:container-released'],
+         koji_session=CachingKojiWrapper(session=hub))
+    return cache_path
+
+
+class TestCacheManage(object):
+
+    def test_parse_target(self):
+        assert parse_target('16.0:8') == (16.0, '8', 'candidate')
+        assert parse_target('13:7:container-released') == (13.0, '7', 'container-released')
+
+    def test_warm_then_run_is_warm(self, hub, warm_cache_path):
+        hub.calls.clear()
+        koji_session = CachingKojiWrapper(session=hub)
+        koji_session.load_cache(path=warm_cache_path)
+        nvrs = koji_session.get_list_containers(16.0, 8)
+        koji_session.get_records(sorted(nvrs), grab_build_task_info=True)
+
+        assert hub.calls['getBuild'] == 0
+        assert hub.calls['getTaskResult'] == 0
+        assert hub.calls['multiCall'] == 0
+
+    def test_bundle_round_trip(self, hub, warm_cache_path, tmpdir):
+        bundles = tmpdir.mkdir('bundles')
+        bundle = export_bundle(warm_cache_path, str(bundles))
+        assert os.path.basename(bundle).startswith('cache-')
+        # packed deterministically, the same caches give the same bundle
+        assert export_bundle(warm_cache_path, str(bundles)) == bundle
+
+        worker_path = str(tmpdir.join('worker'))
+        written = import_bundle(bundle, worker_path, CACHE_SCHEMA_VERSION)
+        assert 'build_data' in written
+        assert import_bundle(bundle, worker_path, CACHE_SCHEMA_VERSION) == []
+
+        hub.calls.clear()
+        koji_session = CachingKojiWrapper(session=hub)
+        koji_session.load_cache(path=worker_path)
+        assert koji_session.verify_indexes() == []
+        koji_session.get_records(sorted(koji_session.get_list_containers(16.0, 8)),
+                                 grab_build_task_info=True)
+        assert hub.calls['getBuild'] == 0
+
+    def test_corrupt_bundle_refused(self, warm_cache_path, tmpdir):
+        bundle = export_bundle(warm_cache_path, str(tmpdir))
+        with open(bundle, 'ab') as fout:
+            fout.write(b'x')
+        with pytest.raises(ValueError):
+            import_bundle(bundle, str(tmpdir.join('worker')), CACHE_SCHEMA_VERSION)
+
+    def test_bundle_schema_checked(self, warm_cache_path, tmpdir):
+        bundle = export_bundle(warm_cache_path, str(tmpdir.join('bundle.tar.xz')))
+        with tarfile.open(bundle) as tar:
+            assert 'manifest.json' in tar.getnames()
+        with pytest.raises(ValueError):
+            import_bundle(bundle, str(tmpdir.join('worker')), CACHE_SCHEMA_VERSION + 1)
+
+    def test_export_without_pickle_caches(self, hub, tmpdir, capsys):
+        cache_path = str(tmpdir.join('cache'))
+        main(['--cache-path', cache_path, 'warm', '16.0:8', '--cache-backend', 'sqlite'],
+             koji_session=CachingKojiWrapper(session=hub, cache_backend='sqlite'))
+
+        assert main(['--cache-path', cache_path, 'export', str(tmpdir)]) == 1
+        assert 'no pickle backend caches to export' in capsys.readouterr().err
+        assert main(['--cache-path', str(tmpdir.join('empty')), 'export', str(tmpdir)]) == 1
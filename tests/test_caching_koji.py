@@ -0,0 +1,529 @@
+from cachetools import Cache
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from container_processing import caching_koji
+from container_processing.cache_util import cache_dir_lock
+from container_processing.caching_koji import CACHE_SCHEMA_VERSION
+from container_processing.caching_koji import CachingKojiWrapper
+from container_processing.test_support import FakeKojiHub
+from container_processing.test_support import make_container_build
+from container_processing.test_support import make_task_result
+import io
+import json
+import koji
+import os
+import pytest
+import threading
+import time
+
+TAG = 'rhos-16.0-rhel-8-candidate'
+
+
+@pytest.fixture
+def fake_hub():
+    hub = FakeKojiHub()
+    base = make_container_build(1, 'openstack-base-container')
+    hub.add_build(base, make_task_result(base, batch='20190601.1'), tags=[TAG])
+    for build_id in range(2, 12):
+        build = make_container_build(build_id, 'openstack-svc{0}-container'.format(build_id),
+                                     parent_build_id=1)
+        batch = '20190601.1' if build_id % 2 else '20190602.1'
+        hub.add_build(build, make_task_result(build, batch=batch), tags=[TAG])
+    return hub
+
+
+@pytest.fixture
+def koji_session(fake_hub):
+    return CachingKojiWrapper(session=fake_hub, multicall_chunk_size=4)
+
+
+class TestCachingKoji(object):
+
+    def test_prefetch_fills_caches(self, koji_session, fake_hub):
+        koji_session.prefetch_records(range(1, 12), grab_build_task_info=True)
+
+        assert len(koji_session._build_data) == 11
+        assert len(koji_session._task_results) == 11
+        # 11 builds and 11 tasks in chunks of 4
+        assert fake_hub.calls['multiCall'] == 6
+        assert fake_hub.calls['getBuild'] == 0
+        assert fake_hub.calls['getTaskResult'] == 0
+
+    def test_prefetch_skips_cached(self, koji_session, fake_hub):
+        koji_session.build(1)
+        koji_session.prefetch_records([1, 2])
+
+        assert fake_hub.calls['getBuild'] == 1
+        assert fake_hub.calls['multiCall'] == 1
+        assert len(koji_session._build_data) == 2
+
+    def test_prefetch_ignores_missing(self, koji_session, fake_hub):
+        koji_session.prefetch_records([1, 999], grab_build_task_info=True)
+
+        assert 999 not in koji_session._build_data
+        assert 1 in koji_session._build_data
+
+    def test_matching_batch_uses_multicall(self, koji_session, fake_hub):
+        data = koji_session.get_matching_batch_from_tag(16, 8, '20190602.1')
+
+        expected = set(['openstack-svc{0}-container'.format(i) for i in range(2, 12, 2)])
+        # parent images are pulled in with the batch
+        expected.add('openstack-base-container')
+        assert set(data) == expected
+        assert fake_hub.calls['getBuild'] == 0
+        assert fake_hub.calls['getTaskResult'] == 0
+
+    def test_batch_independent_of_other_tags(self, koji_session, fake_hub):
+        other_tag = 'rhos-17.0-rhel-9-candidate'
+        for build_id, batch in [(12, 'B1'), (13, 'B1-respin'), (14, 'B2')]:
+            build = make_container_build(build_id, 'openstack-svc{0}-container'.format(build_id))
+            fake_hub.add_build(build, make_task_result(build, batch=batch), tags=[other_tag])
+        build = make_container_build(15, 'openstack-svc15-container')
+        fake_hub.add_build(build, make_task_result(build, batch='B1'), tags=[TAG])
+
+        fresh = CachingKojiWrapper(session=fake_hub).get_matching_batch_from_tag(17, 9, 'B1')
+        assert sorted(fresh) == ['openstack-svc12-container', 'openstack-svc13-container']
+
+        # the exact label is indexed from the other tag first
+        assert list(koji_session.get_matching_batch_from_tag(16, 8, 'B1')) == \
+            ['openstack-svc15-container']
+        assert koji_session.get_matching_batch_from_tag(17, 9, 'B1') == fresh
+
+    def test_matching_batch_with_parents(self, koji_session, fake_hub):
+        koji_session.prefetch_records([1])
+        data = koji_session.get_matching_batch_from_tag(16, 8, '20190601.1')
+        record = data['openstack-svc3-container'][3]
+
+        assert record['parent_build_id'] == 1
+        assert record['nvr'] == 'openstack-svc3-container-1.0-1'
+        assert 'openstack-base-container' in data
+
+    def test_container_builds_from_tag(self, koji_session, fake_hub):
+        data = koji_session.get_container_builds_from_koji_tag(koji_session.get_koji_tag(TAG),
+                                                               get_extra_info=True)
+
+        assert len(data) == 11
+        record = data['openstack-svc4-container'][4]
+        assert record['nvr'] == 'openstack-svc4-container-1.0-1'
+        assert record['parent_build_id'] == 1
+        assert record['task_pullspecs'] == fake_hub.task_results[100004]['repositories']
+        assert fake_hub.calls['listTagged'] == 1
+        assert fake_hub.calls['getBuild'] == 0
+
+    def test_thread_pool_records_keep_order(self, fake_hub):
+        koji_session = CachingKojiWrapper(session=fake_hub, multicall_chunk_size=0, max_workers=4)
+        build_ids = list(range(11, 0, -1))
+        records = koji_session.get_records(build_ids, grab_build_task_info=True)
+
+        assert [record['build_id'] for record in records] == build_ids
+        assert fake_hub.calls['multiCall'] == 0
+        assert fake_hub.calls['getBuild'] == 11
+        assert all('task_pullspecs' in record for record in records)
+
+    def test_locked_caches_round_trip(self, koji_session, tmpdir):
+        koji_session.prefetch_records(range(1, 12), grab_build_task_info=True)
+        koji_session.save_cache(path=str(tmpdir))
+
+        loaded = CachingKojiWrapper(session=FakeKojiHub())
+        loaded.load_cache(path=str(tmpdir))
+
+        assert loaded.getRecordForBuild(3, grab_build_task_info=True) == \
+            koji_session.getRecordForBuild(3, grab_build_task_info=True)
+
+    def test_save_writes_manifest(self, koji_session, tmpdir):
+        koji_session.prefetch_records(range(1, 12))
+        koji_session.save_cache(path=str(tmpdir))
+
+        manifest = json.loads(tmpdir.join('manifest.json').read())
+        assert manifest['schema_version'] == CACHE_SCHEMA_VERSION
+        assert manifest['caches']['build_data']['entries'] == 11
+        assert manifest['caches']['nvr_to_build_id']['entries'] == 11
+
+        loaded = CachingKojiWrapper(session=FakeKojiHub())
+        loaded.load_cache(path=str(tmpdir))
+        assert len(loaded._nvr_to_build_id) == 11
+        assert not any(cache.dirty for _, cache in loaded._caches())
+
+    def test_save_skips_clean_caches(self, koji_session, tmpdir):
+        koji_session.prefetch_records(range(1, 12))
+        koji_session.save_cache(path=str(tmpdir))
+        before = tmpdir.join('build_data').mtime(), tmpdir.join('task_results').read_binary()
+
+        koji_session.getTaskResult(100001)
+        os.utime(str(tmpdir.join('build_data')), (0, 0))
+        koji_session.save_cache(path=str(tmpdir))
+
+        assert tmpdir.join('build_data').mtime() == 0
+        assert tmpdir.join('task_results').read_binary() != before[1]
+
+    def test_corrupt_cache_invalidates_only_itself(self, koji_session, tmpdir):
+        koji_session.prefetch_records(range(1, 12), grab_build_task_info=True)
+        koji_session.save_cache(path=str(tmpdir))
+        tmpdir.join('task_results').write_binary(b'truncated')
+
+        loaded = CachingKojiWrapper(session=FakeKojiHub())
+        loaded.load_cache(path=str(tmpdir))
+
+        assert len(loaded._task_results) == 0
+        assert loaded._task_results.dirty
+        assert len(loaded._build_data) == 11
+        assert not loaded._build_data.dirty
+
+    def test_lazy_load_defers_reads(self, koji_session, tmpdir):
+        koji_session.prefetch_records(range(1, 12), grab_build_task_info=True)
+        koji_session.save_cache(path=str(tmpdir))
+
+        loaded = CachingKojiWrapper(session=FakeKojiHub())
+        loaded.load_cache(path=str(tmpdir))
+        assert not any(cache.loaded for _, cache in loaded._caches())
+
+        loaded.getRecordForBuild(3)
+        assert loaded._build_data.loaded
+        assert not loaded._task_results.loaded
+
+        # untouched caches are neither loaded nor rewritten by save
+        tmpdir.join('task_results').write_binary(b'left alone')
+        loaded.save_cache(path=str(tmpdir))
+        assert not loaded._task_results.loaded
+        assert tmpdir.join('task_results').read_binary() == b'left alone'
+
+    def test_batch_label_index(self, koji_session, fake_hub, tmpdir):
+        koji_session.get_matching_batch_from_tag(16, 8, '20190601.1')
+        koji_session.save_cache(path=str(tmpdir))
+
+        loaded = CachingKojiWrapper(session=fake_hub)
+        loaded.load_cache(path=str(tmpdir))
+        fake_hub.calls.clear()
+
+        data = loaded.get_matching_batch_from_tag(16, 8, '20190602.1')
+        assert len(data) == 6
+        assert fake_hub.calls['getTaskResult'] == 0
+        assert fake_hub.calls['multiCall'] == 0
+
+        labels = loaded.get_batch_labels(loaded.get_koji_tag(TAG))
+        assert labels['20190601.1'] == [1, 3, 5, 7, 9, 11]
+        assert labels['20190602.1'] == [2, 4, 6, 8, 10]
+        assert labels['1.0-1'] == list(range(1, 12))
+
+
+class TestLookupCoalescing(object):
+
+    def test_concurrent_lookups_share_one_call(self, fake_hub):
+        fake_hub.latency = 0.05
+        koji_session = CachingKojiWrapper(session=fake_hub)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            nvrs = list(executor.map(koji_session.get_nvr, [3] * 8))
+
+        assert nvrs == [fake_hub.builds[3]['nvr']] * 8
+        assert fake_hub.calls['getBuild'] == 1
+
+    def test_missing_build_remembered(self, koji_session, fake_hub, tmpdir):
+        assert koji_session.build('no-such-container-1.0-1') is None
+        assert koji_session.getBuildId('no-such-container-1.0-1') is None
+        assert koji_session.getParentBuildId('no-such-container-1.0-1') is None
+        assert fake_hub.calls['getBuild'] == 1
+        assert koji_session.getParentBuildId(999) is None
+        assert koji_session.getBuildTaskId(999) is None
+        assert koji_session.get_tree([999, 'no-such-container-1.0-1', 3],
+                                     fout=io.StringIO()) == {3: 1, 1: None}
+        assert fake_hub.calls['getBuild'] == 2
+
+        koji_session.save_cache(path=str(tmpdir))
+        loaded = CachingKojiWrapper(session=fake_hub)
+        loaded.load_cache(path=str(tmpdir))
+        assert loaded.build('no-such-container-1.0-1') is None
+        assert fake_hub.calls['getBuild'] == 2
+
+    def test_missing_build_expires(self, fake_hub):
+        koji_session = CachingKojiWrapper(session=fake_hub, negative_cache_ttl=0)
+        koji_session.build(999)
+        koji_session.build(999)
+        assert fake_hub.calls['getBuild'] == 2
+
+    def test_task_fault_not_cached(self, koji_session, fake_hub):
+        task_result = fake_hub.task_results.pop(100005)
+        koji_session.prefetch_records([5], grab_build_task_info=True)
+        assert 100005 not in koji_session._task_results
+
+        record = koji_session.getRecordForBuild(5, grab_build_task_info=True)
+        assert 'task_pullspecs' not in record
+        assert not koji_session._negative_lookups
+
+        # the task finished meanwhile
+        fake_hub.task_results[100005] = task_result
+        record = koji_session.getRecordForBuild(5, grab_build_task_info=True)
+        assert record['task_pullspecs'] == task_result['repositories']
+
+    def test_record_of_missing_build(self, koji_session, fake_hub):
+        assert koji_session.getRecordForBuild('no-such-container-1.0-1') is None
+        assert koji_session.getRecordForBuild(999, grab_build_task_info=True) is None
+
+    def test_record_of_build_without_task(self, koji_session, fake_hub):
+        build = make_container_build(12, 'openstack-svc12-container')
+        del build['extra']['container_koji_task_id']
+        fake_hub.add_build(build, tags=[TAG])
+
+        record = koji_session.getRecordForBuild(12, grab_build_task_info=True)
+        assert record['nvr'] == 'openstack-svc12-container-1.0-1'
+        assert 'task_pullspecs' not in record
+        assert fake_hub.calls['getTaskResult'] == 0
+        assert 'openstack-svc12-container' not in \
+            koji_session.get_matching_batch_from_tag(16, 8, '20190601.1')
+
+    def test_faulted_task_fetched_once_per_scan(self, koji_session, fake_hub):
+        fake_hub.task_results.pop(100005)
+        koji_session.get_matching_batch_from_tag(16, 8, '20190601.1')
+        # builds and tasks of 11 builds in chunks of 4
+        assert fake_hub.calls['multiCall'] == 6
+        assert fake_hub.calls['getTaskResult'] == 0
+
+        fake_hub.calls.clear()
+        koji_session.get_matching_batch_from_tag(16, 8, '20190601.1')
+        # only the faulted task is asked for again
+        assert fake_hub.calls['multiCall'] == 1
+        assert fake_hub.calls['getTaskResult'] == 0
+
+    def test_fault_not_cached(self, koji_session, fake_hub):
+        get_build = fake_hub._hub_getBuild
+        fake_hub._hub_getBuild = lambda buildInfo, strict=False: fake_hub._hub_getTaskResult(0)
+        with pytest.raises(koji.GenericError):
+            koji_session.build(5)
+
+        fake_hub._hub_getBuild = get_build
+        assert koji_session.build(5)['id'] == 5
+        assert fake_hub.calls['getBuild'] == 2
+
+
+class TestIndexConsistency(object):
+
+    def test_indexes_follow_inserts(self, koji_session, fake_hub, tmpdir):
+        assert koji_session.verify_indexes() == []
+
+        koji_session.get_list_containers(16, 8)
+        koji_session.getRecordForBuild('openstack-svc3-container-1.0-1', grab_build_task_info=True)
+        koji_session.get_matching_batch_from_tag(16, 8, '20190602.1')
+        koji_session.getParentBuildId(7)
+        assert koji_session.verify_indexes() == []
+
+        koji_session.save_cache(path=str(tmpdir))
+        loaded = CachingKojiWrapper(session=fake_hub)
+        loaded.load_cache(path=str(tmpdir))
+        fake_hub.calls.clear()
+        assert loaded.verify_indexes() == []
+        assert loaded.getBuildId('openstack-svc3-container-1.0-1') == 3
+        assert fake_hub.calls['getBuild'] == 0
+
+    def test_problems_reported(self, koji_session):
+        koji_session.prefetch_records(range(1, 12), grab_build_task_info=True)
+        koji_session._nvr_to_build_id['openstack-svc3-container-1.0-1'] = 4
+        koji_session._build_id_to_child_ids[1] = (2, 3)
+        del koji_session._batch_label_to_build_ids['20190602.1']
+
+        problems = koji_session.verify_indexes()
+        assert 'nvr openstack-svc3-container-1.0-1 maps to 4 not 3' in problems
+        assert 'build 4 missing from the children of 1' in problems
+        assert 'build 2 missing from label 20190602.1' in problems
+
+
+class TestSharedCacheDir(object):
+
+    def test_concurrent_writers_merge(self, fake_hub, tmpdir):
+        path = str(tmpdir)
+        CachingKojiWrapper(session=fake_hub).save_cache(path=path)
+
+        first = CachingKojiWrapper(session=fake_hub)
+        first.load_cache(path=path)
+        second = CachingKojiWrapper(session=fake_hub)
+        second.load_cache(path=path)
+
+        first.getRecordForBuild(2)
+        second.getRecordForBuild(3)
+        first.save_cache(path=path)
+        second.save_cache(path=path)
+
+        merged = CachingKojiWrapper(session=fake_hub)
+        merged.load_cache(path=path)
+        assert sorted(merged._build_data.keys()) == [2, 3]
+        assert merged.build_graph.get_children(1) == [2, 3]
+        assert merged.verify_indexes() == []
+
+    def test_save_waits_for_lock(self, koji_session, tmpdir):
+        koji_session.getRecordForBuild(2)
+        saved = threading.Event()
+
+        def save():
+            koji_session.save_cache(path=str(tmpdir))
+            saved.set()
+
+        with cache_dir_lock(str(tmpdir)):
+            thread = threading.Thread(target=save)
+            thread.start()
+            assert not saved.wait(0.2)
+        thread.join()
+        assert saved.is_set()
+
+    def test_load_during_save(self, koji_session, fake_hub, tmpdir, monkeypatch):
+        koji_session.getRecordForBuild(2, grab_build_task_info=True)
+        koji_session.save_cache(path=str(tmpdir))
+        loaded = CachingKojiWrapper(session=fake_hub)
+        loaded.load_cache(path=str(tmpdir))
+
+        saving = threading.Event()
+        load_manifest = caching_koji.load_manifest
+
+        def slow_load_manifest(*args):
+            if threading.current_thread().name == 'save':
+                saving.set()
+                # the lazy load below starts while the save holds the lock
+                time.sleep(0.2)
+            return load_manifest(*args)
+        monkeypatch.setattr(caching_koji, 'load_manifest', slow_load_manifest)
+
+        found = []
+        save = threading.Thread(target=loaded.save_cache, kwargs={'path': str(tmpdir)},
+                                name='save')
+        load = threading.Thread(target=lambda: found.append(100002 in loaded._task_results))
+        save.daemon = load.daemon = True
+        save.start()
+        saving.wait()
+        load.start()
+        save.join(5)
+        load.join(5)
+
+        assert not save.is_alive() and not load.is_alive()
+        assert found == [True]
+
+    def test_read_only_pickle(self, koji_session, fake_hub, tmpdir):
+        koji_session.getRecordForBuild(2)
+        koji_session.save_cache(path=str(tmpdir))
+        before = tmpdir.join('manifest.json').read()
+
+        reader = CachingKojiWrapper(session=fake_hub, cache_read_only=True)
+        reader.load_cache(path=str(tmpdir))
+        reader.getRecordForBuild(3)
+        reader.save_cache(path=str(tmpdir))
+        assert tmpdir.join('manifest.json').read() == before
+
+    def test_read_only_sqlite(self, fake_hub, tmpdir):
+        writer = CachingKojiWrapper(session=fake_hub, cache_backend='sqlite')
+        writer.load_cache(path=str(tmpdir))
+        writer.getRecordForBuild(2)
+
+        reader = CachingKojiWrapper(session=fake_hub, cache_backend='sqlite',
+                                    cache_read_only=True)
+        reader.load_cache(path=str(tmpdir))
+        fake_hub.calls.clear()
+        assert reader.get_nvr(2) == fake_hub.builds[2]['nvr']
+        assert fake_hub.calls['getBuild'] == 0
+
+        reader.getRecordForBuild(3)
+        assert writer._cache_store.get('build_data', 3) == (False, None)
+
+
+class TestTieredCaches(object):
+
+    def test_immutable_caches_not_bounded(self, koji_session):
+        koji_session.prefetch_records(range(1, 12), grab_build_task_info=True)
+        stats = koji_session.stats()['caches']
+
+        assert stats['build_data']['maxsize'] is None
+        assert stats['build_data']['evictions'] == 0
+        assert not hasattr(koji_session._build_data.cache, 'ttl')
+        assert stats['negative_lookups']['maxsize'] is not None
+
+    def test_memory_tier_in_front_of_store(self, fake_hub, tmpdir, monkeypatch):
+        monkeypatch.setattr('container_processing.caching_koji.MEMORY_TIER_SIZE', 4)
+        koji_session = CachingKojiWrapper(session=fake_hub, cache_backend='sqlite')
+        koji_session.load_cache(path=str(tmpdir))
+        koji_session.prefetch_records(range(1, 12))
+
+        assert len(koji_session._build_data.cache.front) == 4
+        assert koji_session._build_data.cache.ttl is None
+        fake_hub.calls.clear()
+        assert [koji_session.get_nvr(i) for i in range(1, 12)] == \
+            [fake_hub.builds[i]['nvr'] for i in range(1, 12)]
+        assert fake_hub.calls['getBuild'] == 0
+
+    def test_ttl_caches_from_schema_4_converted(self, koji_session, fake_hub, tmpdir):
+        koji_session.prefetch_records(range(1, 12), grab_build_task_info=True)
+        # as saved before the immutable caches lost their ttl and maxsize
+        build_data = TTLCache(maxsize=6000, ttl=604800)
+        build_data.update(koji_session._build_data.items())
+        koji_session._build_data.cache = build_data
+        koji_session._build_data.dirty = True
+        koji_session.save_cache(path=str(tmpdir))
+        manifest = json.loads(tmpdir.join('manifest.json').read())
+        manifest['schema_version'] = 4
+        tmpdir.join('manifest.json').write(json.dumps(manifest))
+
+        loaded = CachingKojiWrapper(session=fake_hub)
+        loaded.load_cache(path=str(tmpdir))
+        assert type(loaded._build_data.cache) is Cache
+        assert len(loaded._build_data) == 11
+        assert loaded.verify_indexes() == []
+
+
+class TestTargetFanOut(object):
+
+    @pytest.fixture
+    def shared_hub(self, fake_hub):
+        # the same base and service builds are tagged into a second release
+        for build_id in range(1, 12):
+            fake_hub.tag_build('rhos-16.1-rhel-8-candidate', build_id)
+        extra = make_container_build(12, 'openstack-extra-container', parent_build_id=1)
+        fake_hub.add_build(extra, make_task_result(extra, batch='20190602.1'),
+                           tags=['rhos-16.1-rhel-8-candidate'])
+        return fake_hub
+
+    def test_shared_builds_resolved_once(self, koji_session, shared_hub):
+        data = koji_session.get_containers_for_targets([(16, 8, 'candidate'),
+                                                        (16.1, '8', 'candidate')])
+
+        assert sorted(data) == [(16.0, '8', 'candidate'), (16.1, '8', 'candidate')]
+        assert len(data[(16.0, '8', 'candidate')]) == 11
+        assert data[(16.1, '8', 'candidate')]['openstack-extra-container'][12]['nvr'] == \
+            'openstack-extra-container-1.0-1'
+        hub = koji_session.stats()['hub']
+        assert hub['multicall:getBuild']['calls'] == 12
+        assert hub['multicall:listTagged']['round_trips'] == 1
+        assert hub['getLastEvent']['calls'] == 1
+        assert shared_hub.calls['getBuild'] == 0
+
+    def test_batch_matches_single_tag(self, koji_session, shared_hub):
+        data = koji_session.get_containers_for_targets(
+            [(16, 8, 'candidate'), (16.1, 8, 'candidate')], batch='20190602.1')
+
+        single = CachingKojiWrapper(session=shared_hub)
+        assert data[(16.0, '8', 'candidate')] == \
+            single.get_matching_batch_from_tag(16, 8, '20190602.1')
+        assert 'openstack-extra-container' in data[(16.1, '8', 'candidate')]
+        assert koji_session.stats()['hub']['multicall:getTaskResult']['calls'] == 12
+
+
+class TestTagPaging(object):
+
+    def test_iter_tagged_offset_limit(self, koji_session):
+        tagged = koji_session.list_tagged(TAG)
+        pages = list(koji_session.iter_tagged(TAG, offset=2, limit=7, page_size=3))
+
+        assert [len(page) for page in pages] == [3, 3, 1]
+        assert [i['id'] for page in pages for i in page] == [i['id'] for i in tagged[2:9]]
+
+    def test_records_resolve_lazily(self, koji_session, fake_hub):
+        records = koji_session.iter_container_records(TAG, page_size=4)
+        first = next(records)
+
+        # only the first page has been resolved
+        assert len(koji_session._build_data) == 4
+        assert first['build_id'] in koji_session._build_data
+        assert len([first] + list(records)) == 11
+        assert fake_hub.calls['multiCall'] == 3
+        assert fake_hub.calls['getBuild'] == 0
+
+    def test_streamed_batch_matches(self, koji_session, fake_hub):
+        streamed = list(koji_session.iter_matching_batch(TAG, '20190602.1', page_size=3))
+        single = CachingKojiWrapper(session=fake_hub)
+
+        assert koji_session._by_component(streamed) == \
+            single.get_matching_batch_from_tag(16, 8, '20190602.1')
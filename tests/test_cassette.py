@@ -0,0 +1,91 @@
+from container_processing.caching_koji import CachingKojiWrapper
+from container_processing.cassette import Cassette
+from container_processing.cassette import CassetteMiss
+from container_processing.test_support import make_synthetic_hub
+from container_processing.update_internal_container_registry import main
+import koji
+import pytest
+
+TAG = 'rhos-16.0-rhel-8-candidate'
+
+
+@pytest.fixture
+def hub():
+    return make_synthetic_hub(builds=40, batches=2)
+
+
+@pytest.fixture
+def cassette_file(hub, tmpdir):
+    filename = str(tmpdir.join('hub.cassette'))
+    koji_session = CachingKojiWrapper(session=hub, multicall_chunk_size=8, record_to=filename)
+    koji_session.get_matching_batch_from_tag(16, 8, '20190102.1')
+    koji_session.get_latest_cdn_containers(16, 8, extra_info=True)
+    assert koji_session.build('no-such-build-1-1') is None
+    with pytest.raises(koji.GenericError):
+        koji_session._hub_call('noSuchMethod')
+    koji_session.save_cassette()
+    return filename
+
+
+class TestCassette(object):
+
+    def test_replay_without_hub(self, hub, cassette_file):
+        replayed = CachingKojiWrapper(replay_from=cassette_file, multicall_chunk_size=8)
+        live = CachingKojiWrapper(session=hub, multicall_chunk_size=8)
+
+        assert replayed.get_matching_batch_from_tag(16, 8, '20190102.1') == \
+            live.get_matching_batch_from_tag(16, 8, '20190102.1')
+        assert replayed.get_latest_cdn_containers(16, 8, extra_info=True) == \
+            live.get_latest_cdn_containers(16, 8, extra_info=True)
+        assert replayed.session.calls['multiCall'] > 0
+
+    def test_multicall_replayed_in_other_chunks(self, hub, cassette_file):
+        replayed = CachingKojiWrapper(replay_from=cassette_file, multicall_chunk_size=0)
+        live = CachingKojiWrapper(session=hub)
+
+        assert replayed.get_matching_batch_from_tag(16, 8, '20190102.1') == \
+            live.get_matching_batch_from_tag(16, 8, '20190102.1')
+        assert replayed.session.calls['multiCall'] == 0
+        assert replayed.session.calls['getBuild'] > 0
+
+    def test_faults_and_misses(self, cassette_file):
+        replayed = CachingKojiWrapper(replay_from=cassette_file)
+
+        assert replayed.build('no-such-build-1-1') is None
+        with pytest.raises(koji.GenericError):
+            replayed._hub_call('noSuchMethod')
+        with pytest.raises(CassetteMiss):
+            replayed.list_tagged('rhos-17.0-rhel-9-candidate')
+
+    def test_latency(self, cassette_file, monkeypatch):
+        sleeps = []
+        monkeypatch.setattr('container_processing.cassette.time.sleep', sleeps.append)
+        replayed = CachingKojiWrapper(replay_from=cassette_file, replay_latency=0.25)
+        replayed.list_tagged(TAG)
+
+        assert sleeps == [0.25, 0.25]
+        assert sum(replayed.session.calls.values()) == 2
+
+    def test_repeated_calls_in_order(self, hub, tmpdir):
+        filename = str(tmpdir.join('events.cassette'))
+        koji_session = CachingKojiWrapper(session=hub, record_to=filename)
+        first = koji_session.session.getLastEvent()
+        hub.tag_build(TAG, 1)
+        second = koji_session.session.getLastEvent()
+        koji_session.save_cassette()
+
+        cassette = Cassette.load(filename)
+        assert len(cassette) == 2
+        assert [cassette.play('getLastEvent', (), {}) for i in range(3)] == \
+            [{'result': first}, {'result': second}, {'result': second}]
+
+    def test_cli_replay(self, hub, tmpdir, capsys):
+        cassette = str(tmpdir.join('cli.cassette'))
+        argv = ['16.0', 'ci', '--rhel', '8', '--from-cdn', '--batch', '20190102.1']
+        koji_session = CachingKojiWrapper(session=hub, record_to=cassette)
+        main(argv + ['--cache-path', str(tmpdir.join('recorded')), '--record', cassette],
+             koji_session=koji_session)
+        recorded = capsys.readouterr().out
+
+        main(argv + ['--cache-path', str(tmpdir.join('replayed')), '--replay', cassette])
+        assert capsys.readouterr().out == recorded
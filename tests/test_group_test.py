@@ -1,6 +1,10 @@
 
 
 from container_processing.group_test_parse import extract_summary_from_group_test_event
+from container_processing.group_test_parse import iter_group_test_summaries
+from container_processing.group_test_parse import iter_json_messages
+import io
+import json
 import pytest
 
 
@@ -19,3 +23,70 @@ class TestGroupTest(object):
         assert 'errata_id' in data.keys()
         assert 'message_id' in data.keys()
         assert len(data['images']) == 9
+
+
+def make_dump(sample, message_ids, indent=None, separator='\n'):
+    messages = []
+    for message_id in message_ids:
+        message = json.loads(sample)
+        message['headers']['message-id'] = message_id
+        messages.append(json.dumps(message, indent=indent))
+    return separator.join(messages)
+
+
+class TestGroupTestStream(object):
+
+    def test_jsonl_dump(self, sample_group_test):
+        dump = make_dump(sample_group_test, ['a', 'b', 'a', 'c'])
+
+        summaries = list(iter_group_test_summaries(io.StringIO(dump), chunk_size=100))
+        assert [i['message_id'] for i in summaries] == ['a', 'b', 'c']
+        assert all(len(i['images']) == 9 for i in summaries)
+
+    def test_concatenated_dump(self, sample_group_test):
+        dump = make_dump(sample_group_test, ['a', 'b'], indent=2, separator='')
+        dump += '\n{"headers": {"message-id": "other"}, "msg": {}}\n'
+
+        summaries = list(iter_group_test_summaries(io.StringIO(dump), chunk_size=7))
+        assert [i['message_id'] for i in summaries] == ['a', 'b']
+
+    def test_seen_shared_between_dumps(self, sample_group_test):
+        seen = {}
+        first = iter_group_test_summaries(io.StringIO(make_dump(sample_group_test, ['a'])),
+                                          seen=seen)
+        second = iter_group_test_summaries(io.StringIO(make_dump(sample_group_test, ['a', 'b'])),
+                                           seen=seen)
+        assert len(list(first)) == 1
+        assert [i['message_id'] for i in second] == ['b']
+
+    def test_truncated_dump(self, sample_group_test):
+        dump = make_dump(sample_group_test, ['a', 'b'])[:-10]
+        with pytest.raises(ValueError):
+            list(iter_json_messages(io.StringIO(dump)))
+
+    def test_line_buffered_skips_bad_lines(self, sample_group_test, capsys):
+        dump = 'not json\n' + make_dump(sample_group_test, ['a', 'b']) + '\n{"cut": \n'
+
+        summaries = list(iter_group_test_summaries(io.StringIO(dump), line_buffered=True))
+        assert [i['message_id'] for i in summaries] == ['a', 'b']
+        assert capsys.readouterr().err.count('does not parse') == 2
+
+    def test_dump_resyncs_after_bad_message(self, sample_group_test, capsys):
+        dump = '{"headers": not json}\n' + make_dump(sample_group_test, ['a', 'b'])
+        reads = []
+
+        class Dump(io.StringIO):
+            def read(self, size=-1):
+                reads.append(size)
+                return super().read(size)
+
+        summaries = list(iter_group_test_summaries(Dump(dump), chunk_size=100))
+        assert [i['message_id'] for i in summaries] == ['a', 'b']
+        assert 'does not parse' in capsys.readouterr().err
+        # never more than about one message is buffered
+        assert max(reads) < len(dump) / 2
+
+    def test_message_size_cap(self):
+        dump = '{"images": "' + 'x' * 1000
+        with pytest.raises(ValueError, match='no message within 100'):
+            list(iter_json_messages(io.StringIO(dump), chunk_size=10, max_message_size=100))
@@ -0,0 +1,128 @@
+from concurrent.futures import ThreadPoolExecutor
+from container_processing.caching_koji import CachingKojiWrapper
+from container_processing.hub_governor import HubGovernor
+from container_processing.stats import format_prometheus
+from container_processing.test_support import FakeKojiHub
+from container_processing.test_support import make_container_build
+from container_processing.test_support import make_task_result
+import koji
+import pytest
+import random
+import threading
+import time
+
+
+def flaky(failures, exception=OSError):
+    """Function raising exception failures times before returning 'ok'"""
+    state = {'left': failures}
+
+    def function():
+        if state['left']:
+            state['left'] -= 1
+            raise exception('connection reset')
+        return 'ok'
+    return function
+
+
+class TestHubGovernor(object):
+
+    def test_retries_with_jittered_backoff(self):
+        sleeps = []
+        governor = HubGovernor(max_limit=8, retries=3, backoff=1.0, sleep=sleeps.append,
+                               rng=random.Random(1))
+
+        assert governor.call('getBuild', flaky(2)) == 'ok'
+        assert len(sleeps) == 2
+        assert 0 <= sleeps[0] <= 1.0 and 0 <= sleeps[1] <= 2.0
+        # both failures started after the previous cut, each halves the limit
+        assert governor.stats()['decreases'] == 2
+        assert governor.limit == 2 + 1 / 2.0
+
+    def test_gives_up(self):
+        governor = HubGovernor(retries=2, sleep=lambda seconds: None)
+        with pytest.raises(OSError):
+            governor.call('getBuild', flaky(3))
+        assert governor.stats()['retries'] == 2
+
+    def test_faults_not_retried(self):
+        governor = HubGovernor(sleep=lambda seconds: None)
+        with pytest.raises(koji.GenericError):
+            governor.call('getBuild', flaky(1, exception=koji.GenericError))
+        assert governor.stats()['retries'] == 0
+        assert governor.limit == governor.max_limit
+
+    def test_server_offline_retried(self):
+        governor = HubGovernor(sleep=lambda seconds: None)
+        assert governor.call('getBuild', flaky(1, exception=koji.ServerOffline)) == 'ok'
+
+    def test_concurrent_failures_cut_once(self):
+        governor = HubGovernor(max_limit=8)
+        epochs = [governor.acquire() for _ in range(6)]
+        for epoch in epochs:
+            governor.release(epoch, 'getBuild', 1.0, failed=True)
+
+        assert governor.limit == 4
+        assert governor.in_flight == 0
+
+    def test_slow_requests_count_as_congestion(self):
+        governor = HubGovernor(max_limit=4)
+        for seconds in (0.2, 0.2, 0.25):
+            governor.release(governor.acquire(), 'getBuild', seconds)
+        assert governor.limit == 4
+
+        governor.release(governor.acquire(), 'getBuild', 2.0)
+        assert governor.limit == 2
+        # a multicall is measured against other multicalls
+        governor.release(governor.acquire(), 'multicall:getBuild', 2.0)
+        assert governor.limit > 2
+
+    def test_additive_increase(self):
+        governor = HubGovernor(max_limit=4)
+        governor.limit = 1.0
+        for _ in range(3):
+            governor.release(governor.acquire(), 'getBuild', 0.01)
+        assert 2 < governor.limit < 3
+
+    def test_limit_bounds_threads(self):
+        governor = HubGovernor(max_limit=2)
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def request():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda i: governor.call('getBuild', request), range(16)))
+        assert running[1] == 2
+
+
+class TestGovernedWrapper(object):
+
+    def test_multicall_chunk_retried(self):
+        hub = FakeKojiHub()
+        for build_id in range(1, 5):
+            build = make_container_build(build_id, 'openstack-svc{0}-container'.format(build_id))
+            hub.add_build(build, make_task_result(build))
+        multi_call = hub._multi_call
+        failures = flaky(1)
+
+        def unreliable(calls):
+            failures()
+            return multi_call(calls)
+        hub._multi_call = unreliable
+
+        koji_session = CachingKojiWrapper(session=hub, multicall_chunk_size=2)
+        koji_session._governor.sleep = lambda seconds: None
+        koji_session.prefetch_records([1, 2, 3, 4])
+
+        assert len(koji_session._build_data) == 4
+        stats = koji_session.stats()
+        assert stats['governor']['retries'] == 1
+        assert stats['hub']['multicall:getBuild']['errors'] == 1
+        assert stats['hub']['multicall:getBuild']['round_trips'] == 3
+        assert 'container_processing_hub_retries_total 1' in format_prometheus(stats)
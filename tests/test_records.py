@@ -0,0 +1,105 @@
+from container_processing.caching_koji import CachingKojiWrapper
+from container_processing.records import BuildRecord
+from container_processing.records import TaskRecord
+from container_processing.test_support import FakeKojiHub
+from container_processing.test_support import make_container_build
+from container_processing.test_support import make_task_result
+import json
+import pickle
+import pytest
+
+
+@pytest.fixture
+def large_build():
+    build = make_container_build(7, 'openstack-nova-api-container', parent_build_id=3)
+    # index manifests and friends make up most of a real build payload
+    build['extra']['image']['index']['digests'] = {'application/vnd.docker': 'sha256:' + 'f' * 64}
+    build['extra']['osbs_build'] = {'subtypes': [], 'engine': 'buildah'}
+    build['extra']['image']['manifest'] = ['layer{0}'.format(i) * 20 for i in range(200)]
+    return build
+
+
+class TestRecords(object):
+
+    def test_build_record_projection(self, large_build):
+        record = BuildRecord.from_build(large_build)
+
+        assert record.id == 7
+        assert record.nvr == 'openstack-nova-api-container-1.0-1'
+        assert record.task_id == 100007
+        assert record.parent_build_id == 3
+        assert record.pullspecs == tuple(large_build['extra']['image']['index']['pull'])
+        assert record.raw is None
+        assert len(pickle.dumps(record)) * 10 < len(pickle.dumps(large_build))
+
+    def test_build_record_round_trip(self, large_build):
+        record = BuildRecord.from_build(large_build)
+        assert BuildRecord.from_build(record.to_build()) == record
+        assert pickle.loads(pickle.dumps(record)) == record
+
+        raw = BuildRecord.from_build(large_build, keep_raw=True)
+        assert raw.to_build() is large_build
+
+    def test_task_record(self):
+        result = make_task_result(make_container_build(7, 'openstack-nova-api-container'), batch='b1')
+        record = TaskRecord.from_result(result)
+
+        assert record.koji_builds == (7,)
+        assert record.to_result() == result
+        assert TaskRecord.from_result({'faultCode': 1000}).repositories is None
+
+    def test_wrapper_stores_records(self, large_build, tmpdir):
+        hub = FakeKojiHub()
+        hub.add_build(large_build, make_task_result(large_build))
+        koji_session = CachingKojiWrapper(session=hub)
+
+        assert koji_session.build(7)['extra']['image']['parent_build_id'] == 3
+        assert isinstance(koji_session._build_data[7], BuildRecord)
+        assert 'manifest' not in koji_session.build(7)['extra']['image']
+
+        koji_session = CachingKojiWrapper(session=hub, keep_raw_payloads=True)
+        assert koji_session.build(7) == large_build
+
+    def test_legacy_dict_caches_migrate(self, large_build, tmpdir):
+        hub = FakeKojiHub()
+        hub.add_build(large_build, make_task_result(large_build))
+        koji_session = CachingKojiWrapper(session=hub, keep_raw_payloads=True)
+        koji_session.getRecordForBuild(7, grab_build_task_info=True)
+        # caches as written before compact records and schema version 2
+        koji_session._build_data[7] = large_build
+        koji_session._task_results[100007] = hub.task_results[100007]
+        koji_session.save_cache(path=str(tmpdir))
+        tmpdir.join('manifest.json').write(json.dumps({'schema_version': 1, 'caches': {}}))
+
+        loaded = CachingKojiWrapper(session=FakeKojiHub())
+        loaded.load_cache(path=str(tmpdir))
+
+        assert isinstance(loaded._build_data[7], BuildRecord)
+        assert isinstance(loaded._task_results[100007], TaskRecord)
+        assert loaded.getRecordForBuild(7, grab_build_task_info=True)['task_pullspecs'] == \
+            hub.task_results[100007]['repositories']
+        assert loaded.verify_indexes() == []
+
+    def test_legacy_task_faults_dropped(self, tmpdir):
+        hub = FakeKojiHub()
+        build = make_container_build(5, 'openstack-svc5-container')
+        hub.add_build(build, make_task_result(build, batch='B1'),
+                      tags=['rhos-16.0-rhel-8-candidate'])
+        koji_session = CachingKojiWrapper(session=hub)
+        koji_session.getRecordForBuild(5)
+        # caches written while failed task lookups were cached
+        koji_session._task_results[100005] = {'faultCode': 1000, 'faultString': 'not done'}
+        koji_session.save_cache(path=str(tmpdir))
+        tmpdir.join('manifest.json').write(json.dumps({'schema_version': 4, 'caches': {}}))
+
+        loaded = CachingKojiWrapper(session=hub)
+        loaded.load_cache(path=str(tmpdir))
+        assert 100005 not in loaded._task_results
+        assert loaded._task_results.dirty
+        assert list(loaded.get_matching_batch_from_tag(16, 8, 'B1')) == ['openstack-svc5-container']
+
+        # a fault row left in a store the migration did not run on
+        loaded._task_results[100005] = {'faultCode': 1000, 'faultString': 'not done'}
+        assert loaded.getRecordForBuild(5, grab_build_task_info=True)['task_pullspecs'] == \
+            hub.task_results[100005]['repositories']
+        assert isinstance(loaded._task_results[100005], TaskRecord)
@@ -0,0 +1,209 @@
+from container_processing.registry_ops import diff_updates
+from container_processing.registry_ops import fetch_snapshot
+from container_processing.registry_ops import imagestream_manifest
+from container_processing.registry_ops import RegistrySnapshot
+from container_processing.registry_ops import RegistryUpdate
+from container_processing.registry_ops import run_oc
+from container_processing.registry_ops import run_updates
+from container_processing.update_internal_container_registry import apply_registry_updates
+from container_processing.update_internal_container_registry import get_options
+import io
+import json
+import pytest
+import threading
+import time
+
+
+class FakeOc(object):
+    """Runner recording oc argv, commands in fail fail that many times first"""
+
+    def __init__(self, fail=None, latency=0.0):
+        self.fail = dict(fail or {})
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self.output = ''
+
+    def __call__(self, argv):
+        with self.lock:
+            self.calls.append(argv)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.latency)
+        with self.lock:
+            self.running -= 1
+            key = ' '.join(argv)
+            if self.fail.get(key):
+                self.fail[key] -= 1
+                return 1, 'error: the server is currently unable to handle the request'
+        return 0, self.output
+
+
+def record(name, version_release):
+    return {'package_name': name, 'nvr': '{0}-{1}'.format(name, version_release),
+            'build_pullspecs': ['registry.example.com/rhosp/{0}:{1}'.format(
+                name[:-len('-container')], version_release)]}
+
+
+def image_stream(name, spec_tags, status_tags):
+    """ImageStream as oc get is -o json shows it, spec tag -> source tag, tag -> image"""
+    return {'kind': 'ImageStream', 'metadata': {'name': name},
+            'spec': {'tags': [{'name': tag, 'from': {'kind': 'ImageStreamTag',
+                                                     'name': '{0}:{1}'.format(name, source)}}
+                              for tag, source in spec_tags.items()]},
+            'status': {'tags': [{'tag': tag, 'items': [{'image': image}]}
+                                for tag, image in status_tags.items()]}}
+
+
+def current_streams():
+    return {'kind': 'List', 'items': [
+        image_stream('openstack-nova', {'ci': '16.0-2', 'latest': '16.0-2'},
+                     {'16.0-2': 'sha256:2', 'ci': 'sha256:2', 'latest': 'sha256:2'}),
+        image_stream('openstack-glance', {'ci': '16.0-1'},
+                     {'16.0-1': 'sha256:1', 'ci': 'sha256:1', 'latest': 'sha256:1'}),
+        image_stream('openstack-keystone', {},
+                     {'16.0-3': 'sha256:3', 'ci': 'sha256:3', 'latest': 'sha256:0'})]}
+
+
+class TestRegistryUpdate(object):
+
+    def test_from_record(self):
+        update = RegistryUpdate.from_record(record('openstack-nova-container', '16.0-2'), 'ci')
+
+        assert update.source == 'openstack-nova:16.0-2'
+        assert update.command_lines('rhosp16') == [
+            'oc -n rhosp16 import-image openstack-nova:16.0-2 '
+            '--from "registry.example.com/rhosp/openstack-nova:16.0-2" --insecure',
+            'oc -n rhosp16 tag openstack-nova:16.0-2 openstack-nova:ci openstack-nova:latest']
+        assert update.commands('rhosp16')[1] == [
+            'oc', '-n', 'rhosp16', 'tag', 'openstack-nova:16.0-2',
+            'openstack-nova:ci', 'openstack-nova:latest']
+
+    def test_manifest(self):
+        updates = [RegistryUpdate.from_record(record('openstack-nova-container', '16.0-2'),
+                                              'ci', skip_latest=True)]
+        manifest = imagestream_manifest(updates, 'rhosp16')
+
+        stream = manifest['items'][0]
+        assert manifest['kind'] == 'List'
+        assert stream['metadata'] == {'name': 'openstack-nova', 'namespace': 'rhosp16'}
+        assert [tag['name'] for tag in stream['spec']['tags']] == ['16.0-2', 'ci']
+        assert stream['spec']['tags'][1]['from'] == {
+            'kind': 'ImageStreamTag', 'name': 'openstack-nova:16.0-2'}
+
+
+class TestRunUpdates(object):
+
+    def test_parallel_in_order(self):
+        updates = [RegistryUpdate.from_record(record('openstack-svc{0}-container'.format(i),
+                                                     '16.0-1'), 'ci') for i in range(16)]
+        oc = FakeOc(latency=0.01)
+        results = run_updates(updates, 'rhosp16', runner=oc, max_workers=4)
+
+        assert [update for update, error in results] == updates
+        assert all(error is None for update, error in results)
+        assert 1 < oc.max_running <= 4
+        for update in updates:
+            import_call, tag_call = [argv for argv in oc.calls if argv[4] == update.source]
+            assert import_call[3] == 'import-image' and tag_call[3] == 'tag'
+
+    def test_retries(self):
+        update = RegistryUpdate.from_record(record('openstack-nova-container', '16.0-2'), 'ci')
+        import_line = ' '.join(update.commands('rhosp16')[0])
+        sleeps = []
+
+        oc = FakeOc(fail={import_line: 2})
+        results = run_updates([update], 'rhosp16', runner=oc, retries=2, sleep=sleeps.append)
+        assert results[0][1] is None
+        assert sleeps == [1.0, 2.0]
+        assert len(oc.calls) == 4
+
+        oc = FakeOc(fail={import_line: 3})
+        results = run_updates([update], 'rhosp16', runner=oc, retries=2, sleep=sleeps.append)
+        argv, returncode, output = results[0][1]
+        assert argv[3] == 'import-image' and returncode == 1
+        # the tag is not run without its import
+        assert len(oc.calls) == 3
+
+    def test_missing_oc(self):
+        returncode, output = run_oc(['/nonexistent/oc', 'whoami'])
+        assert returncode == 127 and '/nonexistent/oc' in output
+
+    def test_execute_option(self, capsys):
+        args = get_options(['16.0', 'ci', '--execute', '--oc-retries', '0'])
+        data = {'openstack-nova-container': [record('openstack-nova-container', '16.0-2')],
+                'openstack-glance-container': [record('openstack-glance-container', '16.0-2')]}
+        oc = FakeOc(fail={'oc -n rhosp16 tag openstack-glance:16.0-2 openstack-glance:ci '
+                          'openstack-glance:latest': 1})
+        fout = io.StringIO()
+
+        assert apply_registry_updates(data, args, fout=fout, runner=oc) == 1
+        assert '# updated openstack-nova:16.0-2' in fout.getvalue()
+        assert 'openstack-glance:16.0-2 failed' in capsys.readouterr().err
+
+    def test_manifest_option(self, tmpdir):
+        manifest = str(tmpdir.join('manifest.json'))
+        args = get_options(['16.0', 'ci', '--manifest', manifest])
+        data = {'openstack-nova-container': [record('openstack-nova-container', '16.0-2')]}
+        fout = io.StringIO()
+
+        assert apply_registry_updates(data, args, fout=fout) == 0
+        assert fout.getvalue() == 'oc apply -f {0}\n'.format(manifest)
+        with open(manifest) as fin:
+            assert json.load(fin)['items'][0]['metadata']['name'] == 'openstack-nova'
+
+
+class TestRegistryDiff(object):
+
+    def test_diff_against_snapshot(self):
+        snapshot = RegistrySnapshot.from_image_streams(current_streams())
+        updates = [RegistryUpdate.from_record(record(name, version_release), 'ci')
+                   for name, version_release in [('openstack-nova-container', '16.0-2'),
+                                                 ('openstack-glance-container', '16.0-2'),
+                                                 ('openstack-keystone-container', '16.0-3'),
+                                                 ('openstack-swift-container', '16.0-1')]]
+
+        changed = dict((update.container_name, update) for update in
+                       diff_updates(updates, snapshot))
+
+        # nova is up to date, the tags of keystone resolve to the same image
+        assert sorted(changed) == ['openstack-glance', 'openstack-keystone', 'openstack-swift']
+        assert changed['openstack-glance'].command_lines('rhosp16') == [
+            'oc -n rhosp16 import-image openstack-glance:16.0-2 '
+            '--from "registry.example.com/rhosp/openstack-glance:16.0-2" --insecure',
+            'oc -n rhosp16 tag openstack-glance:16.0-2 openstack-glance:ci openstack-glance:latest']
+        assert changed['openstack-keystone'].command_lines('rhosp16') == [
+            'oc -n rhosp16 tag openstack-keystone:16.0-3 openstack-keystone:latest']
+        assert changed['openstack-swift'].tags == ('ci', 'latest')
+
+    def test_current_tags_option(self, tmpdir):
+        current = tmpdir.join('current.json')
+        current.write(json.dumps(current_streams()))
+        args = get_options(['16.0', 'ci', '--current-tags', str(current)])
+        data = {'openstack-nova-container': [record('openstack-nova-container', '16.0-2')],
+                'openstack-glance-container': [record('openstack-glance-container', '16.0-2')]}
+        fout = io.StringIO()
+
+        apply_registry_updates(data, args, fout=fout)
+        lines = fout.getvalue().splitlines()
+        assert lines[0] == '# 1 of 2 images up to date'
+        assert len(lines) == 3
+        assert 'openstack-nova' not in fout.getvalue()
+
+    def test_diff_option_fetches_with_oc(self):
+        oc = FakeOc()
+        oc.output = json.dumps(current_streams())
+        args = get_options(['16.0', 'ci', '--diff'])
+        data = {'openstack-nova-container': [record('openstack-nova-container', '16.0-2')]}
+        fout = io.StringIO()
+
+        apply_registry_updates(data, args, fout=fout, runner=oc)
+        assert oc.calls == [['oc', '-n', 'rhosp16', 'get', 'imagestreams', '-o', 'json']]
+        assert fout.getvalue() == '# 1 of 1 images up to date\n'
+
+    def test_fetch_failure(self):
+        oc = FakeOc(fail={'oc -n rhosp16 get imagestreams -o json': 1})
+        with pytest.raises(RuntimeError):
+            fetch_snapshot('rhosp16', runner=oc)
@@ -0,0 +1,91 @@
+from cachetools import LRUCache
+from container_processing.caching_koji import CachingKojiWrapper
+from container_processing.sqlite_cache import KEY_PICKLE_PROTOCOL
+from container_processing.sqlite_cache import SqliteCache
+from container_processing.sqlite_cache import SqliteCacheStore
+from container_processing.test_support import FakeKojiHub
+from container_processing.test_support import make_container_build
+from container_processing.test_support import make_task_result
+import pickle
+import pytest
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def fake_hub():
+    hub = FakeKojiHub()
+    for build_id in range(1, 6):
+        build = make_container_build(build_id, 'openstack-svc{0}-container'.format(build_id))
+        hub.add_build(build, make_task_result(build))
+    return hub
+
+
+class TestSqliteCache(object):
+
+    def test_entries_written_as_set(self, tmpdir):
+        store = SqliteCacheStore(str(tmpdir.join('caches.sqlite')))
+        cache = SqliteCache(store, 'build_data', LRUCache(maxsize=2))
+        cache[1] = {'nvr': 'a-1-1'}
+
+        other = SqliteCacheStore(store.filename)
+        assert other.get('build_data', 1) == (True, {'nvr': 'a-1-1'})
+        assert other.get('task_results', 1) == (False, None)
+
+    def test_front_eviction_reads_from_disk(self, tmpdir):
+        store = SqliteCacheStore(str(tmpdir.join('caches.sqlite')))
+        cache = SqliteCache(store, 'nvr_to_build_id', LRUCache(maxsize=2))
+        for build_id in range(5):
+            cache['nvr-{0}'.format(build_id)] = build_id
+
+        assert len(cache.front) == 2
+        assert cache['nvr-0'] == 0
+        assert len(cache) == 5
+
+    def test_ttl_expiry(self, tmpdir):
+        timer = FakeTimer()
+        store = SqliteCacheStore(str(tmpdir.join('caches.sqlite')), timer=timer)
+        store.set('build_data', 1, 'build', ttl=10)
+
+        assert store.get('build_data', 1) == (True, 'build')
+        timer.now += 11
+        assert store.get('build_data', 1) == (False, None)
+        store.purge_expired()
+        assert store.count('build_data') == 0
+
+    def test_wrapper_survives_without_save(self, fake_hub, tmpdir):
+        koji_session = CachingKojiWrapper(session=fake_hub, cache_backend='sqlite')
+        koji_session.load_cache(path=str(tmpdir))
+        record = koji_session.getRecordForBuild(3, grab_build_task_info=True)
+
+        # no save_cache, a second process picks the entries up from disk
+        offline_hub = FakeKojiHub()
+        restarted = CachingKojiWrapper(session=offline_hub, cache_backend='sqlite')
+        restarted.load_cache(path=str(tmpdir))
+
+        assert restarted.getRecordForBuild(3, grab_build_task_info=True) == record
+        assert restarted.getRecordForBuild('openstack-svc3-container-1.0-1') == \
+            koji_session.getRecordForBuild(3)
+        assert sum(offline_hub.calls.values()) == 0
+
+    def test_entries_before_load_are_kept(self, fake_hub, tmpdir):
+        koji_session = CachingKojiWrapper(session=fake_hub, cache_backend='sqlite')
+        koji_session.build(1)
+        koji_session.save_cache(path=str(tmpdir))
+
+        restarted = CachingKojiWrapper(session=FakeKojiHub(), cache_backend='sqlite')
+        restarted.load_cache(path=str(tmpdir))
+        assert restarted.build(1)['nvr'] == 'openstack-svc1-container-1.0-1'
+
+    def test_keys_pickled_with_fixed_protocol(self, tmpdir):
+        store = SqliteCacheStore(str(tmpdir.join('caches.sqlite')))
+        store.set('nvr_to_build_id', 'a-1-1', 1)
+
+        key = store.conn.execute('SELECT key FROM entries').fetchone()[0]
+        assert bytes(key) == pickle.dumps('a-1-1', protocol=KEY_PICKLE_PROTOCOL)
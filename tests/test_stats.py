@@ -0,0 +1,89 @@
+from cachetools import LRUCache
+from container_processing.cache_util import LockedCache
+from container_processing.caching_koji import CachingKojiWrapper
+from container_processing.stats import format_prometheus
+from container_processing.stats import HubCallStats
+from container_processing.stats import report_stats
+from container_processing.test_support import FakeKojiHub
+from container_processing.test_support import make_container_build
+from container_processing.test_support import make_task_result
+import pytest
+
+TAG = 'rhos-16.0-rhel-8-candidate'
+
+
+@pytest.fixture
+def fake_hub():
+    hub = FakeKojiHub()
+    for build_id in range(1, 6):
+        build = make_container_build(build_id, 'openstack-svc{0}-container'.format(build_id))
+        hub.add_build(build, make_task_result(build), tags=[TAG])
+    return hub
+
+
+class TestCacheStats(object):
+
+    def test_hits_misses_evictions(self):
+        cache = LockedCache(LRUCache(maxsize=2))
+        cache['a'] = 1
+        cache['b'] = 2
+        assert 'a' in cache
+        assert cache.get('c') is None
+        with pytest.raises(KeyError):
+            cache['d']
+        cache['c'] = 3
+
+        stats = cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 2
+        assert stats['evictions'] == 1
+        assert stats['size'] == 2
+        assert stats['maxsize'] == 2
+
+        cache.reset_stats()
+        assert cache.stats()['hits'] == 0
+
+
+class TestHubStats(object):
+
+    def test_hub_calls_counted(self, fake_hub):
+        koji_session = CachingKojiWrapper(session=fake_hub)
+        koji_session.prefetch_records([1, 2, 3], grab_build_task_info=True)
+        koji_session.get_records([1, 2, 3], grab_build_task_info=True)
+
+        hub = koji_session.stats()['hub']
+        assert hub['multicall:getBuild']['calls'] == 3
+        assert hub['multicall:getBuild']['round_trips'] == 1
+        assert hub['multicall:getTaskResult']['calls'] == 3
+        assert 'getBuild' not in hub
+
+        caches = koji_session.stats()['caches']
+        assert caches['build_data']['hits'] > 0
+
+    def test_errors_counted(self, fake_hub):
+        koji_session = CachingKojiWrapper(session=fake_hub)
+        with pytest.raises(Exception):
+            koji_session._hub_call('noSuchMethod')
+        assert koji_session.stats()['hub']['noSuchMethod']['errors'] == 1
+
+    def test_prometheus_textfile(self, fake_hub, tmpdir):
+        koji_session = CachingKojiWrapper(session=fake_hub)
+        koji_session.list_tagged(TAG)
+        textfile = tmpdir.join('koji.prom')
+        report_stats(koji_session, prometheus_textfile=str(textfile))
+
+        text = textfile.read()
+        assert 'container_processing_hub_calls_total{method="listTagged"} 1' in text
+        assert 'container_processing_hub_call_seconds_count{method="listTagged"} 1' in text
+        assert '# TYPE container_processing_cache_hits_total counter' in text
+
+    def test_histogram_cumulative(self):
+        hub_stats = HubCallStats(buckets=(0.1, 1.0))
+        hub_stats.record('getBuild', 0.05)
+        hub_stats.record('getBuild', 0.5)
+        hub_stats.record('getBuild', 5)
+
+        text = format_prometheus({'caches': {}, 'hub': hub_stats.as_dict()})
+        assert 'container_processing_hub_call_seconds_bucket{le="0.1",method="getBuild"} 1' in text
+        assert 'container_processing_hub_call_seconds_bucket{le="1.0",method="getBuild"} 2' in text
+        assert 'container_processing_hub_call_seconds_bucket{le="+Inf",method="getBuild"} 3' in text
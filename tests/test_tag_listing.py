@@ -0,0 +1,92 @@
+from container_processing.caching_koji import CachingKojiWrapper
+from container_processing.test_support import FakeKojiHub
+from container_processing.test_support import make_container_build
+from container_processing.test_support import make_task_result
+import koji
+import pytest
+
+TAG = 'rhos-16.0-rhel-8-candidate'
+
+
+@pytest.fixture
+def fake_hub():
+    hub = FakeKojiHub()
+    for build_id in range(1, 21):
+        build = make_container_build(build_id, 'openstack-svc{0}-container'.format(build_id % 10),
+                                     release=str(build_id))
+        hub.add_build(build, make_task_result(build), tags=[TAG])
+    return hub
+
+
+def nvrs(tagged):
+    return sorted(i['nvr'] for i in tagged)
+
+
+class TestTagListing(object):
+
+    def test_unchanged_tag_is_not_relisted(self, fake_hub):
+        koji_session = CachingKojiWrapper(session=fake_hub)
+        first = koji_session.list_tagged(TAG)
+        second = koji_session.list_tagged(TAG)
+
+        assert nvrs(first) == nvrs(second)
+        assert len(first) == 20
+        assert fake_hub.calls['listTagged'] == 1
+        assert fake_hub.calls['queryHistory'] == 0
+
+    def test_history_applied_as_delta(self, fake_hub, tmpdir):
+        koji_session = CachingKojiWrapper(session=fake_hub)
+        koji_session.list_tagged(TAG)
+        koji_session.save_cache(path=str(tmpdir))
+
+        new_build = make_container_build(21, 'openstack-svc1-container', release='21')
+        fake_hub.add_build(new_build, tags=[TAG])
+        fake_hub.untag_build(TAG, 5)
+        fake_hub.untag_build(TAG, 6)
+        fake_hub.tag_build(TAG, 6)
+
+        expected = nvrs(fake_hub.listTagged(TAG, type='image'))
+        expected_latest = nvrs(fake_hub.listTagged(TAG, type='image', latest=True))
+
+        restarted = CachingKojiWrapper(session=fake_hub)
+        restarted.load_cache(path=str(tmpdir))
+        fake_hub.calls.clear()
+
+        assert nvrs(restarted.list_tagged(TAG)) == expected
+        assert nvrs(restarted.list_tagged(TAG, latest=True)) == expected_latest
+        assert fake_hub.calls['listTagged'] == 0
+        assert fake_hub.calls['queryHistory'] == 1
+
+    def test_max_age_skips_hub(self, fake_hub):
+        koji_session = CachingKojiWrapper(session=fake_hub, tag_listing_max_age=3600)
+        koji_session.list_tagged(TAG)
+        fake_hub.untag_build(TAG, 1)
+        fake_hub.calls.clear()
+
+        assert len(koji_session.list_tagged(TAG)) == 20
+        assert sum(fake_hub.calls.values()) == 0
+
+    def test_list_containers_uses_cache(self, fake_hub):
+        koji_session = CachingKojiWrapper(session=fake_hub)
+        containers = koji_session.get_list_containers(16, 8, latest=True)
+
+        assert len(containers) == 10
+        assert 'openstack-svc0-container-1.0-20' in containers
+        koji_session.get_list_containers(16, 8)
+        assert fake_hub.calls['listTagged'] == 1
+
+    def test_failed_delta_keeps_old_event(self, fake_hub):
+        koji_session = CachingKojiWrapper(session=fake_hub)
+        koji_session.list_tagged(TAG)
+        event_id = koji_session._tag_listings[TAG]['event_id']
+
+        fake_hub.add_build(make_container_build(21, 'openstack-svc1-container', release='21'),
+                           tags=[TAG])
+        get_build = fake_hub._hub_getBuild
+        fake_hub._hub_getBuild = lambda buildInfo, strict=False: fake_hub._hub_getTaskResult(0)
+        with pytest.raises(koji.GenericError):
+            koji_session.list_tagged(TAG)
+        assert koji_session._tag_listings[TAG]['event_id'] == event_id
+
+        fake_hub._hub_getBuild = get_build
+        assert 'openstack-svc1-container-1.0-21' in nvrs(koji_session.list_tagged(TAG))
@@ -0,0 +1,189 @@
+from argparse import Namespace
+from container_processing.caching_koji import CachingKojiWrapper
+from container_processing.group_test_parse import summarize_group_test_event
+from container_processing.test_support import FakeKojiHub
+from container_processing.test_support import make_container_build
+from container_processing.test_support import make_task_result
+from container_processing.update_internal_container_registry import gather_sources
+from container_processing.update_internal_container_registry import get_options
+from container_processing.update_internal_container_registry import iter_spool_dir
+from container_processing.update_internal_container_registry import main
+from container_processing.update_internal_container_registry import merge_sources
+from container_processing.update_internal_container_registry import run_daemon
+import io
+import json
+import os
+import pytest
+
+CANDIDATE = 'rhos-16.0-rhel-8-candidate'
+RELEASED = 'rhos-16.0-rhel-8-container-released'
+
+
+@pytest.fixture
+def koji_session():
+    hub = FakeKojiHub()
+    for build_id, name, release, tag in [(1, 'openstack-nova-container', '1', RELEASED),
+                                         (2, 'openstack-nova-container', '2', CANDIDATE),
+                                         (3, 'openstack-glance-container', '1', RELEASED),
+                                         (4, 'openstack-glance-container', '2', CANDIDATE),
+                                         (5, 'openstack-keystone-container', '1', RELEASED)]:
+        build = make_container_build(build_id, name, release=release)
+        hub.add_build(build, make_task_result(build, batch='20190602.1'), tags=[tag])
+    return CachingKojiWrapper(session=hub)
+
+
+def options(**kwargs):
+    args = Namespace(osp=16.0, rhel=8, from_cdn=False, batch=None)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+class TestUpdateInternalContainerRegistry(object):
+
+    def test_gather_dedups_nvr_lookups(self, koji_session):
+        nvr = 'openstack-nova-container-1.0-2'
+        cdn_data, batch_data, group_test_data, from_file = gather_sources(
+            koji_session, options(), [nvr], [nvr])
+
+        assert cdn_data == {} and batch_data == {}
+        assert group_test_data == from_file
+        assert koji_session.session.calls['getBuild'] == 1
+
+    def test_merge_precedence(self, koji_session):
+        sources = gather_sources(koji_session, options(from_cdn=True, batch='20190602.1'),
+                                 ['openstack-nova-container-1.0-2'],
+                                 ['openstack-nova-container-1.0-1',
+                                  'openstack-glance-container-1.0-1'])
+        cdn_data, batch_data, group_test_data, from_file = sources
+        data = merge_sources(cdn_data, batch_data, from_file, group_test_data)
+
+        assert data['openstack-nova-container'][0]['nvr'] == 'openstack-nova-container-1.0-2'
+        assert data['openstack-glance-container'][0]['nvr'] == 'openstack-glance-container-1.0-1'
+        assert data['openstack-keystone-container'][0]['nvr'] == 'openstack-keystone-container-1.0-1'
+
+    def test_several_releases(self, koji_session, tmpdir, capsys):
+        for build_id in (1, 3, 5):
+            koji_session.session.tag_build('rhos-17.0-rhel-9-container-released', build_id)
+
+        assert main(['16.0', 'ci', '--rhel', '8', '--release', '17.0:9', '--from-cdn',
+                     '--cache-path', str(tmpdir)], koji_session=koji_session) == 0
+
+        output = capsys.readouterr().out
+        assert '# Updating rhos-17.0-rhel-9' in output
+        assert 'oc -n rhosp16 tag openstack-nova:1.0-1 openstack-nova:ci' in output
+        assert 'oc -n rhosp17 tag openstack-nova:1.0-1 openstack-nova:ci' in output
+        # the same builds resolved once for both releases
+        assert output.count('oc -n rhosp16 import-image') == 3
+        assert output.count('oc -n rhosp17 import-image') == 3
+        assert koji_session.stats()['hub']['multicall:getBuild']['calls'] == 3
+
+    def test_cdn_and_batch_share_lookups(self, tmpdir, capsys):
+        hub = FakeKojiHub(latency=0.01)
+        for build_id in range(1, 41):
+            build = make_container_build(build_id, 'openstack-svc{0}-container'.format(build_id))
+            hub.add_build(build, make_task_result(build, batch='20190602.1'),
+                          tags=[CANDIDATE, RELEASED])
+        koji_session = CachingKojiWrapper(session=hub, multicall_chunk_size=8)
+
+        main(['16.0', 'ci', '--rhel', '8', '--from-cdn', '--batch', '20190602.1',
+              '--cache-path', str(tmpdir)], koji_session=koji_session)
+
+        hub_stats = koji_session.stats()['hub']
+        assert hub_stats['multicall:getBuild']['calls'] == 40
+        assert hub_stats['multicall:getTaskResult']['calls'] == 40
+        assert capsys.readouterr().out.count('oc -n rhosp16 import-image') == 40
+
+    def test_stream_matches_merged(self, koji_session, tmpdir, capsys):
+        argv = ['16.0', 'ci', '--rhel', '8', '--from-cdn', '--batch', '20190602.1',
+                '--cache-path', str(tmpdir)]
+        main(argv, koji_session=koji_session)
+        merged = capsys.readouterr().out
+
+        main(argv + ['--stream'], koji_session=CachingKojiWrapper(session=koji_session.session))
+        streamed = capsys.readouterr().out
+
+        def oc_lines(output):
+            return sorted(line for line in output.splitlines() if line.startswith('oc -n'))
+        assert oc_lines(streamed) == oc_lines(merged)
+        assert 'openstack-keystone:1.0-1 openstack-keystone:ci' in streamed
+
+    def test_release_not_with_daemon(self, capsys):
+        with pytest.raises(SystemExit):
+            get_options(['16.0', 'ci', '--release', '17.0:9', '--daemon', '-'])
+
+    def test_releases_of_one_namespace(self, capsys):
+        with pytest.raises(SystemExit):
+            get_options(['16.0', 'ci', '--rhel', '8', '--release', '16.1:8'])
+        assert 'both update namespace rhosp16' in capsys.readouterr().err
+
+    def test_release_not_with_explicit_nvrs(self, capsys):
+        with pytest.raises(SystemExit):
+            get_options(['16.0', 'ci', '--release', '17.0:9', '--from-file', 'nvrs.txt'])
+
+
+def group_test_message(message_id, nvrs):
+    images = [{'nvr': nvr, 'full_name': nvr, 'namespace': 'rh-osbs', 'tag': 'latest'}
+              for nvr in nvrs]
+    return {'headers': {'message-id': message_id},
+            'msg': {'artifact': {'errata_id': 1, 'images': images}}}
+
+
+class TestDaemon(object):
+
+    def test_spool_dir_messages(self, koji_session, tmpdir):
+        spool = tmpdir.mkdir('spool')
+        for name, message_id, nvrs in [('1.json', 'm1', ['openstack-nova-container-1.0-2']),
+                                       ('2.json', 'm2', ['openstack-nova-container-1.0-2',
+                                                         'openstack-glance-container-1.0-2']),
+                                       ('3.json', 'm1', ['openstack-nova-container-1.0-1']),
+                                       ('4.json.tmp', 'm4', ['openstack-nova-container-1.0-1'])]:
+            spool.join(name).write(json.dumps(group_test_message(message_id, nvrs)))
+        spool.join('5.json').write('{"truncated"')
+
+        args = get_options(['16.0', 'ci', '--cache-path', str(tmpdir.join('cache'))])
+        fout = io.StringIO()
+        run_daemon(koji_session, args, iter_spool_dir(str(spool), {}, once=True), fout=fout)
+
+        output = fout.getvalue()
+        assert output.count('# group test message') == 2
+        assert 'oc -n rhosp16 tag openstack-glance:1.0-2 openstack-glance:ci openstack-glance:latest' \
+            in output
+        # the nova build of m1 is not looked up again for m2
+        assert koji_session.session.calls['getBuild'] == 2
+        assert sorted(os.listdir(str(spool.join('done')))) == ['1.json', '2.json', '3.json']
+        assert os.listdir(str(spool.join('failed'))) == ['5.json']
+        assert spool.join('4.json.tmp').exists()
+        assert tmpdir.join('cache', 'manifest.json').exists()
+
+    def test_checkpoint_interval(self, koji_session, tmpdir, monkeypatch):
+        saves = []
+        monkeypatch.setattr(koji_session, 'save_cache', lambda path: saves.append(path))
+        args = get_options(['16.0', 'ci', '--checkpoint-interval', '10'])
+        clock = iter([0, 5, 12, 13, 14]).__next__
+        messages = [summarize_group_test_event(group_test_message(
+            str(i), ['openstack-nova-container-1.0-2'])) for i in range(3)]
+
+        run_daemon(koji_session, args, messages, fout=io.StringIO(), clock=clock)
+
+        # one periodic checkpoint and the final one
+        assert len(saves) == 2
+
+    def test_failed_update_skipped(self, koji_session, tmpdir, monkeypatch, capsys):
+        args = get_options(['16.0', 'ci', '--diff', '--cache-path', str(tmpdir)])
+        applied = []
+
+        def apply_registry_updates(data, args, fout=None):
+            if not applied:
+                applied.append(None)
+                raise RuntimeError('oc get is failed')
+            applied.append(sorted(data))
+        monkeypatch.setattr('container_processing.update_internal_container_registry.'
+                            'apply_registry_updates', apply_registry_updates)
+        messages = [summarize_group_test_event(group_test_message(
+            str(i), ['openstack-nova-container-1.0-2'])) for i in range(2)]
+
+        run_daemon(koji_session, args, messages, fout=io.StringIO())
+
+        assert applied == [None, ['openstack-nova-container']]
+        assert 'group test message 0 failed' in capsys.readouterr().err